@@ -1,8 +1,9 @@
 
 from contextlib import closing
+import shutil
 from yaml import load, SafeLoader
 
-from interfaces.database.Catalog import ReadInterface
+from interfaces.database.Catalog import FederatedReadInterface, ReadInterface
 from util import Logs
 
 from typing import Any, Dict, List
@@ -78,21 +79,62 @@ class SimpleApp:
                                            self.cfg.logpath()
                                            )
         self.replicas = {}
-    
+        self.catalogs = {}
+
+    def catalog_dbpath(self, catalog_name: str, replica=False) -> str:
+        """
+        Returns the path of a catalog database, or of its read replica,
+        which must have been exported.
+        """
+        moniker = self.cfg.catalog_cfg[catalog_name]["moniker"]
+        if not replica:
+            return f"{self.cfg.sonicat_path}/data/catalog/{moniker}.sqlite"
+        dbpath = f"{self.cfg.sonicat_path}/data/catalog/{moniker}-ReadReplica.sqlite"
+        if not shutil.os.path.isfile(dbpath):
+            raise FileNotFoundError(f"No read replica of catalog {catalog_name} at {dbpath};"\
+                                    " export one from the catalog first")
+        return dbpath
+
     def load_catalog_replicas(self, catalog_names=[]) -> bool:
         """
-        Creates connections to all read-replica catalog database instances.
+        Creates read-only connections to all read-replica catalog database
+        instances. Replicas lag the catalogs; checks that writes depend on
+        belong on load_catalogs() connections.
         """
         if not catalog_names:
             catalog_names = self.cfg.catalog_names()
         elif not all([_c in self.cfg.catalog_names() for _c in catalog_names]):
             raise ValueError
         for catalog_name in catalog_names:
-            moniker = self.cfg.catalog_cfg[catalog_name]["moniker"]
-            dbpath = f"{self.cfg.sonicat_path}/data/catalog/{moniker}.sqlite"
-            self.replicas[catalog_name] = ReadInterface(dbpath)
+            self.replicas[catalog_name] = ReadInterface(self.catalog_dbpath(catalog_name,
+                                                                            replica=True),
+                                                        readonly=True)
         return 
 
+    def load_catalogs(self, catalog_names=[]) -> bool:
+        """Creates read-only connections to the primary catalog databases."""
+        if not catalog_names:
+            catalog_names = self.cfg.catalog_names()
+        elif not all([_c in self.cfg.catalog_names() for _c in catalog_names]):
+            raise ValueError
+        for catalog_name in catalog_names:
+            self.catalogs[catalog_name] = ReadInterface(self.catalog_dbpath(catalog_name),
+                                                        readonly=True)
+        return True
+
+    def load_federated_catalogs(self, catalog_names=[]) -> FederatedReadInterface:
+        """
+        Creates a single connection with all read-replica catalogs attached,
+        for queries spanning catalogs.
+        """
+        if not catalog_names:
+            catalog_names = self.cfg.catalog_names()
+        elif not all([_c in self.cfg.catalog_names() for _c in catalog_names]):
+            raise ValueError
+        catalog_paths = {_c: self.catalog_dbpath(_c, replica=True) for _c in catalog_names}
+        self.federated = FederatedReadInterface(catalog_paths)
+        return self.federated
+
   # Methods to be reimplemented by subclasses
     def run_cycle(self, task: Dict = {}) -> List[Dict]:
         raise RuntimeError
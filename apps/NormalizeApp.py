@@ -85,8 +85,8 @@ class CleanUp(App):
                             f"{self.managed}/{_label}/")
                             ]
             label_id = self.writable[self.catalog_name].label_id_by_dirname(_label)
-            all_asset_data = self.writable[self.catalog_name].asset_data_by_label(label_id)
-            expected_assets = [_a["name"] for _a in all_asset_data]
+            expected_assets = [_a.name for _a
+                               in self.writable[self.catalog_name].iter_asset_data(label_id)]
             if not self.crosscheck_lists(expected_assets, found_assets):
                 return False
         return True
@@ -14,7 +14,8 @@ class Data(SimpleApp):
         super().__init__(sonicat_path, "analysis", "DataOperations")
         if sonicat_path == "":
             return None
-        self.data = DataInterface(f"{sonicat_path}/data/analysis/LibrosaAnalysis-ReadReplica.sqlite")
+        self.data = DataInterface(f"{sonicat_path}/data/analysis/LibrosaAnalysis-ReadReplica.sqlite",
+                                  readonly=True)
         self.load_catalog_replicas()
 
     def asset_audio_file_data(self, catalog, asset_id, filetype="wav") -> List[Dict]:
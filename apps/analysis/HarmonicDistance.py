@@ -1,10 +1,18 @@
 
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from decimal import Decimal
+import numpy as np
+import shutil
+import sqlite3
+from scipy.spatial.distance import cdist
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.neighbors import NearestNeighbors
 from time import time
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
 
 from interfaces.database.LibrosaData import DataInterface
-from apps.ConfiguredApp import SimpleApp
+from apps.App import AppConfig, SimpleApp
+from apps.analysis.HarmonicIndex import LshIndex
 from interfaces.Interface import DatabaseInterface
 from util import Logs
 
@@ -40,10 +48,344 @@ CREATE TABLE IF NOT EXISTS data (
   distance float NOT NULL
 );
 """
+# Lookup indexes, and a unique index that makes every insert skip pairs
+# already stored, exist whenever a store is opened. A full run on an empty
+# store drops them and builds them once it finishes or is interrupted,
+# rather than maintaining them through its bulk inserts.
+INTERCATALOG_INDEX_SCHEMA = [
+"""
+CREATE UNIQUE INDEX IF NOT EXISTS data_pair ON data (catalog1, file1, catalog2, file2);
+""",
+"""
+CREATE INDEX IF NOT EXISTS data_file1 ON data (catalog1, file1, distance, file2);
+""",
+"""
+CREATE INDEX IF NOT EXISTS data_file2 ON data (catalog2, file2, distance, file1);
+"""
+]
+INTRACATALOG_INDEX_SCHEMA = [
+"""
+CREATE UNIQUE INDEX IF NOT EXISTS data_pair ON data (file1, file2);
+""",
+"""
+CREATE INDEX IF NOT EXISTS data_file1 ON data (file1, distance, file2);
+""",
+"""
+CREATE INDEX IF NOT EXISTS data_file2 ON data (file2, distance, file1);
+"""
+]
+# Removes repeated pairs, recorded before the unique index existed
+INTERCATALOG_DUPLICATES = \
+"""
+DELETE FROM data WHERE id NOT IN
+  (SELECT MIN(id) FROM data GROUP BY catalog1, file1, catalog2, file2);
+"""
+INTRACATALOG_DUPLICATES = \
+"""
+DELETE FROM data WHERE id NOT IN (SELECT MIN(id) FROM data GROUP BY file1, file2);
+"""
+INTRACATALOG_NEIGHBOURS_SCHEMA = \
+"""
+CREATE TABLE IF NOT EXISTS data (
+  file1 integer NOT NULL,
+  rank integer NOT NULL,
+  file2 integer NOT NULL,
+  distance float NOT NULL,
+  PRIMARY KEY (file1, rank)
+) WITHOUT ROWID;
+"""
+INTRACATALOG_TRANSPOSED_SCHEMA = \
+"""
+CREATE TABLE IF NOT EXISTS data (
+  id integer PRIMARY KEY,
+  file1 integer NOT NULL,
+  file2 integer NOT NULL,
+  distance float NOT NULL,
+  shift integer NOT NULL
+);
+"""
+# complete is 0 once a run that leaves pairs out, e.g. a clustered run, has
+# set the watermark, until a run pairing every file has completed
+WATERMARK_SCHEMA = \
+"""
+CREATE TABLE IF NOT EXISTS watermark (
+  catalog text PRIMARY KEY,
+  chroma_id integer NOT NULL,
+  complete integer NOT NULL DEFAULT 1
+);
+"""
+CLUSTER_SCHEMA = [
+"""
+CREATE TABLE IF NOT EXISTS data (
+  file integer PRIMARY KEY,
+  cluster integer NOT NULL,
+  distance float NOT NULL
+);
+""",
+"""
+CREATE INDEX IF NOT EXISTS data_cluster ON data (cluster, distance);
+""",
+"""
+CREATE TABLE IF NOT EXISTS centroid (
+  id integer PRIMARY KEY,
+  size integer NOT NULL,
+  c01 real NOT NULL,
+  c02 real NOT NULL,
+  c03 real NOT NULL,
+  c04 real NOT NULL,
+  c05 real NOT NULL,
+  c06 real NOT NULL,
+  c07 real NOT NULL,
+  c08 real NOT NULL,
+  c09 real NOT NULL,
+  c10 real NOT NULL,
+  c11 real NOT NULL,
+  c12 real NOT NULL
+);
+"""
+]
+# Tiles are checkpointed against the chroma snapshot they were computed from
+INTRACATALOG_TILE_SCHEMA = \
+"""
+CREATE TABLE IF NOT EXISTS tile (
+  chroma_id integer NOT NULL,
+  row_start integer NOT NULL,
+  col_start integer NOT NULL,
+  size integer NOT NULL,
+  PRIMARY KEY (chroma_id, row_start, col_start, size)
+);
+"""
+# A full run in progress: its method, the last chromadistribution ID of its
+# chroma matrix and the last data row ID written before it began
+INTRACATALOG_RUN_SCHEMA = \
+"""
+CREATE TABLE IF NOT EXISTS run (
+  catalog text PRIMARY KEY,
+  method text NOT NULL,
+  chroma_id integer NOT NULL,
+  start_id integer NOT NULL
+);
+"""
+# Full run methods storing only some of the pairs
+PARTIAL_RUN_METHODS = ["clustered"]
+# Rows of the distance matrix computed per bulk transaction
+BLOCK_SIZE = 64
+# Transposed runs hold 12 scores per pair in memory
+TRANSPOSED_BLOCK_SIZE = 16
+# Rows and columns of the distance matrix per process pool tile
+TILE_SIZE = 1024
+# Neighbours stored per file by nearest neighbour runs
+NEIGHBOURS = 10
+# Harmonic families per catalog and neighbouring families searched with each
+CLUSTERS = 256
+NEIGHBOURING_CLUSTERS = 4
+
+
+# ROTATIONS[s] indexes the chroma bins of a vector shifted up s semitones
+ROTATIONS = (np.arange(12)[None, :] - np.arange(12)[:, None]) % 12
+# INVERSE_ROTATIONS[s] shifts down s semitones, as row . roll(col, s)
+# equals roll(row, -s) . col
+INVERSE_ROTATIONS = ROTATIONS[-np.arange(12) % 12]
+
+
+def squared_distances(rows: np.ndarray, cols: np.ndarray) -> Tuple[np.ndarray]:
+    return (cdist(rows, cols, "sqeuclidean"),)
+
+def transposed_distances(rows: np.ndarray, cols: np.ndarray) -> Tuple[np.ndarray]:
+    """
+    Returns (distances, shifts) arrays holding, for every row/column pair, the
+    smallest squared euclidean distance over all 12 circular rotations of the
+    column vector and the semitone shift of the column achieving it.
+    All rotations are scored in a single matrix product; the rows, usually
+    the smaller block, are rotated the other way rather than the columns.
+    """
+    rotated = rows[:, INVERSE_ROTATIONS].reshape(-1, 12)
+    products = (rotated @ cols.T).reshape(len(rows), 12, len(cols))
+    shifts = products.argmax(axis=1)
+    best = np.take_along_axis(products, shifts[:, None, :], axis=1)[:, 0, :]
+    distances = (rows**2).sum(axis=1)[:, None] + (cols**2).sum(axis=1)[None, :] - 2 * best
+    return (np.maximum(distances, 0), shifts)
+
+
+def blocked_intracatalog_distances(file_ids: np.ndarray,
+                                   matrix: np.ndarray,
+                                   last_pair=(0, 0),
+                                   block_size=BLOCK_SIZE,
+                                   scorer=squared_distances
+                                   ) -> Iterator[Tuple[np.ndarray]]:
+    """
+    Yields (file1, file2, distance) arrays for each block of <block_size> rows
+    of the upper triangle of the squared euclidean distance matrix.
+    <file_ids> must be sorted ascending. Pairs up to and including <last_pair>
+    are skipped, so that interrupted runs resume at the first unfinished block.
+    A <scorer> returning further arrays, such as transposed_distances, adds
+    them to each yielded tuple.
+    """
+    start = int(np.searchsorted(file_ids, last_pair[0]))
+    for lower in range(start, len(file_ids), block_size):
+        upper = min(lower + block_size, len(file_ids))
+        row_ids, col_ids = file_ids[lower:upper], file_ids[lower:]
+        scores = scorer(matrix[lower:upper], matrix[lower:])
+        mask = col_ids[None, :] > row_ids[:, None]
+        mask[row_ids == last_pair[0]] &= col_ids > last_pair[1]
+        rows, cols = np.nonzero(mask)
+        yield (row_ids[rows], col_ids[cols]) + tuple(_s[rows, cols] for _s in scores)
+
+
+def delta_intracatalog_distances(file_ids: np.ndarray,
+                                 matrix: np.ndarray,
+                                 new_ids: np.ndarray,
+                                 block_size=BLOCK_SIZE
+                                 ) -> Iterator[Tuple[np.ndarray]]:
+    """
+    Yields (file1, file2, distance) arrays pairing each file in <new_ids> with
+    every other file, computing pairs of two new files once, with
+    file1 < file2.
+    """
+    is_new = np.isin(file_ids, new_ids)
+    new_rows = np.flatnonzero(is_new)
+    for lower in range(0, len(new_rows), block_size):
+        rows = new_rows[lower:lower + block_size]
+        distances = cdist(matrix[rows], matrix, "sqeuclidean")
+        row_ids = file_ids[rows]
+        mask = ~is_new[None, :] | (file_ids[None, :] > row_ids[:, None])
+        mask &= file_ids[None, :] != row_ids[:, None]
+        rows, cols = np.nonzero(mask)
+        file1, file2 = row_ids[rows], file_ids[cols]
+        yield (np.minimum(file1, file2), np.maximum(file1, file2), distances[rows, cols])
+
+def delta_intercatalog_distances(file_ids1: np.ndarray,
+                                 matrix1: np.ndarray,
+                                 new_ids1: np.ndarray,
+                                 file_ids2: np.ndarray,
+                                 matrix2: np.ndarray,
+                                 new_ids2: np.ndarray,
+                                 block_size=BLOCK_SIZE
+                                 ) -> Iterator[Tuple[np.ndarray]]:
+    """
+    Yields (file1, file2, distance) arrays for every pair of files across
+    two catalogs in which either file is new, with file1 from the first
+    catalog.
+    """
+    is_new1 = np.isin(file_ids1, new_ids1)
+    new_rows1, old_rows1 = np.flatnonzero(is_new1), np.flatnonzero(~is_new1)
+    new_rows2 = np.flatnonzero(np.isin(file_ids2, new_ids2))
+    for lower in range(0, len(new_rows1), block_size):
+        rows = new_rows1[lower:lower + block_size]
+        distances = cdist(matrix1[rows], matrix2, "sqeuclidean")
+        file1, file2 = np.meshgrid(file_ids1[rows], file_ids2, indexing="ij")
+        yield (file1.ravel(), file2.ravel(), distances.ravel())
+    for lower in range(0, len(new_rows2), block_size):
+        cols = new_rows2[lower:lower + block_size]
+        distances = cdist(matrix1[old_rows1], matrix2[cols], "sqeuclidean")
+        file1, file2 = np.meshgrid(file_ids1[old_rows1], file_ids2[cols], indexing="ij")
+        yield (file1.ravel(), file2.ravel(), distances.ravel())
+
+
+def upper_triangle_tiles(n: int, tile_size=TILE_SIZE) -> List[Tuple[int]]:
+    """
+    Returns (row_start, col_start, size) tiles covering the upper triangle of
+    an <n> x <n> matrix.
+    """
+    return [(_r, _c, tile_size) for _r in range(0, n, tile_size)
+                                for _c in range(_r, n, tile_size)]
+
+
+# Chroma matrix memory-mapped once per pool worker
+_tile_matrix = None
+
+def load_tile_matrix(matrix_path: str) -> None:
+    global _tile_matrix
+    _tile_matrix = np.load(matrix_path, mmap_mode="r")
+
+def tile_distances(tile: Tuple[int]) -> Tuple:
+    """
+    Returns (tile, rows, cols, distances) for the pairs of a tile lying above
+    the diagonal, with rows and cols as indexes into the chroma matrix.
+    """
+    row_start, col_start, size = tile
+    distances = cdist(_tile_matrix[row_start:row_start + size],
+                      _tile_matrix[col_start:col_start + size],
+                      "sqeuclidean")
+    if row_start == col_start:
+        rows, cols = np.triu_indices(distances.shape[0], k=1,
+                                     m=distances.shape[1])
+    else:
+        rows, cols = np.indices(distances.shape).reshape(2, -1)
+    return (tile, rows + row_start, cols + col_start, distances[rows, cols])
+
+
+def closest(vector: np.ndarray,
+            matrix: np.ndarray,
+            squared_norms: np.ndarray,
+            k: int
+            ) -> Tuple[np.ndarray]:
+    """
+    Returns (rows, distances) of the <k> rows of <matrix> closest to <vector>
+    by squared euclidean distance, closest first, using a single
+    matrix-vector product. <squared_norms> holds the squared norm of each row.
+    """
+    distances = squared_norms - 2 * (matrix @ vector) + vector @ vector
+    np.maximum(distances, 0, out=distances)
+    if len(distances) > k:
+        rows = np.argpartition(distances, k)[:k]
+    else:
+        rows = np.arange(len(distances))
+    rows = rows[np.argsort(distances[rows], kind="stable")]
+    return (rows, distances[rows])
+
+
+def neighbouring_clusters(centroids: np.ndarray, n: int) -> np.ndarray:
+    """
+    Returns a (clusters, n) array of the <n> clusters with the closest
+    centroids to each cluster, closest first, excluding the cluster itself.
+    """
+    distances = cdist(centroids, centroids, "sqeuclidean")
+    np.fill_diagonal(distances, np.inf)
+    return np.argsort(distances, axis=1, kind="stable")[:, :min(n, len(centroids) - 1)]
+
+def clustered_pair_sources(neighbours: np.ndarray) -> List[List[int]]:
+    """
+    Returns, for each cluster, the other clusters whose files are paired with
+    its own files, such that every neighbouring pair of clusters is computed
+    from exactly one side.
+    """
+    sources = []
+    for cluster, others in enumerate(neighbours.tolist()):
+        sources.append([_o for _o in others
+                        if _o > cluster or cluster not in neighbours[_o]])
+    return sources
+
+
+def nearest_neighbours(file_ids: np.ndarray,
+                       matrix: np.ndarray,
+                       k=NEIGHBOURS
+                       ) -> Tuple[np.ndarray]:
+    """
+    Returns (file1, rank, file2, distance) arrays holding the <k> nearest
+    neighbours of every file by squared euclidean distance, rank 1 closest.
+    """
+    k = min(k, len(file_ids) - 1)
+    if k < 1:
+        return tuple(np.empty(0) for _ in range(4))
+    index = NearestNeighbors(n_neighbors=k + 1, algorithm="kd_tree", n_jobs=-1)
+    distances, indexes = index.fit(matrix).kneighbors(matrix)
+    # Drop each file from its own results, or the farthest result when
+    # duplicate distributions push the file itself out of the first k + 1
+    others = indexes != np.arange(len(file_ids))[:, None]
+    others &= np.cumsum(others, axis=1) <= k
+    distances = distances[others].reshape(-1, k)
+    indexes = indexes[others].reshape(-1, k)
+    file1 = np.repeat(file_ids, k)
+    rank = np.tile(np.arange(1, k + 1), len(file_ids))
+    return (file1, rank, file_ids[indexes.ravel()], distances.ravel()**2)
 
 
 class HarmonicDistanceData(DatabaseInterface):
 
+    index_schema = []
+    duplicates = ""
+
     def __init__(self, dbpath=""):
         super().__init__(dbpath)
 
@@ -62,62 +404,347 @@ class HarmonicDistanceData(DatabaseInterface):
         self.c.execute("SELECT * FROM data ORDER BY distance DESC LIMIT ?;", (n,))
         return self.c.fetchall()
 
+  # Watermarks record the last chromadistribution ID included in the data
+    def watermark(self, catalog) -> int:
+        self.c.execute("SELECT chroma_id FROM watermark WHERE catalog = ?;", (catalog,))
+        result = self.c.fetchone()
+        return int(result[0]) if result else 0
+
+    def watermark_complete(self, catalog) -> bool:
+        """Returns whether every pair through the catalog's watermark is stored."""
+        self.c.execute("SELECT complete FROM watermark WHERE catalog = ?;", (catalog,))
+        result = self.c.fetchone()
+        return bool(result[0]) if result else False
+
+    def set_watermark(self, catalog, chroma_id: int, finalize=True, complete=None) -> bool:
+        """Sets a catalog's watermark, keeping its completeness unless <complete> is given."""
+        self.c.execute("INSERT INTO watermark (catalog, chroma_id) VALUES (?,?)"\
+                       " ON CONFLICT (catalog) DO UPDATE SET chroma_id = excluded.chroma_id;",
+                       (catalog, chroma_id))
+        if complete is not None:
+            self.c.execute("UPDATE watermark SET complete = ? WHERE catalog = ?;",
+                           (int(complete), catalog))
+        if finalize:
+            self.db.commit()
+        return True
+
+    def create_watermark_table(self) -> bool:
+        self.c.execute(WATERMARK_SCHEMA)
+        self.c.execute("PRAGMA table_info(watermark);")
+        if "complete" not in [_c[1] for _c in self.c.fetchall()]:
+            self.c.execute("ALTER TABLE watermark"\
+                           " ADD COLUMN complete integer NOT NULL DEFAULT 1;")
+        return True
+
+    def is_empty(self) -> bool:
+        self.c.execute("SELECT NOT EXISTS (SELECT 1 FROM data);")
+        return bool(self.c.fetchone()[0])
+
+    def create_indexes(self) -> bool:
+        """
+        Creates any missing indexes, first removing repeated pairs if the
+        unique index cannot otherwise be built.
+        """
+        for statement in self.index_schema:
+            try:
+                self.c.execute(statement)
+            except sqlite3.IntegrityError:
+                self.c.execute(self.duplicates)
+                self.c.execute(statement)
+        self.db.commit()
+        return True
+
+    def drop_indexes(self) -> bool:
+        self.c.execute("SELECT name FROM sqlite_master"\
+                       "  WHERE type = 'index' AND tbl_name = 'data' AND sql IS NOT NULL;")
+        for name in [_r[0] for _r in self.c.fetchall()]:
+            self.c.execute(f"DROP INDEX {name};")
+        self.db.commit()
+        return True
+
     
 class Intracatalog(HarmonicDistanceData):
 
+    index_schema = INTRACATALOG_INDEX_SCHEMA
+    duplicates = INTRACATALOG_DUPLICATES
+
     def __init__(self, sonicat_path, catalog):
         dbpath = self.make_dbpath(sonicat_path, self.make_dbname(catalog))
         super().__init__(dbpath)
         #for statement in INTRACATALOG_HARMONIC_DISTANCE_SCHEMA:
         #    self.c.execute(statement)
         self.c.execute(INTRACATALOG_HARMONIC_DISTANCE_SCHEMA)
+        self.c.execute("PRAGMA table_info(tile);")
+        if "chroma_id" not in [_c[1] for _c in self.c.fetchall()]:
+            # Checkpoints made before snapshots were versioned cannot be trusted
+            self.c.execute("DROP TABLE IF EXISTS tile;")
+        self.c.execute(INTRACATALOG_TILE_SCHEMA)
+        self.c.execute(INTRACATALOG_RUN_SCHEMA)
+        self.create_watermark_table()
+        self.c.execute("SELECT NOT EXISTS (SELECT 1 FROM run);")
+        if self.c.fetchone()[0]:
+            self.create_indexes()
 
     def make_dbname(self, catalog: str) -> str:
         return f"HarmonicDistance-{catalog}_Intracatalog.sqlite"
 
     def add_distance(self, file_id1, file_id2, distance) -> bool:
-        self.c.execute("INSERT INTO data (file1, file2, distance) VALUES (?,?,?);",
+        self.c.execute("INSERT OR IGNORE INTO data (file1, file2, distance) VALUES (?,?,?);",
                        (file_id1, file_id2, distance))
         self.db.commit()
         return True
+
+    def add_distances(self, rows: List[Tuple], finalize=True, replace=False) -> bool:
+        """
+        Inserts (file1, file2, distance) rows in a single transaction,
+        skipping pairs already stored, or updating their distances if
+        <replace>.
+        """
+        if replace:
+            self.c.executemany("INSERT INTO data (file1, file2, distance) VALUES (?,?,?)"\
+                               " ON CONFLICT (file1, file2)"\
+                               " DO UPDATE SET distance = excluded.distance;", rows)
+        else:
+            self.c.executemany("INSERT OR IGNORE INTO data (file1, file2, distance)"\
+                               " VALUES (?,?,?);", rows)
+        if finalize:
+            self.db.commit()
+        return True
+    
+    def add_tile_distances(self, chroma_id: int, tile: Tuple[int], rows: List[Tuple]) -> bool:
+        """
+        Inserts (file1, file2, distance) rows and checkpoints their tile of
+        the snapshot through <chroma_id> in a single transaction.
+        """
+        self.c.executemany("INSERT OR IGNORE INTO data (file1, file2, distance)"\
+                           " VALUES (?,?,?);", rows)
+        self.c.execute("INSERT INTO tile (chroma_id, row_start, col_start, size)"\
+                       " VALUES (?,?,?,?);", (chroma_id,) + tuple(tile))
+        self.db.commit()
+        return True
+
+    def completed_tiles(self, chroma_id: int, size: int) -> List[Tuple[int]]:
+        self.c.execute("SELECT row_start, col_start, size FROM tile"\
+                       "  WHERE chroma_id = ? AND size = ?;",
+                       (chroma_id, size))
+        return self.c.fetchall()
+
+    def clear_tiles(self, finalize=True) -> bool:
+        self.c.execute("DELETE FROM tile;")
+        if finalize:
+            self.db.commit()
+        return True
+
+  # A run row marks a full run as started and is removed once it completes
+    def pending_run(self, catalog) -> Tuple:
+        """Returns (method, chroma_id, start_id) of an unfinished full run, if any."""
+        self.c.execute("SELECT method, chroma_id, start_id FROM run WHERE catalog = ?;",
+                       (catalog,))
+        return self.c.fetchone()
+
+    def begin_run(self, catalog, method: str, chroma_id: int) -> Tuple:
+        """
+        Records a full run as started. Returns (method, chroma_id, start_id).
+        Indexes of an empty store are dropped until the run ends.
+        """
+        if self.is_empty():
+            self.drop_indexes()
+        self.c.execute("SELECT IFNULL(MAX(id), 0) FROM data;")
+        run = (method, chroma_id, self.c.fetchone()[0])
+        self.c.execute("INSERT OR REPLACE INTO run (catalog, method, chroma_id, start_id)"\
+                       " VALUES (?,?,?,?);", (catalog,) + run)
+        self.db.commit()
+        return run
+
+    def end_run(self, catalog) -> bool:
+        """
+        Advances the watermark to the run's chroma ID, noting whether the
+        run stored every pair, and removes the run.
+        """
+        run = self.pending_run(catalog)
+        self.set_watermark(catalog, run[1], finalize=False,
+                           complete=run[0] not in PARTIAL_RUN_METHODS)
+        self.c.execute("DELETE FROM run WHERE catalog = ?;", (catalog,))
+        self.db.commit()
+        return True
     
     def distance(self, file_id1, file_id2) -> Decimal:
-        self.c.execute("SELECT distance FROM data AND file1 = ? AND file2 = ?;",
+        file_id1, file_id2 = sorted([file_id1, file_id2])
+        self.c.execute("SELECT distance FROM data WHERE file1 = ? AND file2 = ?;",
                        (file_id1, file_id2))
         result = self.c.fetchone()[0]
         return Decimal(result)
     
     def all_data_by_file(self, file_id) -> List[Tuple[str]]:
-        self.c.execute("SELECT * FROM data WHERE file1 = ? OR file2 = ?"\
-                       "  ORDER BY distance ASC;",
-                       (file_id,))
+        self.c.execute("""
+        SELECT * FROM data WHERE file1 = ?
+        UNION ALL
+        SELECT * FROM data WHERE file2 = ?
+        ORDER BY distance ASC
+        ;""", (file_id, file_id))
+        return self.c.fetchall()
+
+    def neighbours(self, file_id, k: int) -> List[Tuple]:
+        """
+        Returns (file, distance) of the <k> files closest to <file_id>,
+        closest first, merging the top of each lookup index.
+        """
+        self.c.execute("""
+        SELECT * FROM (SELECT file2, distance FROM data WHERE file1 = ?
+                       ORDER BY distance ASC LIMIT ?)
+        UNION ALL
+        SELECT * FROM (SELECT file1, distance FROM data WHERE file2 = ?
+                       ORDER BY distance ASC LIMIT ?)
+        ORDER BY distance ASC LIMIT ?
+        ;""", (file_id, k, file_id, k, k))
         return self.c.fetchall()
 
+    def last_intracatalog_pair(self, after_id=0) -> Tuple[int]:
+        """Returns the last pair recorded, among rows past <after_id>."""
+        self.c.execute("SELECT file1, file2 FROM data WHERE id > ? ORDER BY id DESC LIMIT 1;",
+                       (after_id,))
+        result = self.c.fetchone()
+        return (int(result[0]), int(result[1])) if result else (0,0)
+
+
+class Transposed(HarmonicDistanceData):
+
+    def __init__(self, sonicat_path, catalog):
+        dbpath = self.make_dbpath(sonicat_path, self.make_dbname(catalog))
+        super().__init__(dbpath)
+        self.c.execute(INTRACATALOG_TRANSPOSED_SCHEMA)
+
+    def make_dbname(self, catalog: str) -> str:
+        return f"HarmonicDistance-{catalog}_Transposed.sqlite"
+
+    def add_distances(self, rows: List[Tuple]) -> bool:
+        """Inserts (file1, file2, distance, shift) rows in a single transaction."""
+        self.c.executemany("INSERT INTO data (file1, file2, distance, shift)"\
+                           " VALUES (?,?,?,?);", rows)
+        self.db.commit()
+        return True
+
     def last_intracatalog_pair(self) -> Tuple[int]:
         self.c.execute("SELECT file1, file2 FROM data ORDER BY id DESC LIMIT 1;")
         result = self.c.fetchone()
         return (int(result[0]), int(result[1])) if result else (0,0)
 
 
+class Neighbours(HarmonicDistanceData):
+
+    def __init__(self, sonicat_path, catalog):
+        dbpath = self.make_dbpath(sonicat_path, self.make_dbname(catalog))
+        super().__init__(dbpath)
+        self.c.execute(INTRACATALOG_NEIGHBOURS_SCHEMA)
+
+    def make_dbname(self, catalog: str) -> str:
+        return f"HarmonicDistance-{catalog}_Neighbours.sqlite"
+
+    def replace_neighbours(self, rows: List[Tuple]) -> bool:
+        """Replaces all (file1, rank, file2, distance) rows in a single transaction."""
+        self.c.execute("DELETE FROM data;")
+        self.c.executemany("INSERT INTO data (file1, rank, file2, distance)"\
+                           " VALUES (?,?,?,?);", rows)
+        self.db.commit()
+        return True
+
+    def neighbours(self, file_id) -> List[Tuple[str]]:
+        self.c.execute("SELECT file2, distance FROM data"\
+                       "  WHERE file1 = ? ORDER BY rank ASC;",
+                       (file_id,))
+        return self.c.fetchall()
+
+
+class Clusters(HarmonicDistanceData):
+
+    def __init__(self, sonicat_path, catalog):
+        dbpath = self.make_dbpath(sonicat_path, self.make_dbname(catalog))
+        super().__init__(dbpath)
+        for statement in CLUSTER_SCHEMA:
+            self.c.execute(statement)
+
+    def make_dbname(self, catalog: str) -> str:
+        return f"HarmonicDistance-{catalog}_Clusters.sqlite"
+
+    def replace_clusters(self, assignments: List[Tuple], centroids: List[Tuple]) -> bool:
+        """
+        Replaces all (file, cluster, distance) assignments and
+        (id, size, c01, ..., c12) centroids in a single transaction.
+        """
+        self.c.execute("DELETE FROM data;")
+        self.c.execute("DELETE FROM centroid;")
+        self.c.executemany("INSERT INTO data (file, cluster, distance) VALUES (?,?,?);",
+                           assignments)
+        self.c.executemany("INSERT INTO centroid VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?);",
+                           centroids)
+        self.db.commit()
+        return True
+
+    def cluster(self, file_id) -> int:
+        self.c.execute("SELECT cluster FROM data WHERE file = ?;", (file_id,))
+        result = self.c.fetchone()
+        return result[0] if result else -1
+
+    def cluster_files(self, cluster_id) -> List[int]:
+        """Returns a cluster's file IDs, most typical first."""
+        self.c.execute("SELECT file FROM data WHERE cluster = ? ORDER BY distance ASC;",
+                       (cluster_id,))
+        return [_i[0] for _i in self.c.fetchall()]
+
+    def all_assignments(self) -> List[Tuple[int]]:
+        self.c.execute("SELECT file, cluster FROM data ORDER BY file ASC;")
+        return self.c.fetchall()
+
+    def centroids(self) -> List[Tuple]:
+        self.c.execute("SELECT * FROM centroid ORDER BY id ASC;")
+        return self.c.fetchall()
+
+
 class Intercatalog(HarmonicDistanceData):
 
+    index_schema = INTERCATALOG_INDEX_SCHEMA
+    duplicates = INTERCATALOG_DUPLICATES
+
     def __init__(self, sonicat_path, catalog1, catalog2):
         dbpath = self.make_dbpath(sonicat_path, self.make_dbname(catalog1, catalog2))
         super().__init__(dbpath)
         #for statement in INTERCATALOG_HARMONIC_DISTANCE_SCHEMA:
         #    self.c.execute(statement)
         self.c.execute(INTERCATALOG_HARMONIC_DISTANCE_SCHEMA)
+        self.create_watermark_table()
+        self.create_indexes()
 
     def make_dbname(self, catalog1: str, catalog2) -> str:
         return f"HarmonicDistance-{catalog1}_{catalog2}_Intercatalog.sqlite"
     
     def add_distance(self, catalog1, file_id1, catalog2, file_id2, distance) -> bool:
-        self.c.execute("INSERT INTO data (catalog1, file1, catalog2, file2, distance) VALUES (?,?,?,?,?);",
+        self.c.execute("INSERT OR IGNORE INTO data (catalog1, file1, catalog2, file2, distance) VALUES (?,?,?,?,?);",
                        (catalog1, file_id1, catalog2, file_id2, distance))
         self.db.commit()
         return True
+
+    def add_distances(self, rows: List[Tuple], finalize=True, replace=False) -> bool:
+        """
+        Inserts (catalog1, file1, catalog2, file2, distance) rows in a single
+        transaction, skipping pairs already stored, or updating their
+        distances if <replace>.
+        """
+        if replace:
+            self.c.executemany("INSERT INTO data (catalog1, file1, catalog2, file2, distance)"\
+                               " VALUES (?,?,?,?,?)"\
+                               " ON CONFLICT (catalog1, file1, catalog2, file2)"\
+                               " DO UPDATE SET distance = excluded.distance;", rows)
+        else:
+            self.c.executemany("INSERT OR IGNORE INTO data"\
+                               " (catalog1, file1, catalog2, file2, distance)"\
+                               " VALUES (?,?,?,?,?);", rows)
+        if finalize:
+            self.db.commit()
+        return True
     
     def distance(self, catalog1, file_id1, catalog2, file_id2) -> Decimal:
+        (catalog1, file_id1), (catalog2, file_id2) = sorted([(catalog1, file_id1),
+                                                             (catalog2, file_id2)])
         self.c.execute("SELECT distance FROM data"\
                        " WHERE catalog1 = ? AND file1 = ?"\
                        " AND catalog2 = ? AND file2 = ?",
@@ -126,11 +753,29 @@ class Intercatalog(HarmonicDistanceData):
         return Decimal(result)
     
     def all_data_by_file(self, catalog, file_id) -> List[Tuple[str]]:
-        self.c.execute("SELECT * FROM data"\
-                       "  WHERE (catalog1 = ? AND file1 = ?)"\
-                       "  OR (catalog2 = ? AND file2 = ?)"\
-                       "ORDER BY distance ASC;",
-                       (catalog, file_id))
+        self.c.execute("""
+        SELECT * FROM data WHERE catalog1 = ? AND file1 = ?
+        UNION ALL
+        SELECT * FROM data WHERE catalog2 = ? AND file2 = ?
+        ORDER BY distance ASC
+        ;""", (catalog, file_id, catalog, file_id))
+        return self.c.fetchall()
+
+    def neighbours(self, catalog, file_id, k: int) -> List[Tuple]:
+        """
+        Returns (catalog, file, distance) of the <k> files of the other
+        catalog closest to <file_id>, closest first.
+        """
+        self.c.execute("""
+        SELECT * FROM (SELECT catalog2, file2, distance FROM data
+                       WHERE catalog1 = ? AND file1 = ?
+                       ORDER BY distance ASC LIMIT ?)
+        UNION ALL
+        SELECT * FROM (SELECT catalog1, file1, distance FROM data
+                       WHERE catalog2 = ? AND file2 = ?
+                       ORDER BY distance ASC LIMIT ?)
+        ORDER BY distance ASC LIMIT ?
+        ;""", (catalog, file_id, k, catalog, file_id, k, k))
         return self.c.fetchall()
 
 
@@ -140,9 +785,14 @@ class HarmonicDistance(SimpleApp):
     # catalog will break things.
 
     def __init__(self, sonicat_path: str) -> None:
-        super().__init__(sonicat_path, "analysis", "HarmonicDistance")
-        librosa_analysis_replica_path = f"{self.cfg['sonicat_path']}/data/analysis/LibrosaAnalysis-ReadReplica.sqlite"
-        self.rosa_data = DataInterface(librosa_analysis_replica_path)
+        config = AppConfig(sonicat_path, "harmonic_distance")
+        super().__init__(config)
+        librosa_analysis_replica_path = f"{self.cfg.sonicat_path}/data/analysis/LibrosaAnalysis-ReadReplica.sqlite"
+        self.rosa_data = DataInterface(librosa_analysis_replica_path, readonly=True)
+        self.lsh_indexes = {}
+        self.chroma_cache = {}
+        self.pair_results_dbs = {}
+        self.cluster_cache = {}
         self.log.info(f"Application Initialization Successful")
 
     def harmonic_distance(self, chroma_dist1, chroma_dist2) -> Decimal:
@@ -161,7 +811,8 @@ class HarmonicDistance(SimpleApp):
     def intracatalog_linear_run(self, catalog):
         timestamp = time()
         self.log.info(f"Initializing data for linear intracatalog run: {catalog}")
-        results = Intracatalog(self.cfg["sonicat_path"], catalog)
+        results = Intracatalog(self.cfg.sonicat_path, catalog)
+        chroma_id = self.rosa_data.max_chroma_id(catalog)
         cdists = self.rosa_data.all_chroma_distributions(catalog)
         all_ids = list(cdists.keys())
         all_ids.sort()
@@ -190,40 +841,548 @@ class HarmonicDistance(SimpleApp):
                     continue
                 results.add_distance(_id, _id2, distance)
                 print(f"Harmonic distance recorded for intracatalog pair {_id}, {_id2}")
+        results.set_watermark(catalog, chroma_id, complete=True)
         self.log.info(f"All distances calculated. Run terminated successfully.")
 
-    def intercatalog_all_pairs_run(self, catalog_asset_pairs: List[Tuple[str]]) -> bool:
-        cdists = {p: {} for p in set([p[0] for p in catalog_asset_pairs])}
-        for p in catalog_asset_pairs:
-            cdists[p[0]][p[1]] = self.rosa_data.chroma_distribution(p[0], p[1])
-        for p1 in catalog_asset_pairs:
-            for p2 in catalog_asset_pairs:
-                if p1 >= p2:
+    def resolve_full_run(self, results: Intracatalog, catalog, method: str,
+                               block_size=BLOCK_SIZE
+                               ) -> Tuple:
+        """
+        Decides whether a full <method> run of a catalog goes ahead. Returns
+        (pending run to resume or None, None) if it does; otherwise
+        (None, outcome), where the outcome is False while another method's
+        run is unfinished, or that of a delta run once a run has completed.
+        A run pairing every file goes ahead after one that left pairs out.
+        """
+        run = results.pending_run(catalog)
+        if run and run[0] != method:
+            self.log.error(f"An unfinished {run[0]} run is pending for {catalog}.")
+            return (None, False)
+        if not run and results.watermark(catalog):
+            if results.watermark_complete(catalog) or method in PARTIAL_RUN_METHODS:
+                self.log.info("Previous run complete. Recording newly analyzed files.")
+                return (None, self.intracatalog_delta_run(catalog, block_size))
+            self.log.info("Previous run left pairs out. Recording every pair.")
+        return (run, None)
+
+    def intracatalog_blocked_run(self, catalog, block_size=BLOCK_SIZE) -> bool:
+        """
+        Records every pair of files block by block. An interrupted run
+        resumes after its last recorded pair, on the chroma matrix it started
+        with; once a run has completed, files analyzed since are added by a
+        delta run instead.
+        """
+        self.log.info(f"Initializing data for blocked intracatalog run: {catalog}")
+        results = Intracatalog(self.cfg.sonicat_path, catalog)
+        run, outcome = self.resolve_full_run(results, catalog, "blocked", block_size)
+        if outcome is not None:
+            return outcome
+        chroma_id, file_ids, matrix = self.rosa_data.versioned_chroma_matrix(catalog,
+                                                                             run[1] if run else 0)
+        if not run:
+            run = results.begin_run(catalog, "blocked", chroma_id)
+        last_completed = results.last_intracatalog_pair(after_id=run[2])
+        if last_completed[0] == last_completed[1] == 0:
+            self.log.info("No previously calculated pairs found. Beginning new run.")
+        else:
+            self.log.info(f"Continuing interrupted run from pair {last_completed}.")
+        blocks = blocked_intracatalog_distances(file_ids, matrix,
+                                                last_pair=last_completed,
+                                                block_size=block_size)
+        try:
+            for file1, file2, distances in blocks:
+                if not len(file1):
                     continue
-                cd1 = cdists[p1[0]][p1[1]]
-                cd2 = cdists[p2[0]][p2[1]]
-                distance = self.harmonic_distance(cd1, cd2)
-        pass
+                results.add_distances(zip(file1.tolist(),
+                                          file2.tolist(),
+                                          distances.tolist()))
+                self.log.info(f"Harmonic distances recorded for file IDs {file1[0]} - {file1[-1]} as file1")
+        finally:
+            results.create_indexes()
+        results.end_run(catalog)
+        self.log.info(f"All distances calculated through chroma ID {chroma_id}.")
+        return self.intracatalog_delta_run(catalog, block_size)
+
+    def intracatalog_delta_run(self, catalog, block_size=BLOCK_SIZE) -> bool:
+        """
+        Records distances between files analyzed since the catalog's
+        watermark and every other file, then advances the watermark in the
+        same transaction. Files analyzed again count as new, and their
+        stored distances are replaced. A store holding distances but no
+        watermark gets a full blocked run instead, as its coverage is unknown.
+        """
+        results = Intracatalog(self.cfg.sonicat_path, catalog)
+        run = results.pending_run(catalog)
+        if run:
+            self.log.error(f"An unfinished {run[0]} run is pending for {catalog}.")
+            return False
+        since = results.watermark(catalog)
+        if not since and not results.is_empty():
+            self.log.warning(f"No watermark for {catalog}. Recording every pair instead.")
+            return self.intracatalog_blocked_run(catalog, block_size)
+        until, file_ids, matrix = self.rosa_data.versioned_chroma_matrix(catalog)
+        new_ids = self.rosa_data.chroma_file_ids_between(catalog, since, until)
+        self.log.info(f"{len(new_ids)} files analyzed in {catalog} since chroma ID {since}.")
+        if not new_ids:
+            return True
+        for file1, file2, distances in delta_intracatalog_distances(file_ids, matrix,
+                                                                    new_ids, block_size):
+            # Files analyzed again replace the distances of their old analysis
+            results.add_distances(zip(file1.tolist(),
+                                      file2.tolist(),
+                                      distances.tolist()),
+                                  finalize=False, replace=True)
+        results.set_watermark(catalog, until)
+        results.create_indexes()
+        self.log.info(f"Delta run for {catalog} complete through chroma ID {until}.")
+        return True
+
+    def intercatalog_delta_run(self, catalog1, catalog2, block_size=BLOCK_SIZE) -> bool:
+        """
+        Records distances across two catalogs in which either file was
+        analyzed since its catalog's watermark. A store holding distances
+        without both watermarks is recomputed in full. Stored distances of
+        the pairs are replaced, as files analyzed again count as new.
+        """
+        catalog1, catalog2 = sorted([catalog1, catalog2])
+        results = Intercatalog(self.cfg.sonicat_path, catalog1, catalog2)
+        watermarks = {_c: results.watermark(_c) for _c in [catalog1, catalog2]}
+        if not all(watermarks.values()) and not results.is_empty():
+            self.log.warning(f"No watermarks for {catalog1} x {catalog2}."\
+                             " Recording every pair instead.")
+            watermarks = {_c: 0 for _c in watermarks.keys()}
+        bounds, new_ids, chroma = {}, {}, {}
+        for catalog in [catalog1, catalog2]:
+            until, file_ids, matrix = self.rosa_data.versioned_chroma_matrix(catalog)
+            bounds[catalog] = (watermarks[catalog], until)
+            new_ids[catalog] = self.rosa_data.chroma_file_ids_between(catalog, *bounds[catalog])
+            chroma[catalog] = (file_ids, matrix)
+        self.log.info(f"{len(new_ids[catalog1])} new {catalog1} files and"\
+                      f" {len(new_ids[catalog2])} new {catalog2} files to pair.")
+        blocks = delta_intercatalog_distances(*chroma[catalog1], new_ids[catalog1],
+                                              *chroma[catalog2], new_ids[catalog2],
+                                              block_size)
+        for file1, file2, distances in blocks:
+            results.add_distances(zip([catalog1] * len(file1), file1.tolist(),
+                                      [catalog2] * len(file2), file2.tolist(),
+                                      distances.tolist()),
+                                  finalize=False, replace=True)
+        results.set_watermark(catalog1, bounds[catalog1][1], finalize=False)
+        results.set_watermark(catalog2, bounds[catalog2][1])
+        results.create_indexes()
+        self.log.info(f"Delta run for {catalog1} x {catalog2} complete.")
+        return True
+
+    def delta_run(self, catalogs: List[str]) -> bool:
+        """Appends distances for newly analyzed files of <catalogs> to every store."""
+        catalogs = sorted(catalogs)
+        for _i, catalog in enumerate(catalogs):
+            self.intracatalog_delta_run(catalog)
+            for other in catalogs[_i + 1:]:
+                self.intercatalog_delta_run(catalog, other)
+        return True
+
+    def intracatalog_transposed_run(self, catalog, block_size=TRANSPOSED_BLOCK_SIZE):
+        self.log.info(f"Initializing data for transposed intracatalog run: {catalog}")
+        results = Transposed(self.cfg.sonicat_path, catalog)
+        file_ids, matrix = self.rosa_data.chroma_matrix(catalog)
+        last_completed = results.last_intracatalog_pair()
+        if last_completed[0] == last_completed[1] == 0:
+            self.log.info("No previously calculated pairs found. Beginning new run.")
+        else:
+            self.log.info(f"Continuing interrupted run from pair {last_completed}.")
+        blocks = blocked_intracatalog_distances(file_ids, matrix,
+                                                last_pair=last_completed,
+                                                block_size=block_size,
+                                                scorer=transposed_distances)
+        for file1, file2, distances, shifts in blocks:
+            if not len(file1):
+                continue
+            results.add_distances(zip(file1.tolist(),
+                                      file2.tolist(),
+                                      distances.tolist(),
+                                      shifts.tolist()))
+            self.log.info(f"Transposed distances recorded for file IDs {file1[0]} - {file1[-1]} as file1")
+        self.log.info(f"All distances calculated. Run terminated successfully.")
+
+    def chroma_snapshot_paths(self, catalog, chroma_id: int) -> Tuple[str]:
+        base = f"{self.cfg.sonicat_path}/data/analysis/HarmonicDistance-{catalog}"
+        return (f"{base}_ChromaIds-{chroma_id}.npy", f"{base}_Chroma-{chroma_id}.npy")
+
+    def chroma_snapshot(self, catalog, chroma_id=0) -> Tuple:
+        """
+        Returns (file_ids, matrix_path, chroma_id) for the catalog's chroma
+        matrix through chromadistribution <chroma_id>, or through the latest
+        if 0, saved to disk for memory-mapped reads. Snapshots are named by
+        chroma ID, so a resumed run reuses its own and never a stale one.
+        """
+        if chroma_id:
+            ids_path, matrix_path = self.chroma_snapshot_paths(catalog, chroma_id)
+        if not chroma_id or not all([shutil.os.path.isfile(ids_path),
+                                     shutil.os.path.isfile(matrix_path)]):
+            chroma_id, file_ids, matrix = self.rosa_data.versioned_chroma_matrix(catalog,
+                                                                                 chroma_id)
+            ids_path, matrix_path = self.chroma_snapshot_paths(catalog, chroma_id)
+            np.save(f"{matrix_path}.tmp.npy", matrix)
+            shutil.os.replace(f"{matrix_path}.tmp.npy", matrix_path)
+            np.save(f"{ids_path}.tmp.npy", file_ids)
+            shutil.os.replace(f"{ids_path}.tmp.npy", ids_path)
+        return (np.load(ids_path), matrix_path, chroma_id)
+
+    def remove_chroma_snapshot(self, catalog, chroma_id: int) -> bool:
+        for path in self.chroma_snapshot_paths(catalog, chroma_id):
+            if shutil.os.path.isfile(path):
+                shutil.os.remove(path)
+        return True
+
+    def intracatalog_tiled_run(self, catalog, tile_size=TILE_SIZE, workers=None):
+        """
+        Records every pair of files using a process pool over tiles of the
+        distance matrix, checkpointing each tile. An interrupted run resumes
+        on the snapshot it started with; once a run has completed, files
+        analyzed since are added by a delta run instead.
+        """
+        # Tiles complete out of order, so last_intracatalog_pair is not
+        # meaningful for a database written by this run.
+        self.log.info(f"Initializing data for tiled intracatalog run: {catalog}")
+        results = Intracatalog(self.cfg.sonicat_path, catalog)
+        run, outcome = self.resolve_full_run(results, catalog, "tiled")
+        if outcome is not None:
+            return outcome
+        file_ids, matrix_path, chroma_id = self.chroma_snapshot(catalog, run[1] if run else 0)
+        if not run:
+            results.begin_run(catalog, "tiled", chroma_id)
+        completed = set(results.completed_tiles(chroma_id, tile_size))
+        tiles = [_t for _t in upper_triangle_tiles(len(file_ids), tile_size)
+                 if _t not in completed]
+        self.log.info(f"{len(tiles)} tiles to calculate, {len(completed)} previously completed.")
+        workers = workers if workers else shutil.os.cpu_count()
+        try:
+            with ProcessPoolExecutor(max_workers=workers,
+                                     initializer=load_tile_matrix,
+                                     initargs=(matrix_path,)
+                                     ) as pool:
+                pending = set()
+                while tiles or pending:
+                    while tiles and len(pending) < 2 * workers:
+                        pending.add(pool.submit(tile_distances, tiles.pop()))
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        tile, rows, cols, distances = future.result()
+                        results.add_tile_distances(chroma_id, tile,
+                                                   zip(file_ids[rows].tolist(),
+                                                       file_ids[cols].tolist(),
+                                                       distances.tolist()))
+                        self.log.info(f"Harmonic distances recorded for tile {tile}")
+        finally:
+            results.create_indexes()
+        results.clear_tiles(finalize=False)
+        results.end_run(catalog)
+        self.remove_chroma_snapshot(catalog, chroma_id)
+        self.log.info(f"All distances calculated through chroma ID {chroma_id}.")
+        return self.intracatalog_delta_run(catalog)
+
+    def nearest_neighbours_run(self, catalog, k=NEIGHBOURS):
+        self.log.info(f"Building nearest neighbour index for catalog: {catalog}")
+        results = Neighbours(self.cfg.sonicat_path, catalog)
+        file_ids, matrix = self.rosa_data.chroma_matrix(catalog)
+        file1, rank, file2, distances = nearest_neighbours(file_ids, matrix, k)
+        results.replace_neighbours(zip(file1.tolist(),
+                                       rank.tolist(),
+                                       file2.tolist(),
+                                       distances.tolist()))
+        self.log.info(f"{k} nearest neighbours recorded for {len(file_ids)} files.")
+
+    def cluster_run(self, catalog, n_clusters=CLUSTERS) -> bool:
+        """Assigns every file of a catalog to a harmonic family."""
+        self.log.info(f"Clustering chroma distributions for catalog: {catalog}")
+        file_ids, matrix = self.rosa_data.chroma_matrix(catalog)
+        if not len(file_ids):
+            self.log.info(f"No chroma distributions to cluster in {catalog}.")
+            return True
+        n_clusters = min(n_clusters, len(file_ids))
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=4096,
+                                 n_init=3, random_state=0).fit(matrix)
+        labels = kmeans.predict(matrix)
+        centroids = kmeans.cluster_centers_
+        distances = ((matrix - centroids[labels])**2).sum(axis=1)
+        sizes = np.bincount(labels, minlength=n_clusters)
+        Clusters(self.cfg.sonicat_path, catalog).replace_clusters(
+            zip(file_ids.tolist(), labels.tolist(), distances.tolist()),
+            [(_i, int(sizes[_i])) + tuple(centroids[_i].tolist())
+             for _i in range(n_clusters)])
+        self.cluster_cache.pop(catalog, None)
+        self.log.info(f"{len(file_ids)} files assigned to {n_clusters} clusters.")
+        return True
+
+    def catalog_clusters(self, catalog) -> Tuple[np.ndarray]:
+        """
+        Returns the cached (labels, centroids) of a catalog, with labels
+        aligned to the rows of its chroma matrix. Files left out of the last
+        cluster_run, such as those analyzed since, are labelled with the
+        cluster of the nearest centroid.
+        """
+        if catalog not in self.cluster_cache.keys():
+            file_ids, matrix, _ = self.catalog_chroma(catalog)
+            clusters = Clusters(self.cfg.sonicat_path, catalog)
+            assignments = np.array(clusters.all_assignments(), dtype=np.int64).reshape(-1, 2)
+            centroids = np.array([_c[2:] for _c in clusters.centroids()],
+                                 dtype=np.float32).reshape(-1, 12)
+            labels = np.full(len(file_ids), -1, dtype=np.int64)
+            rows = np.searchsorted(file_ids, assignments[:, 0])
+            found = rows < len(file_ids)
+            found[found] = file_ids[rows[found]] == assignments[found, 0]
+            labels[rows[found]] = assignments[found, 1]
+            unclustered = np.flatnonzero(labels < 0)
+            if len(unclustered) and not len(centroids):
+                raise ValueError(f"{catalog} has not been clustered")
+            if len(unclustered):
+                labels[unclustered] = cdist(matrix[unclustered], centroids,
+                                            "sqeuclidean").argmin(axis=1)
+            self.cluster_cache[catalog] = (labels, centroids)
+        return self.cluster_cache[catalog]
+
+    def clustered_closest(self, catalog, file_id,
+                                k=NEIGHBOURS,
+                                n_neighbouring=NEIGHBOURING_CLUSTERS
+                                ) -> List[Tuple]:
+        """
+        Returns up to <k> (file_id, distance) files closest to <file_id>
+        among its own and the <n_neighbouring> neighbouring clusters.
+        """
+        vector = self.chroma_vector(catalog, file_id)
+        file_ids, matrix, squared_norms = self.catalog_chroma(catalog)
+        labels, centroids = self.catalog_clusters(catalog)
+        cluster = labels[np.searchsorted(file_ids, file_id)]
+        searched = [cluster] + neighbouring_clusters(centroids, n_neighbouring)[cluster].tolist()
+        candidates = np.flatnonzero(np.isin(labels, searched))
+        rows, distances = closest(vector, matrix[candidates], squared_norms[candidates], k + 1)
+        return [(_f, _d) for _f, _d in zip(file_ids[candidates[rows]].tolist(),
+                                           distances.tolist())
+                if _f != file_id][:k]
+
+    def intracatalog_clustered_run(self, catalog,
+                                         n_neighbouring=NEIGHBOURING_CLUSTERS,
+                                         block_size=BLOCK_SIZE
+                                         ) -> bool:
+        """
+        Records distances only between files in the same or neighbouring
+        clusters, <block_size> files of a cluster at a time. An interrupted
+        run starts over, skipping stored pairs; once a run has completed,
+        files analyzed since are added by a delta run, which pairs them with
+        every file.
+        """
+        self.log.info(f"Initializing data for clustered intracatalog run: {catalog}")
+        results = Intracatalog(self.cfg.sonicat_path, catalog)
+        run, outcome = self.resolve_full_run(results, catalog, "clustered")
+        if outcome is not None:
+            return outcome
+        file_ids, matrix, _ = self.catalog_chroma(catalog)
+        labels, centroids = self.catalog_clusters(catalog)
+        if not run:
+            results.begin_run(catalog, "clustered", self.chroma_version(catalog))
+        sources = clustered_pair_sources(neighbouring_clusters(centroids, n_neighbouring))
+        try:
+            for cluster, others in enumerate(sources):
+                cols = np.flatnonzero(np.isin(labels, [cluster] + others))
+                col_ids, same = file_ids[cols], labels[cols] == cluster
+                cluster_rows = np.flatnonzero(labels == cluster)
+                for lower in range(0, len(cluster_rows), block_size):
+                    rows = cluster_rows[lower:lower + block_size]
+                    row_ids = file_ids[rows]
+                    distances = cdist(matrix[rows], matrix[cols], "sqeuclidean")
+                    # Within the cluster each pair appears twice; keep file1 < file2
+                    keep = ~same[None, :] | (col_ids[None, :] > row_ids[:, None])
+                    rows, cols_kept = np.nonzero(keep)
+                    file1, file2 = row_ids[rows], col_ids[cols_kept]
+                    results.add_distances(zip(np.minimum(file1, file2).tolist(),
+                                              np.maximum(file1, file2).tolist(),
+                                              distances[rows, cols_kept].tolist()))
+                self.log.info(f"Harmonic distances recorded for cluster {cluster}")
+        finally:
+            results.create_indexes()
+        results.end_run(catalog)
+        self.log.info(f"All distances calculated. Run terminated successfully.")
+        return self.intracatalog_delta_run(catalog)
+
+    def lsh_index_path(self, catalog) -> str:
+        return f"{self.cfg.sonicat_path}/data/analysis/HarmonicDistance-{catalog}_Lsh.npz"
+
+    def lsh_index_run(self, catalog, n_tables=8, n_bits=16, probes=1) -> bool:
+        """Builds and persists an approximate nearest neighbour index."""
+        self.log.info(f"Building LSH index for catalog: {catalog}")
+        file_ids, matrix = self.rosa_data.chroma_matrix(catalog)
+        index = LshIndex(n_tables, n_bits, probes).fit(file_ids, matrix)
+        index.save(self.lsh_index_path(catalog))
+        self.lsh_indexes[catalog] = index
+        self.log.info(f"LSH index of {len(file_ids)} files saved.")
+        return True
+
+    def approximate_neighbours(self, catalog, file_id, k=NEIGHBOURS) -> List[Tuple]:
+        """
+        Returns up to <k> (file_id, distance) approximate nearest neighbours
+        of a file from the catalog's persisted LSH index, closest first.
+        """
+        if catalog not in self.lsh_indexes.keys():
+            self.lsh_indexes[catalog] = LshIndex.load(self.lsh_index_path(catalog))
+        index = self.lsh_indexes[catalog]
+        file_ids, distances = index.query(index.vector(file_id), k + 1)
+        return [(_f, _d) for _f, _d in zip(file_ids.tolist(), distances.tolist())
+                if _f != file_id][:k]
+
+    def catalog_chroma(self, catalog) -> Tuple[np.ndarray]:
+        """
+        Returns the cached (file_ids, matrix, squared_norms) chroma data of a
+        catalog, loading it on first use and again once any chroma
+        distribution has changed, along with the catalog's clusters.
+        """
+        cached = self.chroma_cache.get(catalog)
+        if cached and self.rosa_data.chroma_changed_since(cached[4]):
+            cached = None
+            self.cluster_cache.pop(catalog, None)
+        if not cached:
+            generation = self.rosa_data.generation()
+            chroma_id, file_ids, matrix = self.rosa_data.versioned_chroma_matrix(catalog)
+            cached = (file_ids, matrix, (matrix**2).sum(axis=1), chroma_id, generation)
+            self.chroma_cache[catalog] = cached
+        return cached[:3]
+
+    def chroma_version(self, catalog) -> int:
+        """Returns the last chromadistribution ID in a catalog's cached chroma data."""
+        if catalog not in self.chroma_cache.keys():
+            self.catalog_chroma(catalog)
+        return self.chroma_cache[catalog][3]
+
+    def chroma_rows(self, catalog, file_ids: List[int]) -> Tuple[np.ndarray]:
+        """
+        Returns (file_ids, vectors) for those of <file_ids> having a chroma
+        distribution in <catalog>, sorted by file ID.
+        """
+        all_ids, matrix, _ = self.catalog_chroma(catalog)
+        file_ids = np.unique(np.asarray(file_ids, dtype=np.int64))
+        rows = np.minimum(np.searchsorted(all_ids, file_ids), max(len(all_ids) - 1, 0))
+        found = all_ids[rows] == file_ids if len(all_ids) else np.zeros(len(file_ids), bool)
+        return (file_ids[found], matrix[rows[found]])
+
+    def chroma_vector(self, catalog, file_id) -> np.ndarray:
+        file_ids, vectors = self.chroma_rows(catalog, [file_id])
+        if not len(file_ids):
+            raise KeyError(file_id)
+        return vectors[0]
+
+    def reorder_id_pairs(self, catalog1, id1, catalog2, id2) -> Tuple:
+        if catalog1 == catalog2:
+            ids = [id1, id2]
+            ids.sort()
+            if not ids[0] == id1:
+                return (catalog1, id2, catalog2, id1)
+        catalogs = [catalog1, catalog2]
+        catalogs.sort()
+        if not catalogs[0] == catalog1:
+            return (catalog2, id2, catalog1, id1)
+        return (catalog1, id1, catalog2, id2)
+
+    def pair_results(self, catalog1, catalog2) -> HarmonicDistanceData:
+        """
+        Returns the cached results database for distances between two
+        catalogs, which is the Intracatalog database if they are the same.
+        """
+        catalogs = tuple(sorted([catalog1, catalog2]))
+        if catalogs not in self.pair_results_dbs.keys():
+            if catalogs[0] == catalogs[1]:
+                db = Intracatalog(self.cfg.sonicat_path, catalogs[0])
+            else:
+                db = Intercatalog(self.cfg.sonicat_path, *catalogs)
+            self.pair_results_dbs[catalogs] = db
+        return self.pair_results_dbs[catalogs]
+
+    def record_one_to_many(self, catalog1, file_id, catalog2,
+                                 file_ids: List[int],
+                                 distances: List[float]
+                                 ) -> bool:
+        rows = [self.reorder_id_pairs(catalog1, file_id, catalog2, _f) + (_d,)
+                for _f, _d in zip(file_ids, distances)]
+        if catalog1 == catalog2:
+            rows = [(_r[1], _r[3], _r[4]) for _r in rows]
+        return self.pair_results(catalog1, catalog2).add_distances(rows)
+
+    def intercatalog_closest(self, catalog1, file_id, catalog2,
+                                   k=NEIGHBOURS,
+                                   record=False
+                                   ) -> List[Tuple]:
+        """
+        Returns up to <k> (file_id, distance) files of <catalog2> harmonically
+        closest to <file_id> of <catalog1>, closest first.
+        """
+        vector = self.chroma_vector(catalog1, file_id)
+        file_ids, matrix, squared_norms = self.catalog_chroma(catalog2)
+        rows, distances = closest(vector, matrix, squared_norms, k + 1)
+        results = [(_f, _d) for _f, _d in zip(file_ids[rows].tolist(), distances.tolist())
+                   if not (catalog1 == catalog2 and _f == file_id)][:k]
+        if record and results:
+            self.record_one_to_many(catalog1, file_id, catalog2, *zip(*results))
+        return results
+
+    def transposed_closest(self, catalog1, file_id, catalog2, k=NEIGHBOURS) -> List[Tuple]:
+        """
+        Returns up to <k> (file_id, distance, shift) files of <catalog2>
+        closest to <file_id> of <catalog1> after shifting them <shift>
+        semitones, closest first.
+        """
+        file_ids, matrix, _ = self.catalog_chroma(catalog2)
+        distances, shifts = transposed_distances(self.chroma_vector(catalog1, file_id)[None, :],
+                                                 matrix)
+        distances, shifts = distances[0], shifts[0]
+        if len(distances) > k + 1:
+            rows = np.argpartition(distances, k + 1)[:k + 1]
+        else:
+            rows = np.arange(len(distances))
+        rows = rows[np.argsort(distances[rows], kind="stable")]
+        return [(_f, _d, _s) for _f, _d, _s in zip(file_ids[rows].tolist(),
+                                                  distances[rows].tolist(),
+                                                  shifts[rows].tolist())
+                if not (catalog1 == catalog2 and _f == file_id)][:k]
+
+    def intercatalog_all_pairs_run(self, catalog_asset_pairs: List[Tuple[str]]) -> bool:
+        by_catalog = {}
+        for _catalog, _id in catalog_asset_pairs:
+            by_catalog.setdefault(_catalog, []).append(_id)
+        catalogs = sorted(by_catalog.keys())
+        for _i, catalog1 in enumerate(catalogs):
+            ids1, vectors1 = self.chroma_rows(catalog1, by_catalog[catalog1])
+            for catalog2 in catalogs[_i:]:
+                ids2, vectors2 = self.chroma_rows(catalog2, by_catalog[catalog2])
+                distances = cdist(vectors1, vectors2, "sqeuclidean")
+                if catalog1 == catalog2:
+                    rows, cols = np.nonzero(ids2[None, :] > ids1[:, None])
+                    results = zip(ids1[rows].tolist(),
+                                  ids2[cols].tolist(),
+                                  distances[rows, cols].tolist())
+                else:
+                    rows, cols = np.indices(distances.shape).reshape(2, -1)
+                    results = zip([catalog1] * len(rows), ids1[rows].tolist(),
+                                  [catalog2] * len(rows), ids2[cols].tolist(),
+                                  distances[rows, cols].tolist())
+                self.pair_results(catalog1, catalog2).add_distances(results)
+                self.log.info(f"Harmonic distances recorded for {catalog1} x {catalog2}")
+        return True
 
     def intercatalog_one_to_many_run(self, catalog_asset_pair: Tuple[str],
                                            catalog_asset_pairs: List[Tuple[str]]
                                            ) -> bool:
-        pass
-
-
-    ### This might be needed later, but not for linear intracatalog processing 
-    #def reorder_id_pairs(self, catalog1, id1, catalog2, id2):
-    #        if catalog1 == catalog2:
-    #            ids = [id1, id2]
-    #            ids.sort()
-    #            if not ids[0] == id1:
-    #                return (catalog1, id2, catalog2, id1)
-    #        catalogs = [catalog1, catalog2]
-    #        catalogs.sort()
-    #        if not catalogs[0] == catalog1:
-    #            return (catalog2, id2, catalog1, id1)
-    #        return (catalog1, id1, catalog2, id2)
-    
+        catalog1, file_id = catalog_asset_pair
+        vector = self.chroma_vector(catalog1, file_id)
+        by_catalog = {}
+        for _catalog, _id in catalog_asset_pairs:
+            by_catalog.setdefault(_catalog, []).append(_id)
+        for catalog2, target_ids in by_catalog.items():
+            file_ids, vectors = self.chroma_rows(catalog2, target_ids)
+            keep = ~((catalog1 == catalog2) & (file_ids == file_id))
+            distances = ((vectors[keep] - vector)**2).sum(axis=1)
+            self.record_one_to_many(catalog1, file_id, catalog2,
+                                    file_ids[keep].tolist(), distances.tolist())
+        return True
+
     #def completed_distribution_complements(self, catalog1, file1, catalog2=""):
     #    catalog2 = catalog1 if not catalog2 else catalog2
     #    self.c.execute("SELECT file2 FROM data"\
@@ -0,0 +1,152 @@
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+
+# Rows hashed per chunk when building an index
+HASH_CHUNK_SIZE = 65536
+
+
+class LshIndex:
+    """
+    Approximate nearest neighbour index over chroma distributions using
+    random-projection locality sensitive hashing.
+
+    Each of <n_tables> hash tables keys a vector by the signs of <n_bits>
+    random projections of the vector less the catalog mean. A query gathers
+    the vectors sharing its bucket, plus buckets within Hamming distance 1
+    when <probes> is set, in every table and reranks them exactly.
+    More tables or probes raise recall; more bits make buckets smaller and
+    queries faster.
+    """
+
+    def __init__(self, n_tables=8, n_bits=16, probes=1, seed=0) -> None:
+        self.n_tables, self.n_bits, self.probes = n_tables, n_bits, probes
+        rng = np.random.default_rng(seed)
+        self.planes = rng.standard_normal((12, n_tables * n_bits)).astype(np.float32)
+        self.powers = (1 << np.arange(n_bits, dtype=np.int64))
+        self.mean = np.zeros(12, dtype=np.float32)
+        self.file_ids = np.empty(0, dtype=np.int64)
+        self.matrix = np.empty((0, 12), dtype=np.float32)
+        self.order = np.empty(0, dtype=np.int64)
+        self.sorted_keys = np.empty(0, dtype=np.int64)
+
+    def codes(self, vectors: np.ndarray) -> np.ndarray:
+        """Returns the (n, n_tables) bucket codes of <vectors>."""
+        codes = np.empty((len(vectors), self.n_tables), dtype=np.int64)
+        for lower in range(0, len(vectors), HASH_CHUNK_SIZE):
+            chunk = vectors[lower:lower + HASH_CHUNK_SIZE] - self.mean
+            bits = (chunk @ self.planes > 0).reshape(-1, self.n_tables, self.n_bits)
+            codes[lower:lower + HASH_CHUNK_SIZE] = bits @ self.powers
+        return codes
+
+    def fit(self, file_ids: np.ndarray, matrix: np.ndarray) -> "LshIndex":
+        self.file_ids = np.asarray(file_ids, dtype=np.int64)
+        self.matrix = np.asarray(matrix, dtype=np.float32)
+        self.mean = self.matrix.mean(axis=0) if len(self.matrix) else self.mean
+        keys = self.table_keys(self.codes(self.matrix)).ravel()
+        order = np.argsort(keys, kind="stable")
+        self.sorted_keys = keys[order]
+        self.order = order // self.n_tables
+        return self
+
+    def table_keys(self, codes: np.ndarray) -> np.ndarray:
+        """Offsets codes by table so that all tables share one sorted array."""
+        return codes + (np.arange(self.n_tables, dtype=np.int64) << self.n_bits)
+
+    def candidates(self, vector: np.ndarray) -> np.ndarray:
+        """Returns matrix row indexes sharing a probed bucket with <vector>."""
+        keys = self.table_keys(self.codes(vector[None, :]))[0]
+        if self.probes:
+            keys = np.concatenate([keys, (keys[:, None] ^ self.powers).ravel()])
+        lefts = np.searchsorted(self.sorted_keys, keys, "left")
+        lengths = np.searchsorted(self.sorted_keys, keys, "right") - lefts
+        starts = np.repeat(lefts - np.cumsum(lengths) + lengths, lengths)
+        return np.unique(self.order[starts + np.arange(lengths.sum())])
+
+    def vector(self, file_id: int) -> np.ndarray:
+        row = int(np.searchsorted(self.file_ids, file_id))
+        if row == len(self.file_ids) or self.file_ids[row] != file_id:
+            raise KeyError(file_id)
+        return self.matrix[row]
+
+    def query(self, vector: np.ndarray, k: int) -> Tuple[np.ndarray]:
+        """
+        Returns (file_ids, distances) of up to <k> approximate nearest
+        neighbours of <vector> by squared euclidean distance, closest first.
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        candidates = self.candidates(vector)
+        distances = ((self.matrix[candidates] - vector)**2).sum(axis=1)
+        if len(candidates) > k:
+            nearest = np.argpartition(distances, k)[:k]
+            candidates, distances = candidates[nearest], distances[nearest]
+        ranked = np.argsort(distances, kind="stable")
+        return (self.file_ids[candidates[ranked]], distances[ranked])
+
+    def save(self, path: str) -> bool:
+        np.savez(path,
+                 params=np.array([self.n_tables, self.n_bits, self.probes]),
+                 planes=self.planes,
+                 mean=self.mean,
+                 file_ids=self.file_ids,
+                 matrix=self.matrix,
+                 order=self.order,
+                 sorted_keys=self.sorted_keys)
+        return True
+
+    @classmethod
+    def load(cls, path: str) -> "LshIndex":
+        with np.load(path) as data:
+            n_tables, n_bits, probes = data["params"].tolist()
+            index = cls(n_tables, n_bits, probes)
+            for attr in ["planes", "mean", "file_ids", "matrix", "order", "sorted_keys"]:
+                setattr(index, attr, data[attr])
+        return index
+
+
+def synthetic_chroma(n: int, n_families=64, concentration=40.0, seed=0) -> np.ndarray:
+    """
+    Returns <n> chroma distributions drawn around <n_families> random
+    distributions, approximating the clustering of real catalogs.
+    """
+    rng = np.random.default_rng(seed)
+    families = rng.dirichlet(np.ones(12), n_families)
+    members = families[rng.integers(0, n_families, n)] * concentration
+    return np.array([rng.dirichlet(_a + 0.01) for _a in members], dtype=np.float32)
+
+def benchmark(n=100000, n_queries=200, k=10,
+              params=((8, 12, 0), (8, 16, 0), (8, 16, 1), (16, 16, 1), (12, 20, 1))
+              ) -> List[Dict]:
+    """
+    Compares recall@k and mean query latency of LshIndex configurations
+    (n_tables, n_bits, probes) against an exact KD-tree on synthetic chroma.
+    """
+    matrix = synthetic_chroma(n)
+    file_ids = np.arange(1, n + 1)
+    queries = matrix[np.random.default_rng(1).choice(n, n_queries, replace=False)]
+    exact = NearestNeighbors(n_neighbors=k, algorithm="kd_tree").fit(matrix)
+    timestamp = perf_counter()
+    truth = [set(file_ids[exact.kneighbors(_q[None, :])[1][0]].tolist()) for _q in queries]
+    exact_ms = (perf_counter() - timestamp) * 1000 / n_queries
+    results = [{"index": "exact", "recall": 1.0, "query_ms": exact_ms, "build_s": 0.0}]
+    for n_tables, n_bits, probes in params:
+        timestamp = perf_counter()
+        index = LshIndex(n_tables, n_bits, probes).fit(file_ids, matrix)
+        build_s = perf_counter() - timestamp
+        timestamp = perf_counter()
+        found = [set(index.query(_q, k)[0].tolist()) for _q in queries]
+        query_ms = (perf_counter() - timestamp) * 1000 / n_queries
+        recall = np.mean([len(_f & _t) / k for _f, _t in zip(found, truth)])
+        results.append({"index": f"lsh tables={n_tables} bits={n_bits} probes={probes}",
+                        "recall": float(recall),
+                        "query_ms": query_ms,
+                        "build_s": build_s})
+    return results
+
+
+if __name__ == "__main__":
+    for row in benchmark():
+        print(f"{row['index']:36} recall {row['recall']:.3f}"\
+              f"  query {row['query_ms']:.3f} ms  build {row['build_s']:.2f} s")
@@ -0,0 +1,167 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import numpy as np
+import shutil
+from sklearn.neighbors import KDTree
+from threading import Event, Thread
+from urllib.parse import parse_qs, urlparse
+
+from apps.App import AppConfig, SimpleApp
+from interfaces.database.LibrosaData import DataInterface
+
+from typing import Dict, List, Tuple
+
+
+HOST = "127.0.0.1"
+PORT = 8765
+# Seconds between checks for a new analysis read replica
+REFRESH_INTERVAL = 30
+DEFAULT_K = 10
+# Query parameters each endpoint cannot do without
+REQUIRED_ARGS = {"/file": ["catalog", "id"], "/vector": ["v"]}
+
+
+class SimilarityIndex:
+    """
+    Holds the chroma matrix and a KD-tree of every catalog in a LibrosaData
+    read replica in memory. Indexes are rebuilt off to the side and swapped
+    in whole, so queries never see a partially loaded replica.
+    """
+
+    def __init__(self, replica_path: str) -> None:
+        self.replica_path = replica_path
+        self.stamp = None
+        self.catalogs = {}
+        self.refresh()
+
+    def replica_stamp(self) -> Tuple:
+        stat = shutil.os.stat(self.replica_path)
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def refresh(self) -> bool:
+        """Reloads the indexes if the replica has changed. Returns True if reloaded."""
+        stamp = self.replica_stamp()
+        if stamp == self.stamp:
+            return False
+        data = DataInterface(self.replica_path, readonly=True)
+        catalogs = {}
+        for catalog in data.chroma_catalogs():
+            file_ids, matrix = data.chroma_matrix(catalog)
+            if not len(file_ids):
+                continue
+            catalogs[catalog] = (file_ids, matrix, KDTree(matrix))
+        data.close()
+        self.catalogs, self.stamp = catalogs, stamp
+        return True
+
+    def vector(self, catalog: str, file_id: int) -> np.ndarray:
+        file_ids, matrix, _ = self.catalogs[catalog]
+        row = int(np.searchsorted(file_ids, file_id))
+        if row == len(file_ids) or file_ids[row] != file_id:
+            raise KeyError(file_id)
+        return matrix[row]
+
+    def similar_to_vector(self, vector: np.ndarray,
+                                k=DEFAULT_K,
+                                within: List[str] = [],
+                                exclude: Tuple = ()
+                                ) -> List[Dict]:
+        """
+        Returns up to <k> files closest to <vector> across the catalogs in
+        <within>, or across all catalogs, by squared euclidean distance.
+        <exclude> is a (catalog, file_id) pair left out of the results.
+        """
+        catalogs = self.catalogs
+        vector = np.asarray(vector, dtype=np.float32).reshape(1, 12)
+        results = []
+        for catalog in (within if within else catalogs.keys()):
+            file_ids, _, tree = catalogs[catalog]
+            distances, rows = tree.query(vector, k=min(k + 1, len(file_ids)))
+            results += [(_d**2, catalog, _f) for _d, _f
+                        in zip(distances[0].tolist(), file_ids[rows[0]].tolist())
+                        if (catalog, _f) != exclude]
+        results.sort()
+        return [{"catalog": _c, "file": _f, "distance": _d} for _d, _c, _f in results[:k]]
+
+    def similar_to_file(self, catalog: str,
+                              file_id: int,
+                              k=DEFAULT_K,
+                              within: List[str] = []
+                              ) -> List[Dict]:
+        return self.similar_to_vector(self.vector(catalog, file_id), k, within,
+                                      exclude=(catalog, file_id))
+
+
+class SimilarityRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /file?catalog=<catalog>&id=<file_id>[&k=<k>][&within=<catalog>,...]
+    GET /vector?v=<c01>,...,<c12>[&k=<k>][&within=<catalog>,...]
+    """
+
+    index: SimilarityIndex = None
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        args = {_k: _v[0] for _k, _v in parse_qs(url.query).items()}
+        if not url.path in REQUIRED_ARGS:
+            return self.respond(404, {"error": "unknown endpoint"})
+        if not all([_a in args for _a in REQUIRED_ARGS[url.path]]):
+            return self.respond(400, {"error": "invalid arguments"})
+        try:
+            k = int(args.get("k", DEFAULT_K))
+            within = args["within"].split(",") if args.get("within") else []
+            if url.path == "/file":
+                results = self.index.similar_to_file(args["catalog"], int(args["id"]),
+                                                     k, within)
+            else:
+                vector = [float(_v) for _v in args["v"].split(",")]
+                if not len(vector) == 12:
+                    raise ValueError
+                results = self.index.similar_to_vector(vector, k, within)
+        except KeyError as e:
+            return self.respond(404, {"error": f"not found: {e}"})
+        except ValueError:
+            return self.respond(400, {"error": "invalid arguments"})
+        return self.respond(200, {"results": results})
+
+    def respond(self, status: int, payload: Dict) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+class SimilarityServer(SimpleApp):
+
+    def __init__(self, sonicat_path: str) -> None:
+        config = AppConfig(sonicat_path, "similarity_server")
+        super().__init__(config)
+        replica_path = f"{self.cfg.sonicat_path}/data/analysis/LibrosaAnalysis-ReadReplica.sqlite"
+        self.index = SimilarityIndex(replica_path)
+        self.stopped = Event()
+        self.log.info(f"Application Initialization Successful")
+
+    def watch_replica(self, interval=REFRESH_INTERVAL) -> None:
+        while not self.stopped.wait(interval):
+            try:
+                if self.index.refresh():
+                    self.log.info("Reloaded indexes from new analysis read replica.")
+            except Exception as e:
+                self.log.error(f"Analysis read replica reload failed: {e}")
+
+    def serve(self, host=HOST, port=PORT, interval=REFRESH_INTERVAL) -> None:
+        handler = type("Handler", (SimilarityRequestHandler,), {"index": self.index})
+        server = ThreadingHTTPServer((host, port), handler)
+        watcher = Thread(target=self.watch_replica, args=(interval,), daemon=True)
+        watcher.start()
+        self.log.info(f"Serving similarity queries on {host}:{port}")
+        try:
+            server.serve_forever()
+        finally:
+            self.stopped.set()
+            server.server_close()
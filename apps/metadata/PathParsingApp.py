@@ -24,8 +24,9 @@ class PathParser(SimpleApp):
         self.log.debug("Connected to Tokens interface")
         self.log.info(f"END application initialization: Success")
 
-    def parse_path(self, catalog: str, file_id) -> bool:
-        path = self.replicas[catalog].file_path(file_id)
+    def parse_path(self, catalog: str, file_id, path="") -> bool:
+        if not path:
+            path = self.replicas[catalog].file_path(file_id)
         result: Parser.ParsedAudioFilePath = self.parser.parse_path(path)
         self.tokens.add_file_tokens(file_id,
                                     self.cfg.moniker,
@@ -39,25 +40,38 @@ class PathParser(SimpleApp):
         return True
 
     def parse_asset_file_paths(self, catalog: str, asset_id: str) -> bool:
+        """
+        (Re)parses the audio file paths of an asset, replacing the tokens
+        and parses of any earlier run in the transactions adding new ones.
+        """
         file_ids = self.replicas[catalog].file_ids_by_asset(asset_id)
-        for _fid in file_ids:
-            if not self.replicas[catalog].file_filetype_id(_fid) in self.audio_type_ids:
+        file_data = self.replicas[catalog].file_data_many(file_ids)
+        self.tokens.remove_file_tokens(file_ids, self.cfg.moniker, finalize=False)
+        self.record.remove_asset_parse(asset_id, file_ids, self.cfg.moniker, finalize=False)
+        for _fid, _d in file_data.items():
+            if not _d["filetype"] in self.audio_type_ids:
                 continue
-            self.parse_path(catalog, _fid)
+            self.parse_path(catalog, _fid, f"{_d['dirname']}/{_d['basename']}")
         self.tokens.db.commit()
         self.record.log_asset_parse(asset_id, self.cfg.moniker, finalize=True)
         return True
 
     def all_unparsed_assets(self, catalog) -> List[str]:
-        parsed_assets = [str(_i) for _i
-                         in self.record.parsed_asset_ids(self.cfg.moniker)]
-        return self.replicas[catalog].all_asset_ids(excluding=parsed_assets)
+        parsed_assets = {str(_i) for _i
+                         in self.record.parsed_asset_ids(self.cfg.moniker)}
+        return [_i for _i in self.replicas[catalog].iter_asset_ids()
+                if str(_i) not in parsed_assets]
 
-    def run(self, catalog: str):
+    def changed_assets(self, catalog, generation: int) -> List[str]:
+        """Returns assets added or changed after change log <generation>, parsed or not."""
+        return self.replicas[catalog].changed_asset_ids(generation)
+
+    def run(self, catalog: str, since=None):
         self.audio_type_ids = [self.replicas[catalog].filetype_id(_ext) 
                                for _ext in self.parser.audio_exts 
                                if self.replicas[catalog].filetype_exists(_ext)]
-        self.target_asset_ids = self.all_unparsed_assets()
+        self.target_asset_ids = self.all_unparsed_assets(catalog) if since is None \
+                                else self.changed_assets(catalog, since)
         #target_asset_id = self.asset_with_unparsed_files()
         while self.target_asset_ids:
             target_id = self.target_asset_ids.pop()
@@ -103,9 +117,5 @@ class TokenAnalysis(SimpleApp):
     #    return self.replicas[catalog].asset_ids_from_file_ids(file_ids)
 
     def freq_dict(self) -> Dict[str, int]:
-        result = {}
-        for _t in self.tokens.all_tokens(self.cfg.moniker):
-            _token = _t[1]
-            _freq = self.tokens.n_occurrences_total(_t[0], self.cfg.moniker)
-            result[_token] = _freq
-        return result
+        occurrences = self.tokens.n_occurrences_by_token(self.cfg.moniker)
+        return {_t[1]: occurrences.get(_t[0], 0) for _t in self.tokens.all_tokens()}
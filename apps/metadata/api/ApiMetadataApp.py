@@ -79,13 +79,11 @@ class ApiMetadataApp(SimpleApp):
         return False
     
     def run(self, catalog):
-        completed = self.data.all_asset_ids_by_catalog("releases")
-        _ids = self.replicas[catalog].all_asset_ids()
-        _failed = self.data.all_failed_searches_by_catalog("releases")
-        assets_to_search = [_id for _id in _ids if all([
-            _id not in completed,
-            _id not in _failed])]
-        for _id in assets_to_search:
+        skipped = set(self.data.all_asset_ids_by_catalog("releases"))
+        skipped.update(self.data.all_failed_searches_by_catalog("releases"))
+        for _id in self.replicas[catalog].iter_asset_ids():
+            if _id in skipped:
+                continue
             self.log.debug(f"BEGIN - Search {self.api_name} for asset ID {_id}.")
             if self.process_asset(catalog, _id):
                 self.log.debug("END - Success")
@@ -1,6 +1,8 @@
 #!/usr/bin/python3
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
+import hashlib
 import re
 import shutil
 from yaml import load, SafeLoader
@@ -11,12 +13,35 @@ from util.NameUtility import NameUtility
 from typing import Dict, List, Tuple
 
 
+# Files are hashed in reads of this many bytes, by this many threads;
+# hashlib releases the GIL while digesting large buffers
+DIGEST_CHUNK_SIZE = 4 * 1024 * 1024
+DIGEST_WORKERS = 8
+
+
+def file_digest(path: str, chunk_size=DIGEST_CHUNK_SIZE) -> str:
+    digest = hashlib.sha256()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with closing(open(path, "rb", buffering=0)) as _f:
+        while n_bytes := _f.readinto(buffer):
+            digest.update(view[:n_bytes])
+    return digest.hexdigest()
+
+def file_digests(paths: List[str], workers=DIGEST_WORKERS) -> List[str]:
+    """Returns the SHA-256 hex digest of each of <paths>, in order."""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(file_digest, paths))
+
+
 class Inventory(SimpleApp):
     
     def __init__(self, sonicat_path) -> None:
         config = AppConfig(sonicat_path, "inventory")
         super().__init__(config)
         self.load_catalog_replicas()
+        # Assets added since the last replica export must not be inventoried again
+        self.load_catalogs()
         self.cln = Cleanse(f"{self.cfg.sonicat_path}")
 
     def run_cycle(self, task: Dict = {}) -> List[Dict]:
@@ -37,7 +62,7 @@ class Inventory(SimpleApp):
         cname = path.split("/")[-1]
         if not NameUtility.name_is_canonical(cname):
             return False
-        if self.replicas[catalog].asset_exists(cname):
+        if self.catalogs[catalog].asset_exists(cname):
             return False
         return True
 
@@ -66,18 +91,47 @@ class Inventory(SimpleApp):
         return True
 
     def survey_asset_files(self, path: str) -> Dict[str, Dict[str, str]]:
-        file_data = {}
-        for _path in shutil.os.walk(path):
-            for basename in _path[2]:
-                dirname = _path[0].replace(path, "")
-                fpath = "/".join([_path[0], basename])
-                file_data[f"{dirname}/{basename}"] = {
-                    "basename": basename,
-                    "dirname": dirname,
-                    "size": shutil.os.path.getsize(fpath),
-                    "filetype": NameUtility.file_extension(basename)
-                }
-        return file_data
+        return survey_files(path)
+
+    def duplicate_report(self) -> List[Dict]:
+        """
+        Returns every digest shared by more than one file across the loaded
+        catalog replicas, largest reclaimable size first.
+        """
+        by_digest = {}
+        for catalog, replica in self.replicas.items():
+            for digest, file_id, size in replica.digested_files():
+                by_digest.setdefault(digest, []).append((catalog, file_id, size))
+        report = [{"digest": _d,
+                   "size": _f[0][2],
+                   "reclaimable": sum([_s for _, _, _s in _f[1:]]),
+                   "files": [(_c, _i) for _c, _i, _ in _f]}
+                  for _d, _f in by_digest.items() if len(_f) > 1]
+        report.sort(key=lambda _r: _r["reclaimable"], reverse=True)
+        return report
+
+
+def survey_files(path: str, workers=DIGEST_WORKERS) -> Dict[str, Dict[str, str]]:
+    """
+    Returns file data for every file under <path>, digesting file contents
+    while the asset is restored so that it never has to be restored again
+    for hashing.
+    """
+    file_data, fpaths = {}, []
+    for _path in shutil.os.walk(path):
+        for basename in _path[2]:
+            dirname = _path[0].replace(path, "")
+            fpath = "/".join([_path[0], basename])
+            file_data[f"{dirname}/{basename}"] = {
+                "basename": basename,
+                "dirname": dirname,
+                "size": shutil.os.path.getsize(fpath),
+                "filetype": NameUtility.file_extension(basename)
+            }
+            fpaths.append(fpath)
+    for _data, _digest in zip(file_data.values(), file_digests(fpaths, workers)):
+        _data["digest"] = _digest
+    return file_data
 
 
 class Cleanse:
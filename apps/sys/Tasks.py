@@ -94,15 +94,15 @@ class Tasks(SimpleApp):
         """
         Returns items in <all_entities> and not in any list in <subsets>.
         """
-        return [_i for _i in all_entities
-                if all([_i not in subset for subset in subsets])]
+        excluded = set().union(*subsets)
+        return [_i for _i in all_entities if _i not in excluded]
 
-    def asset_lists_by_task(self, catalog) -> Dict[str, Dict[str, List[str]]]:
+    def asset_lists_by_task(self, catalog, since=None) -> Dict[str, Dict[str, List[str]]]:
         """
         Returns dictionary {<app>: <action>: List[asset_id]}
-        That is, asset IDs in <catalog> not yet processed by <app>.<action>.
+        That is, asset IDs in <catalog> not yet processed by <app>.<action>,
+        limited to assets changed after change log generation <since> if given.
         """
-        all_assets = self.replicas[catalog].all_asset_ids(catalog)
         tasks_to_run = self.cfg.catalog_cfg[catalog]["tasks"]
         asset_lists = {}
         for _type in tasks_to_run.keys():
@@ -111,8 +111,10 @@ class Tasks(SimpleApp):
                 _completed = self.replicas[_app].get_completed()
                 _failed = self.replicas
                 for _action in tasks_to_run[_type][_app]["actions"]:
+                    asset_ids = self.replicas[catalog].iter_asset_ids() if since is None \
+                                else self.replicas[catalog].changed_asset_ids(since)
                     asset_lists[_app][_action] = \
-                            self.filter_lists(all_assets, [_completed, _failed])
+                            self.filter_lists(asset_ids, [_completed, _failed])
         return asset_lists
             
     def task_lists_by_asset(self, assets_by_task) -> Dict[str, List[Tuple[str]]]:
@@ -142,8 +144,9 @@ class Tasks(SimpleApp):
                 cleanup_task = self.tm.make("file_mover", "remove", {"data_path": data_path})
                 break
 
+        cnames = self.replicas[catalog].cnames(tasks_by_asset.keys())
         for asset_id in tasks_by_asset.keys():
-            cname = self.replicas[catalog.asset_data(asset_id)]
+            cname = cnames[asset_id]
             label_dir = NameUtility.label_dir_from_cname(cname)
             task_args = {"catalog": catalog,
                          "asset_id": asset_id,
@@ -179,10 +182,10 @@ class Tasks(SimpleApp):
     def add_args_file_paths(self, catalog, asset_id, file_ext, task_args) -> Dict:
         filetype_id = self.replicas[catalog].cached_filetype_id(file_ext)
         file_ids = self.replicas[catalog].file_ids_by_asset_and_type(asset_id, filetype_id)
-        file_paths = [self.replicas[catalog].file_path(_id) for _id in file_ids]
+        file_paths = self.replicas[catalog].file_paths(file_ids)
         if not file_paths:
             return {}
-        task_args["file_paths"] = [_t for _t in zip(file_ids, file_paths)]
+        task_args["file_paths"] = [(_id, file_paths[_id]) for _id in file_ids]
         return task_args
 
   
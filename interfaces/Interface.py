@@ -4,28 +4,577 @@
 
 
 
+from collections import deque, OrderedDict
+from functools import lru_cache
+import json
+import re
 import shutil
 import sqlite3
+import threading
+import time
+from time import perf_counter
+from urllib.parse import quote
+import weakref
+
+from typing import Dict, List
+
+# Replica exports copy this many pages per backup step, pausing between
+# steps so that writers on other connections can proceed
+REPLICA_PAGES_PER_STEP = 1024
+REPLICA_STEP_SLEEP = 0.01
+# Read-only connections map up to this many bytes of the database file and
+# keep a page cache of this many KiB
+READONLY_MMAP_SIZE = 1 << 30
+READONLY_CACHE_KIB = 256 * 1024
+# Idle pooled connections are closed, least recently used first, beyond this
+MAX_POOLED_CONNECTIONS = 64
+# Private databases get a connection of their own rather than a pooled one
+PRIVATE_DBPATHS = ["", ":memory:"]
+# Replica sync reads and writes changed rows in batches of this many IDs
+SYNC_BATCH_SIZE = 900
+# Query profiling keeps this many recent latencies per statement for
+# percentiles, and logs statements taking at least SLOW_QUERY_MS
+PROFILE_SAMPLES = 10000
+SLOW_QUERY_MS = 100
+SLOW_QUERIES_KEPT = 1000
+
+
+def connect(dbpath: str, mode: str, check_same_thread=True) -> sqlite3.Connection:
+    """
+    Writable ("rw") connections use WAL journaling so that readers on other
+    connections never wait on a writer. Read-only ("ro") connections open
+    the file with a mode=ro URI, memory-map it and take no write locks;
+    "immutable" further skips all locking and change detection, and is only
+    safe for files that are replaced rather than modified in place, such as
+    exported read replicas. In-memory databases are opened by URI too, so
+    that they can ATTACH files by URI, and have no journal to configure.
+    """
+    if dbpath == ":memory:":
+        return sqlite3.connect("file::memory:", uri=True,
+                               check_same_thread=check_same_thread)
+    if mode == "rw":
+        db = sqlite3.connect(dbpath, check_same_thread=check_same_thread)
+        db.execute("PRAGMA journal_mode = WAL;")
+        db.execute("PRAGMA synchronous = NORMAL;")
+        return db
+    uri = f"file:{quote(dbpath)}?mode=ro{'&immutable=1' if mode == 'immutable' else ''}"
+    db = sqlite3.connect(uri, uri=True, check_same_thread=check_same_thread)
+    db.execute(f"PRAGMA mmap_size = {READONLY_MMAP_SIZE};")
+    db.execute(f"PRAGMA cache_size = -{READONLY_CACHE_KIB};")
+    db.execute("PRAGMA query_only = ON;")
+    return db
+
+def changelog_schema(tables: list) -> list:
+    """
+    Returns statements creating a changelog table and triggers that append
+    (generation, table, row id, operation) for every insert, update and
+    delete on <tables>. Generations increase monotonically and are never
+    reused.
+    """
+    schema = ["""
+CREATE TABLE IF NOT EXISTS changelog (
+    generation integer PRIMARY KEY AUTOINCREMENT,
+    tbl text NOT NULL,
+    row_id integer NOT NULL,
+    op text NOT NULL
+);
+"""]
+    for table in tables:
+        for event, row in [("insert", "NEW"), ("update", "NEW"), ("delete", "OLD")]:
+            schema.append(f"""
+CREATE TRIGGER IF NOT EXISTS {table}_{event}_changelog AFTER {event.upper()} ON {table} BEGIN
+    INSERT INTO changelog (tbl, row_id, op) VALUES ('{table}', {row}.id, '{event}');
+END;
+""")
+    return schema
+
+def file_identity(dbpath: str) -> tuple:
+    try:
+        stat = shutil.os.stat(dbpath)
+    except OSError:
+        return None
+    return (stat.st_dev, stat.st_ino)
+
+
+class ConnectionPool:
+    """
+    Process-wide pool of sqlite3 connections, keyed by thread, database
+    file and mode, so that every interface on a thread shares one warm
+    connection (and page cache) per database. Connections are reference
+    counted by the interfaces bound to them; once the pool holds more than
+    <max_connections>, the calling thread's least recently used idle
+    connections are closed. A file replaced on disk, such as a re-exported
+    replica, gets a new connection on the next bind. Connections of threads
+    that have exited are closed on the next acquire, whatever their
+    references, so they are opened without sqlite3's same-thread check.
+    """
+
+    def __init__(self, max_connections=MAX_POOLED_CONNECTIONS) -> None:
+        self.max_connections = max_connections
+        self.lock = threading.Lock()
+        self.connections = OrderedDict()
+        self.prepared = set()
+
+    def acquire(self, dbpath: str, mode: str) -> tuple:
+        """Returns (key, connection) for the calling thread, adding a reference."""
+        thread = threading.get_ident()
+        key = (thread, dbpath, mode, file_identity(dbpath))
+        with self.lock:
+            entry = self.connections.get(key)
+            if entry and entry[2] is threading.current_thread():
+                entry[1] += 1
+                self.connections.move_to_end(key)
+                return (key, entry[0])
+            dead = self.abandoned()
+        for _db in dead:
+            _db.close()
+        db = connect(dbpath, mode, check_same_thread=False)
+        key = (thread, dbpath, mode, file_identity(dbpath))
+        with self.lock:
+            entry = self.connections.setdefault(key, [db, 0, threading.current_thread()])
+            entry[1] += 1
+            self.connections.move_to_end(key)
+            idle = self.evictable(thread)
+        if entry[0] is not db:
+            idle.append(db)
+        for _db in idle:
+            _db.close()
+        return (key, entry[0])
+
+    def release(self, key: tuple) -> None:
+        with self.lock:
+            entry = self.connections.get(key)
+            if entry:
+                entry[1] -= 1
+
+    def release_all(self, keys: list) -> None:
+        for key in keys:
+            self.release(key)
+
+    def evictable(self, thread: int) -> list:
+        """Removes and returns idle connections of <thread> beyond the limit."""
+        idle = []
+        for key, (db, refs, _) in list(self.connections.items()):
+            if len(self.connections) <= self.max_connections:
+                break
+            if key[0] == thread and refs <= 0 and not db.in_transaction:
+                del self.connections[key]
+                idle.append(db)
+        return idle
+
+    def abandoned(self) -> list:
+        """
+        Removes and returns connections of threads that have exited,
+        including those whose thread ID has since been reused.
+        """
+        dead = []
+        for key, (db, _, thread) in list(self.connections.items()):
+            if not thread.is_alive():
+                del self.connections[key]
+                dead.append(db)
+        return dead
+
+    def size(self) -> int:
+        return len(self.connections)
+
+    def needs_schema(self, key: tuple, schema: str) -> bool:
+        return (key[1:], schema) not in self.prepared
+
+    def schema_applied(self, key: tuple, schema: str) -> None:
+        self.prepared.add((key[1:], schema))
+
+
+POOL = ConnectionPool()
+
+
+@lru_cache(maxsize=4096)
+def statement_key(statement: str) -> str:
+    """Returns <statement> with whitespace and IN (?,...) lists collapsed."""
+    statement = " ".join(statement.split())
+    return re.sub(r"\bIN \(\?(\s*,\s*\?)*\)", "IN (...)", statement, flags=re.I)
+
+
+class QueryProfiler:
+    """
+    Opt-in, process-wide statistics on statements run through
+    DatabaseInterface cursors: calls, total and percentile latency (execute
+    plus fetches) and rows returned or changed, per statement with IN (...)
+    parameter lists collapsed. Statements taking at least <slow_ms> are kept,
+    with their EXPLAIN QUERY PLAN, and appended as JSON lines to
+    <slow_log_path> if given. Only interfaces created while enabled are
+    profiled, so disabled profiling costs nothing.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.slow_ms = SLOW_QUERY_MS
+        self.slow_log_path = ""
+        self.lock = threading.Lock()
+        self.cursors = weakref.WeakSet()
+        self.reset()
+
+    def enable(self, slow_ms=SLOW_QUERY_MS, slow_log_path="") -> None:
+        self.enabled, self.slow_ms, self.slow_log_path = True, slow_ms, slow_log_path
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        with self.lock:
+            self.stats = {}
+            self.slow_queries = deque(maxlen=SLOW_QUERIES_KEPT)
+
+    def record(self, cursor: sqlite3.Cursor,
+                     statement: str,
+                     args,
+                     elapsed: float,
+                     rows: int
+                     ) -> None:
+        key = statement_key(statement)
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = {"calls": 0, "total": 0.0, "rows": 0,
+                                           "samples": deque(maxlen=PROFILE_SAMPLES)}
+            stats["calls"] += 1
+            stats["total"] += elapsed
+            stats["rows"] += rows
+            stats["samples"].append(elapsed)
+        if elapsed * 1000 >= self.slow_ms:
+            self.log_slow_query(cursor, statement, key, args, elapsed, rows)
+
+    def query_plan(self, cursor: sqlite3.Cursor, statement: str, args) -> List[str]:
+        try:
+            plan = cursor.connection.execute(f"EXPLAIN QUERY PLAN {statement}", args)
+            return [_r[-1] for _r in plan.fetchall()]
+        except sqlite3.Error:
+            return []
+
+    def log_slow_query(self, cursor: sqlite3.Cursor,
+                             statement: str,
+                             key: str,
+                             args,
+                             elapsed: float,
+                             rows: int
+                             ) -> None:
+        entry = {"time": time.time(),
+                 "statement": key,
+                 "ms": elapsed * 1000,
+                 "rows": rows,
+                 "plan": self.query_plan(cursor, statement, args)}
+        with self.lock:
+            self.slow_queries.append(entry)
+            if self.slow_log_path:
+                with open(self.slow_log_path, "a") as f:
+                    f.write(f"{json.dumps(entry)}\n")
+
+    def report(self) -> List[Dict]:
+        """
+        Returns per-statement statistics, largest total time first. Finishes
+        the calling thread's cursors first, so their last statements count.
+        """
+        for cursor in list(self.cursors):
+            if cursor.thread == threading.get_ident():
+                cursor.finish()
+        with self.lock:
+            stats = [(_k, dict(_s, samples=sorted(_s["samples"])))
+                     for _k, _s in self.stats.items()]
+        report = []
+        for key, _s in stats:
+            samples = _s["samples"]
+            percentile = lambda _p: samples[min(len(samples) - 1,
+                                                int(_p * len(samples)))] * 1000
+            report.append({"statement": key,
+                           "calls": _s["calls"],
+                           "rows": _s["rows"],
+                           "total_ms": _s["total"] * 1000,
+                           "mean_ms": _s["total"] * 1000 / _s["calls"],
+                           "p50_ms": percentile(0.5),
+                           "p95_ms": percentile(0.95),
+                           "p99_ms": percentile(0.99),
+                           "max_ms": samples[-1] * 1000})
+        return sorted(report, key=lambda _r: _r["total_ms"], reverse=True)
+
+    def dump(self, path: str) -> bool:
+        """Writes the report and the kept slow queries to <path> as JSON."""
+        report = self.report()
+        with self.lock:
+            slow_queries = list(self.slow_queries)
+        with open(path, "w") as f:
+            json.dump({"statements": report, "slow_queries": slow_queries}, f, indent=2)
+        return True
+
+
+PROFILER = QueryProfiler()
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """
+    Cursor timing each statement from execute through its last fetch, and
+    recording it with PROFILER once the cursor moves on or closes.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.thread = threading.get_ident()
+        self.pending = None
+        PROFILER.cursors.add(self)
+
+    def finish(self) -> None:
+        pending, self.pending = self.pending, None
+        if pending is None:
+            return
+        statement, args, elapsed, rows = pending
+        if self.description is None:
+            rows = max(self.rowcount, 0)
+        PROFILER.record(self, statement, args, elapsed, rows)
+
+    def execute(self, statement: str, args=()) -> sqlite3.Cursor:
+        self.finish()
+        timestamp = perf_counter()
+        try:
+            return super().execute(statement, args)
+        finally:
+            self.pending = [statement, args, perf_counter() - timestamp, 0]
+
+    def executemany(self, statement: str, args_list) -> sqlite3.Cursor:
+        self.finish()
+        args_list = args_list if isinstance(args_list, (list, tuple)) else list(args_list)
+        timestamp = perf_counter()
+        try:
+            return super().executemany(statement, args_list)
+        finally:
+            self.pending = [statement, args_list[0] if args_list else (),
+                            perf_counter() - timestamp, 0]
+
+    def fetched(self, timestamp: float, rows: int) -> None:
+        if self.pending is not None:
+            self.pending[2] += perf_counter() - timestamp
+            self.pending[3] += rows
+
+    def fetchone(self):
+        timestamp = perf_counter()
+        row = super().fetchone()
+        self.fetched(timestamp, row is not None)
+        return row
+
+    def fetchmany(self, *args, **kwargs) -> list:
+        timestamp = perf_counter()
+        rows = super().fetchmany(*args, **kwargs)
+        self.fetched(timestamp, len(rows))
+        return rows
+
+    def fetchall(self) -> list:
+        timestamp = perf_counter()
+        rows = super().fetchall()
+        self.fetched(timestamp, len(rows))
+        return rows
+
+    def __next__(self):
+        timestamp = perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self.fetched(timestamp, 0)
+            raise
+        self.fetched(timestamp, 1)
+        return row
+
+    def close(self) -> None:
+        self.finish()
+        super().close()
 
 
 class DatabaseInterface:
+    """
+    Connections are drawn from the process-wide POOL; <db> and <c> resolve
+    to the calling thread's connection and this interface's cursor on it.
+    See connect() for the <readonly> and <immutable> modes.
+    """
 
-    def __init__(self, dbpath=""):
+    # Tables whose changes are recorded by changelog_schema() triggers, in
+    # the order their upserts are applied to replicas
+    changelog_tables = []
+    # Snapshots exported by interfaces.database.Columnar.ColumnarSnapshot
+    column_snapshots = {}
+
+    def __init__(self, dbpath="", readonly=False, immutable=False):
         self.dbpath = dbpath
-        self.db = sqlite3.connect(dbpath)
-        self.c = self.db.cursor()
+        self.readonly = readonly or immutable
+        self.mode = "immutable" if immutable else "ro" if readonly else "rw"
+        self.handles = {}
+        self.pool_keys = []
+        weakref.finalize(self, POOL.release_all, self.pool_keys)
+        self.handle()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        return self.handle()[1]
+
+    @property
+    def c(self) -> sqlite3.Cursor:
+        return self.handle()[2]
+
+    def handle(self) -> tuple:
+        """Returns (pool key, connection, cursor) for the calling thread."""
+        handle = self.handles.get(threading.current_thread())
+        if handle is None:
+            for thread in [_t for _t in self.handles if not _t.is_alive()]:
+                key = self.handles.pop(thread)[0]
+                if key is not None:
+                    self.pool_keys.remove(key)
+            if self.dbpath in PRIVATE_DBPATHS:
+                key, db = None, connect(self.dbpath, self.mode)
+            else:
+                key, db = POOL.acquire(self.dbpath, self.mode)
+                self.pool_keys.append(key)
+            handle = (key, db, self.cursor(db))
+            self.handles[threading.current_thread()] = handle
+        return handle
+
+    def cursor(self, db=None) -> sqlite3.Cursor:
+        """Returns a new cursor, profiled if PROFILER is enabled."""
+        db = self.db if db is None else db
+        return db.cursor(ProfiledCursor) if PROFILER.enabled else db.cursor()
+
+    def close(self) -> None:
+        """Releases the calling thread's connection back to the pool."""
+        handle = self.handles.pop(threading.current_thread(), None)
+        if handle is None:
+            return
+        key, db, cursor = handle
+        cursor.close()
+        if key is None:
+            db.close()
+        else:
+            self.pool_keys.remove(key)
+            POOL.release(key)
+
+    def needs_schema(self, schema: str) -> bool:
+        """
+        Returns whether <schema> has yet to be applied to this database file
+        by this process; private databases always need it.
+        """
+        key = self.handle()[0]
+        return key is None or POOL.needs_schema(key, schema)
+
+    def schema_applied(self, schema: str) -> None:
+        key = self.handle()[0]
+        if key is not None:
+            POOL.schema_applied(key, schema)
 
     def commit(self):
         return self.db.commit()
 
-    def export_replica(self, note=""):
+    def replica_path(self, note="") -> str:
+        return self.dbpath.replace(".sqlite", f"-ReadReplica{note}.sqlite")
+
+    def export_replica(self, note="", pages=REPLICA_PAGES_PER_STEP):
+        """
+        Copies the database with the online backup API into a temporary file,
+        then renames it over the replica, so the connection stays open and
+        readers only ever see a complete replica.
+        """
+        self.db.commit()
+        replica_path = self.replica_path(note)
+        tmp_path = f"{replica_path}.tmp"
+        if shutil.os.path.exists(tmp_path):
+            shutil.os.remove(tmp_path)
+        replica = sqlite3.connect(tmp_path)
+        try:
+            self.db.backup(replica, pages=pages, sleep=REPLICA_STEP_SLEEP)
+            replica.execute("PRAGMA journal_mode = DELETE;")
+        finally:
+            replica.close()
+        shutil.os.replace(tmp_path, replica_path)
+        return replica_path
+
+  # Change Log
+    def generation(self) -> int:
+        self.c.execute("SELECT MAX(generation) FROM changelog;")
+        result = self.c.fetchone()[0]
+        return int(result) if result else 0
+
+    def changes_since(self, generation: int) -> list:
+        """Returns (generation, table, row_id, op) of every change after <generation>."""
+        self.c.execute("SELECT generation, tbl, row_id, op FROM changelog"\
+                       "  WHERE generation > ? ORDER BY generation ASC;",
+                       (generation,))
+        return self.c.fetchall()
+
+    def sync_replica(self, note="") -> int:
+        """
+        Brings the replica up to date in place by applying only the rows
+        changed since its generation, in one transaction, then copying the
+        change log entries across. Rows are upserted or deleted to match
+        their current state here, so each changed row is written once however
+        often it changed. Falls back to export_replica if the replica does
+        not exist or predates the change log. Returns the replica's new
+        generation.
+        """
         self.db.commit()
-        self.db.close()
-        replica_path = self.dbpath.replace(".sqlite", f"-ReadReplica{note}.sqlite")
-        shutil.copyfile(self.dbpath,replica_path)
-        self.db = sqlite3.connect(self.dbpath)
-        self.c = self.db.cursor()
-        
+        replica_path = self.replica_path(note)
+        if not shutil.os.path.exists(replica_path):
+            self.export_replica(note)
+            return self.generation() if self.changelog_tables else 0
+        replica = sqlite3.connect(replica_path, isolation_level=None)
+        if not replica.execute("SELECT name FROM sqlite_master"\
+                               "  WHERE type = 'table' AND name = 'changelog';").fetchone():
+            replica.close()
+            self.export_replica(note)
+            return self.generation() if self.changelog_tables else 0
+        try:
+            since = replica.execute("SELECT MAX(generation) FROM changelog;").fetchone()[0] or 0
+            self.c.execute("BEGIN;")
+            changes = self.changes_since(since)
+            changed = {}
+            for _, table, row_id, _ in changes:
+                changed.setdefault(table, set()).add(row_id)
+            current = {_t: self.current_rows(_t, changed.get(_t, set()))
+                       for _t in self.changelog_tables}
+            self.db.commit()
+            replica.execute("BEGIN IMMEDIATE;")
+            for table in reversed(self.changelog_tables):
+                deleted = sorted(changed.get(table, set()) - current[table][1].keys())
+                for lower in range(0, len(deleted), SYNC_BATCH_SIZE):
+                    batch = deleted[lower:lower + SYNC_BATCH_SIZE]
+                    replica.execute(f"DELETE FROM {table} WHERE id IN"\
+                                    f" ({','.join('?' * len(batch))});", batch)
+            for table in self.changelog_tables:
+                columns, rows = current[table]
+                if rows:
+                    replica.executemany(self.upsert_statement(table, columns),
+                                        list(rows.values()))
+            replica.execute("DELETE FROM changelog WHERE generation > ?;", (since,))
+            replica.executemany("INSERT INTO changelog (generation, tbl, row_id, op)"\
+                                " VALUES (?,?,?,?);", changes)
+            replica.execute("COMMIT;")
+        except:
+            if replica.in_transaction:
+                replica.execute("ROLLBACK;")
+            raise
+        finally:
+            replica.close()
+        return changes[-1][0] if changes else since
+
+    def current_rows(self, table: str, row_ids: set) -> tuple:
+        """Returns (columns, {id: row}) of those of <row_ids> still in <table>."""
+        self.c.execute(f"SELECT * FROM {table} LIMIT 0;")
+        columns = [_d[0] for _d in self.c.description]
+        row_ids, rows = sorted(row_ids), {}
+        for lower in range(0, len(row_ids), SYNC_BATCH_SIZE):
+            batch = row_ids[lower:lower + SYNC_BATCH_SIZE]
+            self.c.execute(f"SELECT * FROM {table} WHERE id IN"\
+                           f" ({','.join('?' * len(batch))});", batch)
+            rows.update({_r[0]: _r for _r in self.c.fetchall()})
+        return (columns, rows)
+
+    def upsert_statement(self, table: str, columns: list) -> str:
+        updates = ", ".join([f"{_c} = excluded.{_c}" for _c in columns if _c != "id"])
+        return f"INSERT INTO {table} ({', '.join(columns)})"\
+               f" VALUES ({','.join('?' * len(columns))})"\
+               f" ON CONFLICT (id) DO UPDATE SET {updates};"
+
 
 
 import requests
@@ -1,8 +1,18 @@
 
 
-from interfaces.Interface import DatabaseInterface
+from collections import namedtuple
+from contextlib import closing
+import json
+import re
+import shutil
+import threading
+from time import perf_counter
+from urllib.parse import quote
 
-from typing import Dict, List, Tuple
+from interfaces.Interface import (changelog_schema, DatabaseInterface,
+                                  READONLY_CACHE_KIB, READONLY_MMAP_SIZE)
+
+from typing import Dict, Iterator, List, Tuple
 
 
 SCHEMA = [
@@ -47,14 +57,374 @@ CREATE TABLE IF NOT EXISTS filetype (
 """
 ]
 
+# MIGRATIONS[n] upgrades a catalog from schema version n to n + 1.
+# The version is kept in PRAGMA user_version; append, never edit. Objects
+# are created IF NOT EXISTS so that a step is harmless to repeat.
+MIGRATIONS = [
+[
+"""
+CREATE INDEX IF NOT EXISTS asset_name ON asset (name);
+""",
+"""
+CREATE INDEX IF NOT EXISTS asset_label ON asset (label);
+""",
+"""
+CREATE INDEX IF NOT EXISTS file_asset_filetype ON file (asset, filetype);
+""",
+"""
+CREATE INDEX IF NOT EXISTS file_digest ON file (digest);
+""",
+"""
+CREATE INDEX IF NOT EXISTS file_basename_dirname ON file (basename, dirname);
+""",
+"""
+CREATE INDEX IF NOT EXISTS label_name ON label (name);
+""",
+"""
+CREATE INDEX IF NOT EXISTS label_dirname ON label (dirname);
+""",
+"""
+CREATE INDEX IF NOT EXISTS filetype_name ON filetype (name);
+"""
+],
+# Summary statistics, kept current by triggers
+[
+"""
+CREATE TABLE IF NOT EXISTS summary (
+    id integer PRIMARY KEY CHECK (id = 1),
+    labels integer NOT NULL,
+    assets integer NOT NULL,
+    files integer NOT NULL,
+    bytes integer NOT NULL
+);
+""",
+"""
+CREATE TABLE IF NOT EXISTS label_stats (
+    label integer PRIMARY KEY,
+    assets integer NOT NULL
+) WITHOUT ROWID;
+""",
+"""
+CREATE TABLE IF NOT EXISTS asset_stats (
+    asset integer PRIMARY KEY,
+    files integer NOT NULL,
+    bytes integer NOT NULL
+) WITHOUT ROWID;
+""",
+"""
+CREATE TABLE IF NOT EXISTS filetype_stats (
+    filetype integer PRIMARY KEY,
+    files integer NOT NULL
+) WITHOUT ROWID;
+""",
+"""
+INSERT INTO summary (id, labels, assets, files, bytes)
+SELECT 1,
+       (SELECT COUNT(*) FROM label),
+       (SELECT COUNT(*) FROM asset),
+       (SELECT COUNT(*) FROM file),
+       (SELECT IFNULL(SUM(size), 0) FROM file);
+""",
+"""
+INSERT INTO label_stats (label, assets)
+SELECT label, COUNT(*) FROM asset GROUP BY label;
+""",
+"""
+INSERT INTO asset_stats (asset, files, bytes)
+SELECT asset.id, COUNT(file.id), IFNULL(SUM(file.size), 0)
+FROM asset LEFT JOIN file ON file.asset = asset.id
+GROUP BY asset.id;
+""",
+"""
+INSERT INTO filetype_stats (filetype, files)
+SELECT filetype, COUNT(*) FROM file WHERE filetype IS NOT NULL GROUP BY filetype;
+""",
+"""
+CREATE TRIGGER IF NOT EXISTS label_insert_stats AFTER INSERT ON label BEGIN
+    UPDATE summary SET labels = labels + 1;
+END;
+""",
+"""
+CREATE TRIGGER IF NOT EXISTS label_delete_stats AFTER DELETE ON label BEGIN
+    UPDATE summary SET labels = labels - 1;
+END;
+""",
+"""
+CREATE TRIGGER IF NOT EXISTS asset_insert_stats AFTER INSERT ON asset BEGIN
+    UPDATE summary SET assets = assets + 1;
+    INSERT INTO label_stats (label, assets) VALUES (NEW.label, 1)
+      ON CONFLICT (label) DO UPDATE SET assets = assets + 1;
+    INSERT INTO asset_stats (asset, files, bytes) VALUES (NEW.id, 0, 0)
+      ON CONFLICT (asset) DO NOTHING;
+END;
+""",
+"""
+CREATE TRIGGER IF NOT EXISTS asset_delete_stats AFTER DELETE ON asset BEGIN
+    UPDATE summary SET assets = assets - 1;
+    UPDATE label_stats SET assets = assets - 1 WHERE label = OLD.label;
+    DELETE FROM asset_stats WHERE asset = OLD.id;
+END;
+""",
+"""
+CREATE TRIGGER IF NOT EXISTS asset_label_stats AFTER UPDATE OF label ON asset BEGIN
+    UPDATE label_stats SET assets = assets - 1 WHERE label = OLD.label;
+    INSERT INTO label_stats (label, assets) VALUES (NEW.label, 1)
+      ON CONFLICT (label) DO UPDATE SET assets = assets + 1;
+END;
+""",
+"""
+CREATE TRIGGER IF NOT EXISTS file_insert_stats AFTER INSERT ON file BEGIN
+    UPDATE summary SET files = files + 1, bytes = bytes + IFNULL(NEW.size, 0);
+    INSERT INTO asset_stats (asset, files, bytes) VALUES (NEW.asset, 1, IFNULL(NEW.size, 0))
+      ON CONFLICT (asset) DO UPDATE SET files = files + 1,
+                                        bytes = bytes + IFNULL(NEW.size, 0);
+    INSERT INTO filetype_stats (filetype, files)
+      SELECT NEW.filetype, 1 WHERE NEW.filetype IS NOT NULL
+      ON CONFLICT (filetype) DO UPDATE SET files = files + 1;
+END;
+""",
+"""
+CREATE TRIGGER IF NOT EXISTS file_delete_stats AFTER DELETE ON file BEGIN
+    UPDATE summary SET files = files - 1, bytes = bytes - IFNULL(OLD.size, 0);
+    UPDATE asset_stats SET files = files - 1, bytes = bytes - IFNULL(OLD.size, 0)
+      WHERE asset = OLD.asset;
+    UPDATE filetype_stats SET files = files - 1 WHERE filetype = OLD.filetype;
+END;
+""",
+"""
+CREATE TRIGGER IF NOT EXISTS file_update_stats AFTER UPDATE OF asset, size, filetype ON file BEGIN
+    UPDATE summary SET bytes = bytes - IFNULL(OLD.size, 0) + IFNULL(NEW.size, 0);
+    UPDATE asset_stats SET files = files - 1, bytes = bytes - IFNULL(OLD.size, 0)
+      WHERE asset = OLD.asset;
+    INSERT INTO asset_stats (asset, files, bytes) VALUES (NEW.asset, 1, IFNULL(NEW.size, 0))
+      ON CONFLICT (asset) DO UPDATE SET files = files + 1,
+                                        bytes = bytes + IFNULL(NEW.size, 0);
+    UPDATE filetype_stats SET files = files - 1 WHERE filetype = OLD.filetype;
+    INSERT INTO filetype_stats (filetype, files)
+      SELECT NEW.filetype, 1 WHERE NEW.filetype IS NOT NULL
+      ON CONFLICT (filetype) DO UPDATE SET files = files + 1;
+END;
+"""
+],
+# Full-text search over asset and label names, and over file paths
+[
+"""
+CREATE VIRTUAL TABLE IF NOT EXISTS asset_fts USING fts5 (
+    name,
+    label,
+    prefix = '2 3',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+""",
+"""
+CREATE VIRTUAL TABLE IF NOT EXISTS file_fts USING fts5 (
+    basename,
+    dirname,
+    content = 'file',
+    content_rowid = 'id',
+    prefix = '2 3',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+""",
+"""
+INSERT INTO asset_fts (rowid, name, label)
+SELECT asset.id, asset.name, label.name FROM asset
+LEFT JOIN label ON label.id = asset.label;
+""",
+"""
+INSERT INTO file_fts (file_fts) VALUES ('rebuild');
+""",
+"""
+CREATE TRIGGER IF NOT EXISTS asset_insert_fts AFTER INSERT ON asset BEGIN
+    INSERT INTO asset_fts (rowid, name, label)
+    VALUES (NEW.id, NEW.name, (SELECT name FROM label WHERE id = NEW.label));
+END;
+""",
+"""
+CREATE TRIGGER IF NOT EXISTS asset_delete_fts AFTER DELETE ON asset BEGIN
+    DELETE FROM asset_fts WHERE rowid = OLD.id;
+END;
+""",
+"""
+CREATE TRIGGER IF NOT EXISTS asset_update_fts AFTER UPDATE OF name, label ON asset BEGIN
+    UPDATE asset_fts SET name = NEW.name,
+                         label = (SELECT name FROM label WHERE id = NEW.label)
+    WHERE rowid = NEW.id;
+END;
+""",
+"""
+CREATE TRIGGER IF NOT EXISTS label_update_fts AFTER UPDATE OF name ON label BEGIN
+    UPDATE asset_fts SET label = NEW.name
+    WHERE rowid IN (SELECT id FROM asset WHERE label = NEW.id);
+END;
+""",
+"""
+CREATE TRIGGER IF NOT EXISTS file_insert_fts AFTER INSERT ON file BEGIN
+    INSERT INTO file_fts (rowid, basename, dirname)
+    VALUES (NEW.id, NEW.basename, NEW.dirname);
+END;
+""",
+"""
+CREATE TRIGGER IF NOT EXISTS file_delete_fts AFTER DELETE ON file BEGIN
+    INSERT INTO file_fts (file_fts, rowid, basename, dirname)
+    VALUES ('delete', OLD.id, OLD.basename, OLD.dirname);
+END;
+""",
+"""
+CREATE TRIGGER IF NOT EXISTS file_update_fts AFTER UPDATE OF basename, dirname ON file BEGIN
+    INSERT INTO file_fts (file_fts, rowid, basename, dirname)
+    VALUES ('delete', OLD.id, OLD.basename, OLD.dirname);
+    INSERT INTO file_fts (rowid, basename, dirname)
+    VALUES (NEW.id, NEW.basename, NEW.dirname);
+END;
+"""
+],
+changelog_schema(["label", "filetype", "asset", "file"])
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+# Milliseconds a process waits on another migrating the same catalog
+MIGRATION_BUSY_TIMEOUT = 600000
+# Rows fetched per round trip by streaming iterators
+STREAM_ARRAYSIZE = 1000
+# Results returned per full-text search
+SEARCH_LIMIT = 50
+# Federated views, each a UNION ALL of one SELECT per attached catalog
+FEDERATED_VIEWS = {
+    "all_label": 'SELECT {name} AS catalog, id, name, dirname FROM "{schema}".label',
+    "all_asset": 'SELECT {name} AS catalog, id, name, label, managed FROM "{schema}".asset',
+    "all_file": 'SELECT {name} AS catalog, file.id, file.asset, file.basename,'\
+                ' file.dirname, file.size, filetype.name AS filetype, file.digest'\
+                ' FROM "{schema}".file'\
+                ' LEFT JOIN "{schema}".filetype ON filetype.id = file.filetype'
+}
+# Databases SQLite lets one connection attach, by default
+MAX_ATTACHED = 10
+# Bound parameters per IN (...) query, below SQLite's default limit of 999
+MAX_VARIABLES = 900
+# Columnar snapshots, (source table, query, [(column, dtype)]); see Columnar
+COLUMN_SNAPSHOTS = {
+    "label": ("label",
+              "SELECT id, name, dirname FROM label WHERE id > ? ORDER BY id;",
+              [("id", "int64"), ("name", "text"), ("dirname", "text")]),
+    "filetype": ("filetype",
+                 "SELECT id, name FROM filetype WHERE id > ? ORDER BY id;",
+                 [("id", "int64"), ("name", "text")]),
+    "asset": ("asset",
+              "SELECT id, name, label, managed FROM asset WHERE id > ? ORDER BY id;",
+              [("id", "int64"), ("name", "text"), ("label", "int64"), ("managed", "int8")]),
+    "file": ("file",
+             "SELECT id, asset, filetype, size, basename, dirname, digest FROM file"\
+             " WHERE id > ? ORDER BY id;",
+             [("id", "int64"), ("asset", "int64"), ("filetype", "int64"), ("size", "int64"),
+              ("basename", "text"), ("dirname", "text"), ("digest", "text")])
+}
+
+
+AssetRecord = namedtuple("AssetRecord", ["id", "name", "label", "managed"])
+FileRecord = namedtuple("FileRecord", ["id", "asset", "basename", "dirname",
+                                       "size", "filetype", "digest"])
+
+
+def chunked(ids: List, size=MAX_VARIABLES):
+    ids = list(ids)
+    for lower in range(0, len(ids), size):
+        yield ids[lower:lower + size]
+
 
 class ReadInterface(DatabaseInterface):
 
-    def __init__(self, dbpath="") -> None:
-        super().__init__(dbpath)
+    changelog_tables = ["label", "filetype", "asset", "file"]
+    column_snapshots = COLUMN_SNAPSHOTS
+
+    def __init__(self, dbpath="", readonly=False, immutable=False) -> None:
+        super().__init__(dbpath, readonly, immutable)
+        if self.readonly or not self.needs_schema("catalog"):
+            return
         for statement in SCHEMA:
             self.c.execute(statement)
         self.db.commit()
+        self.migrate()
+        self.schema_applied("catalog")
+
+    def schema_version(self) -> int:
+        self.c.execute("PRAGMA user_version;")
+        return self.c.fetchone()[0]
+
+    def migrate(self) -> int:
+        """
+        Applies each pending migration in its own transaction along with
+        its version bump. Returns the resulting schema version. Each step
+        takes the write lock before reading the version, so processes
+        opening the catalog at once apply every step exactly once.
+        """
+        if self.schema_version() >= SCHEMA_VERSION:
+            return self.schema_version()
+        self.db.commit()
+        self.c.execute("PRAGMA busy_timeout;")
+        busy_timeout = self.c.fetchone()[0]
+        self.c.execute(f"PRAGMA busy_timeout = {MIGRATION_BUSY_TIMEOUT};")
+        try:
+            while True:
+                self.c.execute("BEGIN IMMEDIATE;")
+                try:
+                    version = self.schema_version()
+                    if version >= SCHEMA_VERSION:
+                        break
+                    for statement in MIGRATIONS[version]:
+                        self.c.execute(statement)
+                    self.c.execute(f"PRAGMA user_version = {version + 1};")
+                except:
+                    self.db.rollback()
+                    raise
+                self.db.commit()
+            self.db.commit()
+        finally:
+            self.c.execute(f"PRAGMA busy_timeout = {busy_timeout};")
+        return self.schema_version()
+
+  # Streaming Iterators
+    def stream(self, query: str,
+                     args=(),
+                     record=None,
+                     arraysize=STREAM_ARRAYSIZE
+                     ) -> Iterator:
+        """
+        Yields the rows of <query>, fetched <arraysize> at a time on a cursor
+        of their own, as <record> namedtuples if given.
+        """
+        cursor = self.cursor()
+        cursor.arraysize = arraysize
+        if record:
+            cursor.row_factory = lambda _c, _r: record._make(_r)
+        try:
+            cursor.execute(query, args)
+            while rows := cursor.fetchmany():
+                yield from rows
+        finally:
+            cursor.close()
+
+    def iter_asset_ids(self, arraysize=STREAM_ARRAYSIZE) -> Iterator[int]:
+        for row in self.stream("SELECT id FROM asset ORDER BY id ASC;",
+                               arraysize=arraysize):
+            yield row[0]
+
+    def iter_asset_data(self, label_id=None,
+                              arraysize=STREAM_ARRAYSIZE
+                              ) -> Iterator[AssetRecord]:
+        if label_id is None:
+            return self.stream("SELECT * FROM asset ORDER BY id ASC;",
+                               record=AssetRecord, arraysize=arraysize)
+        return self.stream("SELECT * FROM asset WHERE label = ? ORDER BY id ASC;",
+                           (label_id,), AssetRecord, arraysize)
+
+    def iter_file_data(self, asset_id=None,
+                             arraysize=STREAM_ARRAYSIZE
+                             ) -> Iterator[FileRecord]:
+        if asset_id is None:
+            return self.stream("SELECT * FROM file ORDER BY id ASC;",
+                               record=FileRecord, arraysize=arraysize)
+        return self.stream("SELECT * FROM file WHERE asset = ? ORDER BY id ASC;",
+                           (asset_id,), FileRecord, arraysize)
 
   # Asset ID Methods
     def all_asset_ids(self) -> List[str]:
@@ -76,6 +446,21 @@ class ReadInterface(DatabaseInterface):
     def highest_asset_id(self) -> str:
         self.c.execute("SELECT id FROM asset ORDER BY id DESC LIMIT 1;")
         return self.c.fetchone()[0]
+
+    def changed_asset_ids(self, generation: int) -> List[int]:
+        """
+        Returns IDs of assets still in the catalog that were added or
+        updated, or had files added or updated, after <generation>.
+        """
+        self.c.execute("""
+        SELECT row_id FROM changelog
+          WHERE generation > ? AND tbl = 'asset' AND row_id IN (SELECT id FROM asset)
+        UNION
+        SELECT file.asset FROM changelog
+          JOIN file ON file.id = changelog.row_id
+          WHERE changelog.generation > ? AND changelog.tbl = 'file'
+        ORDER BY 1;""", (generation, generation))
+        return [_i[0] for _i in self.c.fetchall()]
         
   # File ID Methods
     def file_id_by_name(self, basename: str, dirname: str) -> str:
@@ -100,6 +485,24 @@ class ReadInterface(DatabaseInterface):
         self.c.execute("SELECT id FROM file WHERE digest = ?;", (digest,))
         return [_i[0] for _i in self.c.fetchall()]
 
+    def digested_files(self) -> List[Tuple]:
+        """Returns (digest, file_id, size) of every digested file, by digest."""
+        self.c.execute("SELECT digest, id, size FROM file"\
+                       "  WHERE digest IS NOT NULL ORDER BY digest ASC;")
+        return self.c.fetchall()
+
+    def duplicate_digests(self) -> Dict[str, List[int]]:
+        self.c.execute("""
+        SELECT digest, id FROM file
+        WHERE digest IN (SELECT digest FROM file WHERE digest IS NOT NULL
+                         GROUP BY digest HAVING COUNT(*) > 1)
+        ORDER BY digest ASC, id ASC
+        ;""")
+        duplicates = {}
+        for digest, file_id in self.c.fetchall():
+            duplicates.setdefault(digest, []).append(file_id)
+        return duplicates
+
   # Label ID Methods
     def label_id_by_name(self, name: str) -> str:
         self.c.execute("SELECT id FROM label WHERE name = ?;", (name,))
@@ -111,7 +514,6 @@ class ReadInterface(DatabaseInterface):
 
   #Asset Data
     def encode_asset_data(self, result: Tuple[str]) -> Dict:
-        print(result)
         return {
             "id": result[0],
             "name": result[1],
@@ -164,6 +566,68 @@ class ReadInterface(DatabaseInterface):
         result = self.c.fetchone()
         return f"{result[1]}/{result[0]}"
 
+  # Multi-ID Lookups
+    def rows_by_ids(self, query: str, ids: List) -> List[Tuple]:
+        """
+        Runs <query>, which ends in "IN ({})", once per chunk of <ids> and
+        returns all rows.
+        """
+        rows = []
+        for chunk in chunked(ids):
+            self.c.execute(query.format(",".join("?" * len(chunk))), chunk)
+            rows += self.c.fetchall()
+        return rows
+
+    def file_paths(self, file_ids: List[str]) -> Dict[int, str]:
+        rows = self.rows_by_ids("SELECT id, basename, dirname FROM file WHERE id IN ({});",
+                                file_ids)
+        return {_r[0]: f"{_r[2]}/{_r[1]}" for _r in rows}
+
+    def file_data_many(self, file_ids: List[str]) -> Dict[int, Dict]:
+        rows = self.rows_by_ids("SELECT * FROM file WHERE id IN ({});", file_ids)
+        return {_r[0]: self.encode_file_data(_r) for _r in rows}
+
+    def asset_data_many(self, asset_ids: List[str]) -> Dict[int, Dict]:
+        rows = self.rows_by_ids("SELECT * FROM asset WHERE id IN ({});", asset_ids)
+        return {_r[0]: self.encode_asset_data(_r) for _r in rows}
+
+    def cnames(self, asset_ids: List[str]) -> Dict[int, str]:
+        rows = self.rows_by_ids("SELECT id, name FROM asset WHERE id IN ({});", asset_ids)
+        return {_r[0]: _r[1] for _r in rows}
+
+  # Full-Text Search
+    def fts_query(self, text: str) -> str:
+        """
+        Converts free text to an FTS5 query matching every word of <text>,
+        the last as a prefix, so user input never hits FTS5 syntax.
+        """
+        words = re.findall(r"\w+", text)
+        if not words:
+            return ""
+        return " ".join([f'"{_w}"' for _w in words[:-1]] + [f'"{words[-1]}"*'])
+
+    def search_assets(self, text: str, limit=SEARCH_LIMIT) -> List[int]:
+        """Returns IDs of assets whose cname or label matches <text>, best first."""
+        query = self.fts_query(text)
+        if not query:
+            return []
+        self.c.execute("SELECT rowid FROM asset_fts WHERE asset_fts MATCH ?"\
+                       "  ORDER BY rank LIMIT ?;", (query, limit))
+        return [_r[0] for _r in self.c.fetchall()]
+
+    def search_files(self, text: str, limit=SEARCH_LIMIT) -> List[int]:
+        """Returns IDs of files whose basename or dirname matches <text>, best first."""
+        query = self.fts_query(text)
+        if not query:
+            return []
+        self.c.execute("SELECT rowid FROM file_fts WHERE file_fts MATCH ?"\
+                       "  ORDER BY rank LIMIT ?;", (query, limit))
+        return [_r[0] for _r in self.c.fetchall()]
+
+    def search(self, text: str, limit=SEARCH_LIMIT) -> Dict[str, List[int]]:
+        return {"assets": self.search_assets(text, limit),
+                "files": self.search_files(text, limit)}
+
   # Label Data
     def all_label_dirs(self) -> List[str]:
         self.c.execute("SELECT dirname FROM label")
@@ -214,37 +678,113 @@ class ReadInterface(DatabaseInterface):
         self.c.execute("SELECT * FROM label WHERE name = ?;", (name,))
         return bool(self.c.fetchone())
 
-  # Counts
+  # Counts, read from the trigger-maintained summary tables
     def count_labels(self) -> int:
-        self.c.execute("SELECT COUNT id FROM label;")
-        result = self.c.fetchone()[0]
-        return int(result) if result else 0
+        self.c.execute("SELECT labels FROM summary;")
+        result = self.c.fetchone()
+        return int(result[0]) if result else 0
 
     def count_assets(self) -> int:
-        self.c.execute("SELECT COUNT id FROM asset;")
-        result = self.c.fetchone()[0]
-        return int(result) if result else 0
+        self.c.execute("SELECT assets FROM summary;")
+        result = self.c.fetchone()
+        return int(result[0]) if result else 0
+
+    def count_files(self) -> int:
+        self.c.execute("SELECT files FROM summary;")
+        result = self.c.fetchone()
+        return int(result[0]) if result else 0
+
+    def total_bytes(self) -> int:
+        self.c.execute("SELECT bytes FROM summary;")
+        result = self.c.fetchone()
+        return int(result[0]) if result else 0
 
     def count_label_assets(self, label_id: int) -> int:
-        self.c.execute("SELECT COUNT if FROM asset WHERE label = ?;",
+        self.c.execute("SELECT assets FROM label_stats WHERE label = ?;",
                        (label_id,))
-        result = self.c.fetchone()[0]
-        return int(result) if result else 0
+        result = self.c.fetchone()
+        return int(result[0]) if result else 0
 
     def count_assets_by_labels(self) -> Dict[str, int]:
-        pass
+        self.c.execute("SELECT label.name, IFNULL(label_stats.assets, 0) FROM label"\
+                       "  LEFT JOIN label_stats ON label_stats.label = label.id;")
+        return {_r[0]: _r[1] for _r in self.c.fetchall()}
+
+    def asset_file_stats(self, asset_id: int) -> Tuple[int]:
+        """Returns (files, bytes) of an asset."""
+        self.c.execute("SELECT files, bytes FROM asset_stats WHERE asset = ?;",
+                       (asset_id,))
+        result = self.c.fetchone()
+        return (int(result[0]), int(result[1])) if result else (0, 0)
+
+    def count_files_by_filetypes(self) -> Dict[str, int]:
+        self.c.execute("SELECT filetype.name, filetype_stats.files FROM filetype_stats"\
+                       "  JOIN filetype ON filetype.id = filetype_stats.filetype;")
+        return {_r[0]: _r[1] for _r in self.c.fetchall()}
+
+class CnameCache:
+    """
+    Two-way map between asset IDs and cnames with O(1) lookups either way.
+    Names are held once, referenced from a list indexed by asset ID (IDs
+    are dense integer keys) and from a dict of name to ID.
+    """
+
+    def __init__(self) -> None:
+        self.names = []
+        self.ids = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def load(self, cursor, chunk_size=10000) -> "CnameCache":
+        """Adds (id, name) rows from <cursor>, which must be ordered by id."""
+        names, ids = self.names, self.ids
+        while rows := cursor.fetchmany(chunk_size):
+            if rows[-1][0] >= len(names):
+                names.extend([None] * (rows[-1][0] + 1 - len(names)))
+            for asset_id, cname in rows:
+                names[asset_id] = cname
+                ids[cname] = asset_id
+        return self
+
+    def add(self, asset_id: int, cname: str) -> None:
+        self.discard(asset_id)
+        if asset_id >= len(self.names):
+            self.names.extend([None] * (asset_id + 1 - len(self.names)))
+        self.names[asset_id] = cname
+        self.ids[cname] = asset_id
+
+    def discard(self, asset_id: int) -> None:
+        cname = self.name(asset_id)
+        if cname is not None:
+            self.names[asset_id] = None
+            if self.ids.get(cname) == asset_id:
+                del self.ids[cname]
+
+    def name(self, asset_id: int) -> str:
+        return self.names[asset_id] if 0 <= asset_id < len(self.names) else None
+
+    def asset_id(self, cname: str) -> int:
+        return self.ids.get(cname)
+
+    def asset_ids(self) -> List[int]:
+        return [_i for _i, _n in enumerate(self.names) if _n is not None]
+
+    def items(self) -> List[Tuple[int, str]]:
+        return [(_i, _n) for _i, _n in enumerate(self.names) if _n is not None]
+
 
 class CachedReadInterface(ReadInterface):
 
-    def __init__(self, dbpath="") -> None:
-        super().__init__(dbpath)
+    def __init__(self, dbpath="", readonly=False, immutable=False) -> None:
+        super().__init__(dbpath, readonly, immutable)
         self.filetype_cache = self.filetype_id_dicts()
         self.label_cache = self.label_id_dicts()
         self.cname_cache = self.initialize_cname_cache()
 
-    def initialize_cname_cache(self) -> Dict:
-        _data = self.all_asset_data()
-        return {_d["name"]: _d["id"] for _d in _data}
+    def initialize_cname_cache(self) -> CnameCache:
+        self.c.execute("SELECT id, name FROM asset ORDER BY id ASC;")
+        return CnameCache().load(self.c)
 
     def cached_filetype_id(self, ext: str) -> str:
         if ext not in self.filetype_cache.keys():
@@ -256,25 +796,31 @@ class CachedReadInterface(ReadInterface):
             self.label_cache[label] = self.label_id_by_name(label)
         return self.label_cache[label]
 
-    def cached_cname(self, asset_id: str) -> str:
-        if asset_id not in self.cname_cache.keys():
-            self.cname_cache[asset_id] = self.asset_data(asset_id)["name"]
-        return self.cname_cache[asset_id]
+    def cached_cname(self, asset_id: int) -> str:
+        cname = self.cname_cache.name(asset_id)
+        if cname is None:
+            cname = self.asset_data(asset_id)["name"]
+            self.cname_cache.add(asset_id, cname)
+        return cname
 
-    def list_asset_ids(self) -> List[str]:
-        return list(self.cname_cache.values())
+    def cached_asset_id(self, cname: str) -> int:
+        asset_id = self.cname_cache.asset_id(cname)
+        if asset_id is None:
+            asset_id = self.asset_id(cname)
+            self.cname_cache.add(asset_id, cname)
+        return asset_id
 
-    def list_asset_ids_cnames(self) -> List[Tuple[str]]:
-        return [(self.cname_cache[_k], _k) for _k in self.cname_cache.keys()]
+    def list_asset_ids(self) -> List[int]:
+        return self.cname_cache.asset_ids()
+
+    def list_asset_ids_cnames(self) -> List[Tuple]:
+        return self.cname_cache.items()
 
 
 class WriteInterface(CachedReadInterface):
 
     def __init__(self, dbpath="") -> None:
         super().__init__(dbpath)
-        for statement in SCHEMA:
-            self.c.execute(statement)
-        self.db.commit()
 
     def new_asset(self, cname: str, 
                         label_id: str,
@@ -307,6 +853,79 @@ class WriteInterface(CachedReadInterface):
             self.db.commit()
         return True
 
+    def new_files(self, asset_id: int,
+                        file_data: Dict[str, Dict],
+                        finalize=False
+                        ) -> int:
+        """
+        Inserts every file of an asset's survey <file_data>, as produced by
+        Inventory.survey_asset_files, with one executemany. Unknown filetypes
+        are added first. Returns the number of files inserted.
+        """
+        self.resolve_filetypes({_d["filetype"] for _d in file_data.values()})
+        rows = [(asset_id,
+                 _d["basename"],
+                 _d["dirname"],
+                 _d["size"],
+                 self.filetype_cache[_d["filetype"].lower()] if _d["filetype"] else None,
+                 _d.get("digest"))
+                for _d in file_data.values()]
+        self.c.executemany("INSERT INTO file (asset, basename, dirname, size, filetype,"\
+                           " digest) VALUES (?,?,?,?,?,?);", rows)
+        if finalize:
+            self.db.commit()
+        return len(rows)
+
+    def resolve_filetypes(self, exts: List[str]) -> Dict[str, int]:
+        """Adds any of <exts> missing from filetype and refreshes the filetype cache."""
+        missing = {_e.lower() for _e in exts if _e} - self.filetype_cache.keys()
+        if missing:
+            self.c.executemany("INSERT INTO filetype (name) VALUES (?);",
+                               [(_e,) for _e in sorted(missing)])
+            self.filetype_cache = self.filetype_id_dicts()
+        return self.filetype_cache
+
+    def ingest_asset(self, cname: str,
+                           label_id: int,
+                           file_data: Dict[str, Dict],
+                           managed=1,
+                           finalize=True
+                           ) -> int:
+        """
+        Adds an asset with all of its files in a single transaction.
+        Returns the number of files inserted.
+        """
+        self.new_asset(cname, label_id, managed)
+        asset_id = self.c.lastrowid
+        self.cname_cache.add(asset_id, cname)
+        count = self.new_files(asset_id, file_data)
+        if finalize:
+            self.db.commit()
+        return count
+
+    def ingest_survey_dir(self, survey_path: str, label_id: int, managed=1) -> Dict:
+        """
+        Ingests every <cname>.json survey written by AsyncSurvey in
+        <survey_path> under <label_id> in a single transaction, skipping
+        assets already in the catalog.
+        """
+        timestamp = perf_counter()
+        assets, files = 0, 0
+        for fname in sorted(shutil.os.listdir(survey_path)):
+            cname = fname[:-len(".json")]
+            if not fname.endswith(".json") or self.asset_exists(cname):
+                continue
+            with closing(open(f"{survey_path}/{fname}", "r")) as _f:
+                file_data = json.loads(_f.read())
+            files += self.ingest_asset(cname, label_id, file_data, managed, finalize=False)
+            assets += 1
+        self.db.commit()
+        seconds = perf_counter() - timestamp
+        return {"assets": assets,
+                "files": files,
+                "seconds": seconds,
+                "rows_per_second": (assets + files) / seconds if seconds else 0.0}
+
     def new_label(self, name: str, dirname: str) -> bool:
         self.c.execute("INSERT INTO label (name, dirname) VALUES (?, ?);",
                        (name, dirname))
@@ -322,6 +941,7 @@ class WriteInterface(CachedReadInterface):
     def update_asset_name(self, asset_id: str, new_name: str) -> bool:
         self.c.execute("UPDATE asset SET name = ? WHERE id = ?;",
                        (new_name, asset_id))
+        self.cname_cache.add(asset_id, new_name)
         return True
     
     def update_asset_label(self, asset_id: str, new_label: int) -> bool:
@@ -330,14 +950,23 @@ class WriteInterface(CachedReadInterface):
         self.db.commit()
         return True
     
+    def update_digests(self, digests: Dict[int, str], finalize=True) -> bool:
+        """Sets the digest of each file ID in <digests> with one executemany."""
+        self.c.executemany("UPDATE file SET digest = ? WHERE id = ?;",
+                           [(_d, _id) for _id, _d in digests.items()])
+        if finalize:
+            self.db.commit()
+        return True
+
     def remove_asset(self, asset_id: str) -> bool:
         self.c.execute("DELETE FROM asset WHERE id = ?;",
                        (asset_id,))
         self.db.commit()
+        self.cname_cache.discard(asset_id)
         return True
     
     def remove_file(self, file_id: str) -> bool:
-        self.c.execute("DELETE FROM asset WHERE id = ?;",
+        self.c.execute("DELETE FROM file WHERE id = ?;",
                        (file_id,))
         self.db.commit()
         return True
@@ -347,3 +976,69 @@ class WriteInterface(CachedReadInterface):
                        (asset_id, fname.lower()))
         self.db.commit()
         return True
+
+
+class FederatedReadInterface(DatabaseInterface):
+    """
+    Read-only view across catalogs. Each replica in <catalog_paths>
+    ({catalog name: path}) is ATTACHed, read-only, to a private in-memory
+    connection, and the temporary views all_label, all_asset and all_file
+    union them with a leading catalog column, so cross-catalog questions
+    run as single statements inside SQLite. Filetypes are resolved to
+    names in all_file, as their IDs differ between catalogs. At most
+    MAX_ATTACHED catalogs can be federated.
+    """
+
+    def __init__(self, catalog_paths: Dict[str, str]) -> None:
+        if len(catalog_paths) > MAX_ATTACHED:
+            raise ValueError(f"{len(catalog_paths)} catalogs given; SQLite attaches"\
+                             f" at most {MAX_ATTACHED} databases to a connection")
+        self.catalog_paths = dict(catalog_paths)
+        super().__init__(":memory:")
+
+    def handle(self) -> tuple:
+        if threading.current_thread() in self.handles:
+            return self.handles[threading.current_thread()]
+        handle = super().handle()
+        self.attach_catalogs(handle[1])
+        return handle
+
+    def attach_catalogs(self, db) -> None:
+        for _i, path in enumerate(self.catalog_paths.values()):
+            db.execute("ATTACH DATABASE ? AS ?;",
+                       (f"file:{quote(path)}?mode=ro", f"catalog{_i}"))
+            db.execute(f"PRAGMA catalog{_i}.mmap_size = {READONLY_MMAP_SIZE};")
+            db.execute(f"PRAGMA catalog{_i}.cache_size = -{READONLY_CACHE_KIB};")
+        for view, select in FEDERATED_VIEWS.items():
+            selects = [select.format(name=self.quote_literal(_c), schema=f"catalog{_i}")
+                       for _i, _c in enumerate(self.catalog_paths.keys())]
+            db.execute(f"CREATE TEMP VIEW {view} AS {' UNION ALL '.join(selects)};")
+
+    def quote_literal(self, value: str) -> str:
+        return "'" + value.replace("'", "''") + "'"
+
+    def query(self, query: str, args=()) -> List[Tuple]:
+        self.c.execute(query, args)
+        return self.c.fetchall()
+
+    def shared_cnames(self) -> Dict[str, List[str]]:
+        """Returns cnames present in more than one catalog, with their catalogs."""
+        self.c.execute("""
+        SELECT name, GROUP_CONCAT(catalog, char(31)) FROM
+            (SELECT DISTINCT name, catalog FROM all_asset)
+        GROUP BY name HAVING COUNT(*) > 1
+        ORDER BY name ASC
+        ;""")
+        return {_r[0]: sorted(_r[1].split(chr(31))) for _r in self.c.fetchall()}
+
+    def files_by_type(self, ext: str, min_size=0) -> List[Tuple]:
+        """Returns (catalog, file_id, size) of files of type <ext> above <min_size> bytes."""
+        self.c.execute("SELECT catalog, id, size FROM all_file"\
+                       "  WHERE filetype = ? AND size > ?"\
+                       "  ORDER BY catalog ASC, id ASC;",
+                       (ext.lower(), min_size))
+        return self.c.fetchall()
+
+    def count_assets_by_catalogs(self) -> Dict[str, int]:
+        self.c.execute("SELECT catalog, COUNT(*) FROM all_asset GROUP BY catalog;")
+        return {_r[0]: _r[1] for _r in self.c.fetchall()}
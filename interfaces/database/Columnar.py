@@ -0,0 +1,250 @@
+import io
+import json
+import shutil
+import numpy as np
+
+from uuid import uuid4
+
+from interfaces.Interface import DatabaseInterface
+
+from typing import Dict, List, Tuple
+
+
+# Rows read from SQLite and appended to the column files per chunk
+EXPORT_CHUNK_SIZE = 100000
+MANIFEST = "manifest.json"
+# NULL integers are exported as this; IDs and sizes are never negative
+NULL_INTEGER = -1
+
+
+def append_npy(path: str, array: np.ndarray) -> int:
+    """
+    Appends <array> along axis 0 to the .npy file at <path>, creating it if
+    missing, and returns the resulting row count. The header is rewritten
+    in place; numpy pads headers so that the row count can grow.
+    """
+    if not shutil.os.path.exists(path):
+        np.save(path, array)
+        return len(array)
+    with open(path, "r+b") as f:
+        np.lib.format.read_magic(f)
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        header_length = f.tell()
+        if fortran_order or dtype != array.dtype or shape[1:] != array.shape[1:]:
+            raise ValueError(f"{path} does not hold {array.dtype} rows of {array.shape[1:]}")
+        shape = (shape[0] + len(array),) + shape[1:]
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(header, {"descr": np.lib.format.dtype_to_descr(dtype),
+                                                      "fortran_order": False,
+                                                      "shape": shape})
+        if len(header.getvalue()) != header_length:
+            raise ValueError(f"{path} header cannot grow in place")
+        f.seek(0, 2)
+        f.write(np.ascontiguousarray(array).tobytes())
+        f.seek(0)
+        f.write(header.getvalue())
+    return shape[0]
+
+
+class TextColumn:
+    """
+    Strings stored as one uint8 array of UTF-8 bytes plus int64 offsets, so
+    that row i is blob[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray) -> None:
+        self.blob, self.offsets = blob, offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row: int) -> str:
+        return bytes(self.blob[self.offsets[row]:self.offsets[row + 1]]).decode()
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @classmethod
+    def encode(cls, strings: List[str], start=0) -> Tuple[np.ndarray]:
+        """Returns (blob, offsets) for <strings>, offsets beginning after <start>."""
+        encoded = [(_s or "").encode() for _s in strings]
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return (blob, start + np.cumsum(lengths))
+
+
+def encode_column(values: List[Tuple], first: int, width: int, dtype: str) -> np.ndarray:
+    """Returns query columns first to first + width of <values> as an array."""
+    if width > 1:
+        return np.array(list(zip(*values[first:first + width])),
+                        dtype=dtype).reshape(-1, width)
+    values = values[first]
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        return np.fromiter((NULL_INTEGER if _v is None else _v for _v in values),
+                           dtype=dtype, count=len(values))
+    return np.array(values, dtype=dtype)
+
+def column_specs(snapshot: Tuple) -> List[Tuple]:
+    """Returns (column, dtype, width, first query column) for a snapshot definition."""
+    specs, first = [], 0
+    for column in snapshot[2]:
+        name, dtype, width = (tuple(column) + (1,))[:3]
+        specs.append((name, dtype, width, first))
+        first += width
+    return specs
+
+
+class ColumnarSnapshot:
+    """
+    Exports the column_snapshots of <interface> to <directory> as .npy
+    column files that readers memory-map with load_columns(). Each snapshot
+    is (source table, query, [(column, dtype[, width])]): the query selects
+    rows with id > ? in id order, id first; width > 1 packs that many query
+    columns into an N x width matrix; "text" columns are stored as
+    TextColumns. Changes are found through the interface's change log, so a
+    refresh appends new rows when only rows past the last export changed,
+    and otherwise rewrites the snapshot into a fresh directory. The manifest
+    is replaced last, and readers only see the rows it records.
+    """
+
+    def __init__(self, interface: DatabaseInterface, directory: str) -> None:
+        self.interface = interface
+        self.directory = directory
+        shutil.os.makedirs(directory, exist_ok=True)
+        self.manifest = load_manifest(directory)
+        self.stale_paths = []
+
+    def refresh(self) -> Dict[str, str]:
+        """Brings every snapshot up to date. Returns {snapshot: action taken}."""
+        interface = self.interface
+        interface.commit()
+        interface.c.execute("BEGIN;")
+        try:
+            generation = interface.generation()
+            since = self.manifest.get("generation", 0)
+            if since > generation:
+                since = 0
+            changes = interface.changes_since(since) if since else []
+            actions = {}
+            for name, snapshot in interface.column_snapshots.items():
+                entry = self.manifest["snapshots"].get(name)
+                if not entry or not since or not self.files_consistent(entry):
+                    actions[name] = self.rewrite(name, snapshot, generation)
+                    continue
+                row_ids = [_c[2] for _c in changes if _c[1] == snapshot[0]]
+                if not row_ids:
+                    actions[name] = "unchanged"
+                elif min(row_ids) > entry["last_id"]:
+                    actions[name] = self.append(name, snapshot, entry)
+                else:
+                    actions[name] = self.rewrite(name, snapshot, generation)
+        finally:
+            interface.commit()
+        self.manifest["generation"] = generation
+        self.save_manifest()
+        return actions
+
+    def files_consistent(self, entry: Dict) -> bool:
+        """
+        Returns whether every column file of <entry> holds exactly the rows
+        recorded in the manifest, as an interrupted append leaves more.
+        """
+        path, rows = f"{self.directory}/{entry['path']}", entry["rows"]
+        try:
+            for column, spec in entry["columns"].items():
+                if spec["dtype"] == "text":
+                    offsets = np.load(f"{path}/{column}.offsets.npy", mmap_mode="r")
+                    blob = np.load(f"{path}/{column}.npy", mmap_mode="r")
+                    if len(offsets) != rows + 1 or len(blob) != offsets[-1]:
+                        return False
+                elif len(np.load(f"{path}/{column}.npy", mmap_mode="r")) != rows:
+                    return False
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def rewrite(self, name: str, snapshot: Tuple, generation: int) -> str:
+        """
+        Exports the snapshot into a new directory. The directory the manifest
+        points to is only removed by save_manifest(), once it no longer does.
+        """
+        old_entry = self.manifest["snapshots"].get(name)
+        entry = {"path": f"{name}-{generation}-{uuid4().hex[:8]}",
+                 "rows": 0,
+                 "last_id": 0,
+                 "columns": {_n: {"dtype": _d, "width": _w}
+                             for _n, _d, _w, _ in column_specs(snapshot)}}
+        path = f"{self.directory}/{entry['path']}"
+        shutil.os.makedirs(path)
+        for column, dtype, width, _ in column_specs(snapshot):
+            if dtype == "text":
+                np.save(f"{path}/{column}.npy", np.empty(0, dtype=np.uint8))
+                np.save(f"{path}/{column}.offsets.npy", np.zeros(1, dtype=np.int64))
+            else:
+                shape = (0, width) if width > 1 else (0,)
+                np.save(f"{path}/{column}.npy", np.empty(shape, dtype=dtype))
+        self.append(name, snapshot, entry)
+        self.manifest["snapshots"][name] = entry
+        if old_entry:
+            self.stale_paths.append(old_entry["path"])
+        return "rewritten"
+
+    def append(self, name: str, snapshot: Tuple, entry: Dict) -> str:
+        """Appends rows with IDs past entry["last_id"] to the snapshot's files."""
+        path = f"{self.directory}/{entry['path']}"
+        specs = column_specs(snapshot)
+        cursor = self.interface.cursor()
+        cursor.arraysize = EXPORT_CHUNK_SIZE
+        try:
+            cursor.execute(snapshot[1], (entry["last_id"],))
+            while rows := cursor.fetchmany():
+                values = list(zip(*rows))
+                for column, dtype, width, first in specs:
+                    if dtype == "text":
+                        offsets = np.load(f"{path}/{column}.offsets.npy", mmap_mode="r")
+                        blob, offsets = TextColumn.encode(values[first], int(offsets[-1]))
+                        append_npy(f"{path}/{column}.npy", blob)
+                        append_npy(f"{path}/{column}.offsets.npy", offsets)
+                    else:
+                        append_npy(f"{path}/{column}.npy",
+                                   encode_column(values, first, width, dtype))
+                entry["rows"] += len(rows)
+                entry["last_id"] = rows[-1][0]
+        finally:
+            cursor.close()
+        return "appended"
+
+    def save_manifest(self) -> None:
+        tmp_path = f"{self.directory}/{MANIFEST}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        shutil.os.replace(tmp_path, f"{self.directory}/{MANIFEST}")
+        for stale_path in self.stale_paths:
+            shutil.rmtree(f"{self.directory}/{stale_path}", ignore_errors=True)
+        self.stale_paths = []
+
+
+def load_manifest(directory: str) -> Dict:
+    try:
+        with open(f"{directory}/{MANIFEST}") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"generation": 0, "snapshots": {}}
+
+def load_columns(directory: str, name="", entry=None, mmap_mode="r") -> Dict:
+    """
+    Returns {column: array} of snapshot <name> in <directory>, memory-mapped
+    and, once loaded, independent of later refreshes. Text columns are
+    TextColumns. Rows appended after the manifest was written are left out.
+    """
+    entry = entry if entry else load_manifest(directory)["snapshots"][name]
+    path, rows = f"{directory}/{entry['path']}", entry["rows"]
+    columns = {}
+    for column, spec in entry["columns"].items():
+        data = np.load(f"{path}/{column}.npy", mmap_mode=mmap_mode)
+        if spec["dtype"] == "text":
+            offsets = np.load(f"{path}/{column}.offsets.npy", mmap_mode=mmap_mode)
+            columns[column] = TextColumn(data[:offsets[rows]], offsets[:rows + 1])
+        else:
+            columns[column] = data[:rows]
+    return columns
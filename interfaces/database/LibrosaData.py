@@ -1,9 +1,10 @@
 
+import numpy as np
 from numpy import save as np_save
 
 from typing import Dict, List, Tuple
 
-from interfaces.Interface import DatabaseInterface
+from interfaces.Interface import changelog_schema, DatabaseInterface
 
 SCHEMA = [
 """
@@ -61,17 +62,53 @@ VALUES
   (4, 'beat_frames')
 ;
 """
-]
+] + changelog_schema(["audiodata", "chromadistribution", "log"])
+# Columnar snapshots, (source table, query, [(column, dtype[, width])]); see
+# interfaces.database.Columnar
+COLUMN_SNAPSHOTS = {
+    "chroma": ("chromadistribution",
+               "SELECT id, catalog, file, c01, c02, c03, c04, c05, c06, c07, c08, c09, c10,"\
+               " c11, c12 FROM chromadistribution WHERE id > ? ORDER BY id;",
+               [("id", "int64"), ("catalog", "text"), ("file", "int64"),
+                ("chroma", "float32", 12)]),
+    "duration": ("audiodata",
+                 "SELECT id, catalog, file, CAST(datavalue AS REAL) FROM audiodata"\
+                 " WHERE id > ? AND datatype = 1 ORDER BY id;",
+                 [("id", "int64"), ("catalog", "text"), ("file", "int64"),
+                  ("duration", "float64")]),
+    "tempo": ("audiodata",
+              "SELECT id, catalog, file, CAST(datavalue AS REAL) FROM audiodata"\
+              " WHERE id > ? AND datatype = 2 ORDER BY id;",
+              [("id", "int64"), ("catalog", "text"), ("file", "int64"),
+               ("tempo", "float64")])
+}
+
+
+def chroma_arrays(cdists: Dict[int, Tuple]) -> Tuple[np.ndarray]:
+    """
+    Returns (file_ids, matrix) for {file: chroma distribution}, dropping
+    distributions containing NaN.
+    """
+    file_ids = np.fromiter(cdists.keys(), dtype=np.int64, count=len(cdists))
+    matrix = np.array(list(cdists.values()), dtype=np.float32).reshape(-1, 12)
+    valid = ~np.isnan(matrix).any(axis=1)
+    return (file_ids[valid], matrix[valid])
 
 
 class DataInterface(DatabaseInterface):
 
-    def __init__(self, dbpath=""):
-        super().__init__(dbpath)
+    changelog_tables = ["audiodata", "chromadistribution", "log"]
+    column_snapshots = COLUMN_SNAPSHOTS
+
+    def __init__(self, dbpath="", readonly=False, immutable=False):
+        super().__init__(dbpath, readonly, immutable)
+        self.dtype_ids = {}
+        if self.readonly or not self.needs_schema("librosa_data"):
+            return
         for statement in SCHEMA:
             self.c.execute(statement)
         self.db.commit()
-        self.dtype_ids = {}
+        self.schema_applied("librosa_data")
         
     def record_results(self, task: Dict) -> bool:
         catalog = task["catalog"]
@@ -212,6 +249,65 @@ class DataInterface(DatabaseInterface):
         self.c.execute(query, arguments)
         return {_i[2]: _i[3:] for _i in self.c.fetchall()}
 
+    def max_chroma_id(self, catalog) -> int:
+        self.c.execute("SELECT MAX(id) FROM chromadistribution WHERE catalog = ?;",
+                       (catalog,))
+        result = self.c.fetchone()[0]
+        return int(result) if result else 0
+
+    def chroma_file_ids_between(self, catalog, lower_id: int, upper_id: int) -> List[int]:
+        """Returns IDs of files whose chroma distribution ID is in (lower_id, upper_id]."""
+        self.c.execute("""
+        SELECT file FROM chromadistribution
+        WHERE catalog = ? AND id > ? AND id <= ?
+        ORDER BY file ASC
+        ;""", (catalog, lower_id, upper_id))
+        return [_i[0] for _i in self.c.fetchall()]
+
+    def chroma_changed_since(self, generation: int) -> bool:
+        """Returns whether any chroma distribution changed after change log <generation>."""
+        self.c.execute("SELECT EXISTS (SELECT 1 FROM changelog"\
+                       "  WHERE generation > ? AND tbl = 'chromadistribution');",
+                       (generation,))
+        return bool(self.c.fetchone()[0])
+
+    def chroma_catalogs(self) -> List[str]:
+        self.c.execute("SELECT DISTINCT catalog FROM chromadistribution;")
+        return [_i[0] for _i in self.c.fetchall()]
+
+    def chroma_distribution(self, catalog, file_id) -> Tuple[float]:
+        self.c.execute("SELECT * FROM chromadistribution WHERE catalog = ? AND file = ?;",
+                       (catalog, file_id))
+        result = self.c.fetchone()
+        return result[3:] if result else ()
+
+    def chroma_matrix(self, catalog, lbound=0, ubound=0) -> Tuple[np.ndarray]:
+        """
+        Returns (file_ids, matrix) where file_ids is a sorted int64 array and
+        matrix is the N x 12 float32 array of their chroma distributions.
+        Distributions containing NaN are dropped.
+        """
+        return chroma_arrays(self.all_chroma_distributions(catalog, lbound, ubound))
+
+    def versioned_chroma_matrix(self, catalog, until=0) -> Tuple:
+        """
+        Returns (chroma_id, file_ids, matrix): the chroma_matrix() of a
+        catalog and the largest chromadistribution ID it includes, read in a
+        single transaction. With <until>, distributions added after that ID
+        are left out, so that a resumed run sees the matrix it started with.
+        """
+        self.db.commit()
+        self.c.execute("BEGIN;")
+        try:
+            chroma_id = until if until else self.max_chroma_id(catalog)
+            self.c.execute("SELECT * FROM chromadistribution WHERE catalog = ? AND id <= ?"\
+                           " ORDER BY file ASC, id ASC;",
+                           (catalog, chroma_id))
+            cdists = {_i[2]: _i[3:] for _i in self.c.fetchall()}
+        finally:
+            self.db.commit()
+        return (chroma_id,) + chroma_arrays(cdists)
+
 
 
         
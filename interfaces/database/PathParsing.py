@@ -20,6 +20,12 @@ CREATE TABLE IF NOT EXISTS log (
     asset integer NOT NULL,
     catalog text NOT NULL
 );
+""",
+"""
+CREATE INDEX IF NOT EXISTS data_file ON data (file, catalog);
+""",
+"""
+CREATE INDEX IF NOT EXISTS log_asset ON log (asset, catalog);
 """
 ]
 
@@ -62,6 +68,19 @@ class Interface(DatabaseInterface):
             self.db.commit()
         return True
 
+    def remove_asset_parse(self, asset_id: str,
+                                 file_ids: List[str],
+                                 catalog: str,
+                                 finalize=False
+                                 ) -> bool:
+        self.c.executemany("DELETE FROM data WHERE file = ? AND catalog = ?;",
+                           [(_fid, catalog) for _fid in file_ids])
+        self.c.execute("DELETE FROM log WHERE asset = ? AND catalog = ?;",
+                       (asset_id, catalog))
+        if finalize:
+            self.db.commit()
+        return True
+
     def parsed_asset_ids(self, catalog: str) -> List[str]:
         self.c.execute("SELECT DISTINCT asset FROM log WHERE catalog = ?;",
                        (catalog,))
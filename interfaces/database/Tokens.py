@@ -19,6 +19,9 @@ CREATE TABLE IF NOT EXISTS filepathtokens (
     catalog text
 );
 """,
+"""
+CREATE INDEX IF NOT EXISTS filepathtokens_file ON filepathtokens (file, catalog);
+""",
 ]
 CACHE_SIZE = 5000000
 
@@ -26,8 +29,10 @@ class TokensInterface(DatabaseInterface):
 
     def __init__(self, dbpath="") -> None:
         super().__init__(dbpath)
-        for statement in SCHEMA:
-            self.c.execute(statement)
+        if self.needs_schema("tokens"):
+            for statement in SCHEMA:
+                self.c.execute(statement)
+            self.schema_applied("tokens")
         self.cache = LRUCache(maxsize=CACHE_SIZE)
         self.populate_token_id_cache()
 
@@ -69,6 +74,16 @@ class TokensInterface(DatabaseInterface):
             self.db.commit()
         return True
     
+    def remove_file_tokens(self, file_ids: List[str],
+                                 app_key: str,
+                                 finalize=False
+                                 ) -> bool:
+        self.c.executemany("DELETE FROM filepathtokens WHERE file = ? AND catalog = ?;",
+                           [(_fid, app_key) for _fid in file_ids])
+        if finalize:
+            self.db.commit()
+        return True
+
     def token(self, token_id: str) -> str:
         self.c.execute("SELECT value FROM token WHERE id = ?;", (token_id,))
         result = self.c.fetchone()
@@ -180,6 +195,12 @@ class TokensInterface(DatabaseInterface):
                        (token_id, catalog))
         return int(self.c.fetchone()[0])
 
+    def n_occurrences_by_token(self, catalog: str) -> Dict[int, int]:
+        self.c.execute("SELECT token, COUNT(id) FROM filepathtokens"\
+                       "  WHERE catalog = ? GROUP BY token;",
+                       (catalog,))
+        return {_r[0]: _r[1] for _r in self.c.fetchall()}
+
     def n_occurrences_in_files(self, token_id: str,
                                      file_ids: List[str],
                                      catalog: str
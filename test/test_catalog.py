@@ -0,0 +1,348 @@
+import json
+import multiprocessing
+import sqlite3
+import threading
+import pytest
+
+from interfaces.database.Catalog import (MIGRATIONS,
+                                         SCHEMA,
+                                         CachedReadInterface,
+                                         CnameCache,
+                                         FederatedReadInterface,
+                                         SCHEMA_VERSION,
+                                         AssetRecord,
+                                         FileRecord,
+                                         ReadInterface,
+                                         WriteInterface)
+
+
+@pytest.fixture
+def catalog_path(tmp_path):
+    return str(tmp_path / "Catalog.sqlite")
+
+def query_plan(interface, query, args=()):
+    interface.c.execute(f"EXPLAIN QUERY PLAN {query}", args)
+    return " ".join([_r[-1] for _r in interface.c.fetchall()])
+
+def test_new_catalog_is_current(catalog_path):
+    catalog = WriteInterface(catalog_path)
+    assert catalog.schema_version() == SCHEMA_VERSION == len(MIGRATIONS)
+
+def test_unversioned_catalog_upgrades_in_place(catalog_path):
+    db = sqlite3.connect(catalog_path)
+    for statement in SCHEMA:
+        db.execute(statement)
+    db.execute("INSERT INTO label (name, dirname) VALUES ('label', '/label');")
+    db.execute("INSERT INTO asset (name, label, managed) VALUES ('cname', 1, 1);")
+    db.commit()
+    db.close()
+    catalog = ReadInterface(catalog_path)
+    assert catalog.schema_version() == SCHEMA_VERSION
+    assert catalog.asset_id("cname") == 1
+    assert ReadInterface(catalog_path).migrate() == SCHEMA_VERSION
+
+def open_catalog(catalog_path):
+    ReadInterface(catalog_path)
+
+def test_concurrent_upgrades_migrate_once(catalog_path):
+    db = sqlite3.connect(catalog_path)
+    for statement in SCHEMA:
+        db.execute(statement)
+    db.execute("INSERT INTO label (name, dirname) VALUES ('label', '/label');")
+    db.execute("INSERT INTO asset (name, label, managed) VALUES ('cname', 1, 1);")
+    db.executemany("INSERT INTO file (asset, basename, dirname, size) VALUES (1, ?, '/', 1);",
+                   [(f"{_i}.flac",) for _i in range(20000)])
+    db.commit()
+    db.close()
+    processes = [multiprocessing.Process(target=open_catalog, args=(catalog_path,))
+                 for _i in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [_p.exitcode for _p in processes] == [0] * 4
+    catalog = ReadInterface(catalog_path)
+    assert catalog.schema_version() == SCHEMA_VERSION
+    assert catalog.c.execute("SELECT files FROM summary;").fetchall() == [(20000,)]
+    assert catalog.c.execute("SELECT files FROM asset_stats;").fetchall() == [(20000,)]
+
+@pytest.mark.parametrize("query,args,index", [
+    ("SELECT id FROM asset WHERE name = ?;", ("cname",), "asset_name"),
+    ("SELECT id FROM asset WHERE label = ?;", (1,), "asset_label"),
+    ("SELECT * FROM file WHERE asset = ? AND filetype = ?;", (1, 1), "file_asset_filetype"),
+    ("SELECT id FROM file WHERE digest = ?;", ("digest",), "file_digest"),
+    ("SELECT id FROM label WHERE dirname = ?;", ("/label",), "label_dirname"),
+    ("SELECT id FROM filetype WHERE name = ?;", ("flac",), "filetype_name"),
+])
+def test_hot_queries_use_indexes(query, args, index, catalog_path):
+    assert index in query_plan(ReadInterface(catalog_path), query, args)
+
+def survey(n_files, exts=("flac", "CUE", "")):
+    return {f"/CD1/{_i:04}.{exts[_i % len(exts)]}": {
+                "basename": f"{_i:04}.{exts[_i % len(exts)]}",
+                "dirname": "/CD1",
+                "size": _i,
+                "filetype": exts[_i % len(exts)]}
+            for _i in range(n_files)}
+
+def test_ingest_asset(catalog_path):
+    catalog = WriteInterface(catalog_path)
+    catalog.new_label("label", "/label")
+    assert catalog.ingest_asset("cname", 1, survey(30)) == 30
+    asset_id = catalog.asset_id("cname")
+    assert len(catalog.file_ids_by_asset(asset_id)) == 30
+    flac = catalog.file_data_by_asset_and_type(asset_id, catalog.filetype_id("flac"))
+    assert len(flac) == 10
+    assert len(catalog.file_data_by_asset_and_type(asset_id, catalog.filetype_id("cue"))) == 10
+    assert catalog.filetype_id_dicts().keys() == {"flac", "cue"}
+
+def test_ingest_survey_dir(catalog_path, tmp_path):
+    survey_path = tmp_path / "survey"
+    survey_path.mkdir()
+    for cname, n_files in [("a", 5), ("b", 7)]:
+        (survey_path / f"{cname}.json").write_text(json.dumps(survey(n_files)))
+    catalog = WriteInterface(catalog_path)
+    catalog.new_label("label", "/label")
+    catalog.ingest_asset("a", 1, survey(5))
+    stats = catalog.ingest_survey_dir(str(survey_path), 1)
+    assert (stats["assets"], stats["files"]) == (1, 7)
+    assert stats["rows_per_second"] > 0
+    assert len(WriteInterface(catalog_path).all_asset_ids()) == 2
+
+def test_readonly_catalog_replica(catalog_path):
+    catalog = WriteInterface(catalog_path)
+    catalog.new_label("label", "/label")
+    catalog.ingest_asset("cname", 1, survey(3))
+    replica = ReadInterface(catalog.export_replica(), immutable=True)
+    assert replica.asset_id("cname") == 1
+    assert len(replica.file_ids_by_asset(1)) == 3
+
+def test_readonly_catalog_skips_schema(catalog_path):
+    sqlite3.connect(catalog_path).execute("CREATE TABLE other (id integer);")
+    catalog = ReadInterface(catalog_path, readonly=True)
+    catalog.c.execute("SELECT name FROM sqlite_master;")
+    assert catalog.c.fetchall() == [("other",)]
+
+@pytest.fixture
+def populated(catalog_path):
+    catalog = WriteInterface(catalog_path)
+    catalog.new_label("label", "/label")
+    for _i in range(3):
+        catalog.ingest_asset(f"cname{_i}", 1, survey(1000))
+    return catalog
+
+def test_multi_id_lookups(populated):
+    file_ids = list(range(1, 3001))
+    paths = populated.file_paths(file_ids)
+    assert len(paths) == 3000
+    assert all([paths[_id] == populated.file_path(_id) for _id in [1, 901, 2999]])
+    file_data = populated.file_data_many(file_ids[::7])
+    assert file_data[8] == populated.file_data(8)
+    assert populated.cnames([3, 1, 99]) == {1: "cname0", 3: "cname2"}
+    assert populated.asset_data_many([2])[2]["name"] == "cname1"
+    assert populated.file_paths([]) == {}
+
+def test_update_digests(populated):
+    populated.update_digests({1: "a" * 64, 2: "a" * 64, 3: "b" * 64})
+    assert populated.file_ids_by_digest("a" * 64) == [1, 2]
+    assert populated.duplicate_digests() == {"a" * 64: [1, 2]}
+
+def test_cname_cache():
+    cache = CnameCache()
+    cache.add(3, "c")
+    cache.add(1, "a")
+    assert (cache.name(3), cache.asset_id("a"), len(cache)) == ("c", 1, 2)
+    assert cache.name(2) is None and cache.name(99) is None
+    cache.add(3, "renamed")
+    assert cache.asset_id("c") is None and cache.name(3) == "renamed"
+    cache.discard(1)
+    assert cache.asset_ids() == [3] and cache.items() == [(3, "renamed")]
+
+def test_cached_read_interface_cnames(populated, catalog_path):
+    cached = CachedReadInterface(catalog_path)
+    assert cached.list_asset_ids() == [1, 2, 3]
+    assert cached.list_asset_ids_cnames() == [(1, "cname0"), (2, "cname1"), (3, "cname2")]
+    assert cached.cached_cname(2) == "cname1"
+    assert cached.cached_asset_id("cname2") == 3
+    populated.ingest_asset("cname3", 1, survey(1))
+    assert cached.cached_cname(4) == "cname3"
+    assert populated.cached_asset_id("cname3") == 4
+    populated.remove_asset(4)
+    assert populated.list_asset_ids() == [1, 2, 3]
+
+def assert_stats_consistent(catalog):
+    c = catalog.c
+    assert catalog.count_labels() == c.execute("SELECT COUNT(*) FROM label;").fetchone()[0]
+    assert catalog.count_assets() == c.execute("SELECT COUNT(*) FROM asset;").fetchone()[0]
+    assert catalog.count_files() == c.execute("SELECT COUNT(*) FROM file;").fetchone()[0]
+    assert catalog.total_bytes() == c.execute("SELECT IFNULL(SUM(size), 0) FROM file;").fetchone()[0]
+    for asset_id in catalog.all_asset_ids():
+        assert catalog.asset_file_stats(asset_id) == c.execute(
+            "SELECT COUNT(*), IFNULL(SUM(size), 0) FROM file WHERE asset = ?;",
+            (asset_id,)).fetchone()
+    by_label = dict(c.execute("SELECT label.name, COUNT(asset.id) FROM label"\
+                              " LEFT JOIN asset ON asset.label = label.id"\
+                              " GROUP BY label.id;").fetchall())
+    assert catalog.count_assets_by_labels() == by_label
+    by_filetype = dict(c.execute("SELECT filetype.name, COUNT(*) FROM file"\
+                                 " JOIN filetype ON filetype.id = file.filetype"\
+                                 " GROUP BY filetype.id;").fetchall())
+    assert {_k: _v for _k, _v in catalog.count_files_by_filetypes().items() if _v} \
+           == by_filetype
+
+def test_summary_stats_follow_writes(populated):
+    assert_stats_consistent(populated)
+    assert populated.count_label_assets(1) == 3
+    populated.new_label("other", "/other")
+    populated.update_asset_label(2, 2)
+    populated.remove_file(1)
+    populated.remove_files_by_name(3, "0002.cue")
+    populated.c.execute("UPDATE file SET asset = 1, size = 7 WHERE id = 2500;")
+    populated.remove_asset(2)
+    assert_stats_consistent(populated)
+    assert populated.count_label_assets(2) == 0
+
+def test_summary_stats_backfilled_on_upgrade(catalog_path):
+    db = sqlite3.connect(catalog_path)
+    for statement in SCHEMA:
+        db.execute(statement)
+    db.execute("INSERT INTO label (name, dirname) VALUES ('label', '/label');")
+    db.execute("INSERT INTO asset (name, label, managed) VALUES ('cname', 1, 1);")
+    db.execute("INSERT INTO filetype (name) VALUES ('wav');")
+    db.executemany("INSERT INTO file (asset, basename, dirname, size, filetype)"\
+                   " VALUES (1, ?, '/', 10, 1);", [(str(_i),) for _i in range(5)])
+    db.commit()
+    db.close()
+    catalog = WriteInterface(catalog_path)
+    assert_stats_consistent(catalog)
+    assert catalog.asset_file_stats(1) == (5, 50)
+
+@pytest.mark.parametrize("arraysize", [1, 7, 1000])
+def test_streaming_iterators(arraysize, populated):
+    assert list(populated.iter_asset_ids(arraysize)) == populated.all_asset_ids()
+    records = list(populated.iter_asset_data(1, arraysize))
+    assert records[1] == AssetRecord(2, "cname1", 1, 1)
+    assert records[1].name == populated.asset_data(2)["name"]
+    files = populated.iter_file_data(2, arraysize)
+    first = next(files)
+    assert isinstance(first, FileRecord) and first.asset == 2
+    assert populated.file_path(first.id) == f"{first.dirname}/{first.basename}"
+    assert len(list(files)) == 999
+    assert sum([1 for _ in populated.iter_file_data(arraysize=arraysize)]) == 3000
+
+def test_encode_asset_data_is_quiet(populated, capsys):
+    populated.all_asset_data()
+    assert capsys.readouterr().out == ""
+
+@pytest.fixture
+def searchable(catalog_path):
+    catalog = WriteInterface(catalog_path)
+    catalog.new_label("Warp Records", "/warp")
+    catalog.new_label("Loopmasters", "/loopmasters")
+    catalog.ingest_asset("Aphex Twin - Selected Ambient Works", 1, {
+        "/CD1/01 Xtal.flac": {"basename": "01 Xtal.flac", "dirname": "/CD1",
+                              "size": 1, "filetype": "flac"},
+        "/CD1/02 Tha.flac": {"basename": "02 Tha.flac", "dirname": "/CD1",
+                             "size": 1, "filetype": "flac"}})
+    catalog.ingest_asset("Deep House Kicks", 2, {
+        "/Kicks/Kick_120_Xtal.wav": {"basename": "Kick_120_Xtal.wav",
+                                     "dirname": "/Kicks", "size": 1, "filetype": "wav"}})
+    return catalog
+
+def test_search(searchable):
+    assert searchable.search_assets("aphex") == [1]
+    assert searchable.search_assets("warp") == [1]
+    assert searchable.search_assets("loopmast") == [2]
+    assert set(searchable.search_files("xtal")) == {1, 3}
+    assert searchable.search_files("kick 120") == [3]
+    assert searchable.search('"unbalanced (') == {"assets": [], "files": []}
+    assert searchable.search("") == {"assets": [], "files": []}
+
+def test_search_follows_writes(searchable):
+    searchable.update_asset_name(2, "Deep Techno Kicks")
+    searchable.c.execute("UPDATE label SET name = 'Samples From Mars' WHERE id = 2;")
+    searchable.c.execute("UPDATE file SET basename = 'Kick_124.wav' WHERE id = 3;")
+    searchable.remove_file(1)
+    assert searchable.search_assets("house") == []
+    assert searchable.search_assets("techno mars") == [2]
+    assert searchable.search_files("xtal") == []
+    assert searchable.search_files("124") == [3]
+    searchable.remove_asset(1)
+    assert searchable.search_assets("aphex") == []
+
+def test_changed_asset_ids(populated):
+    generation = populated.generation()
+    assert populated.changed_asset_ids(generation) == []
+    populated.update_digests({1500: "a" * 64})
+    populated.update_asset_name(3, "renamed")
+    populated.ingest_asset("cname3", 1, survey(2))
+    populated.remove_asset(1)
+    assert populated.changed_asset_ids(generation) == [2, 3, 4]
+    assert [_c[1:] for _c in populated.changes_since(generation)][:2] \
+           == [("file", 1500, "update"), ("asset", 3, "update")]
+
+def test_sync_replica(populated, tmp_path):
+    replica_path = populated.export_replica()
+    populated.update_asset_name(2, "Deep Techno Kicks")
+    populated.c.execute("UPDATE file SET basename = 'Kick_124.wav', size = 5000 WHERE id = 1500;")
+    populated.ingest_asset("cname3", 1, survey(10, ("wav",)))
+    populated.remove_file(7)
+    populated.remove_asset(1)
+    populated.c.execute("DELETE FROM file WHERE asset = 1;")
+    generation = populated.sync_replica()
+    assert generation == populated.generation()
+    replica = ReadInterface(replica_path, readonly=True)
+    assert replica.generation() == generation
+    for table in ["label", "filetype", "asset", "file"]:
+        query = f"SELECT * FROM {table} ORDER BY id;"
+        assert replica.c.execute(query).fetchall() == populated.c.execute(query).fetchall()
+    assert_stats_consistent(replica)
+    assert replica.search_assets("techno") == [2]
+    assert replica.search_files("124") == [1500]
+    assert populated.sync_replica() == generation
+
+def test_sync_replica_exports_when_missing(populated, tmp_path):
+    assert populated.sync_replica() == populated.generation()
+    replica = ReadInterface(str(tmp_path / "Catalog-ReadReplica.sqlite"), readonly=True)
+    assert replica.count_files() == 3000
+
+@pytest.fixture
+def federated(tmp_path):
+    catalog_paths = {}
+    for catalog, cnames in [("releases", ["a", "b"]), ("samples", ["b", "c"]),
+                            ("o'brien", ["b"])]:
+        writer = WriteInterface(str(tmp_path / f"{catalog}.sqlite"))
+        writer.new_label("label", "/label")
+        writer.new_filetype("txt")
+        for cname in cnames:
+            writer.ingest_asset(cname, 1, survey(6))
+        catalog_paths[catalog] = writer.export_replica()
+    return FederatedReadInterface(catalog_paths)
+
+def test_federated_queries(federated):
+    assert federated.shared_cnames() == {"b": ["o'brien", "releases", "samples"]}
+    assert federated.count_assets_by_catalogs() == {"releases": 2, "samples": 2, "o'brien": 1}
+    flac = federated.files_by_type("FLAC", min_size=2)
+    assert len(flac) == 5 and {_r[2] for _r in flac} == {3}
+    assert federated.query("SELECT COUNT(*) FROM all_file WHERE filetype = 'cue';") == [(10,)]
+
+def test_federated_connection_per_thread(federated):
+    results = []
+    thread = threading.Thread(target=lambda: results.append(federated.count_assets_by_catalogs()))
+    thread.start()
+    thread.join()
+    assert results == [federated.count_assets_by_catalogs()]
+
+def test_federated_attaches_replicas_read_only(federated):
+    attached = {_r[1]: _r[2] for _r in federated.query("PRAGMA database_list;")}
+    assert [attached[f"catalog{_i}"] for _i in range(3)] == list(federated.catalog_paths.values())
+    with pytest.raises(sqlite3.OperationalError):
+        federated.c.execute("DELETE FROM catalog0.file;")
+
+def test_federated_rejects_too_many_catalogs(federated):
+    paths = list(federated.catalog_paths.values())
+    catalog_paths = {f"catalog{_i}": paths[_i % len(paths)] for _i in range(11)}
+    with pytest.raises(ValueError, match="at most 10"):
+        FederatedReadInterface(catalog_paths)
+    del catalog_paths["catalog10"]
+    assert len(FederatedReadInterface(catalog_paths).count_assets_by_catalogs()) == 10
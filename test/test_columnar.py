@@ -0,0 +1,139 @@
+import numpy as np
+import pytest
+
+from interfaces.database.Catalog import WriteInterface
+from interfaces.database.Columnar import (append_npy,
+                                          ColumnarSnapshot,
+                                          load_columns,
+                                          load_manifest,
+                                          TextColumn)
+from interfaces.database.LibrosaData import DataInterface
+
+
+def survey(n_files, exts=("flac", "wav")):
+    return {f"/CD1/{_i:04}.{exts[_i % len(exts)]}": {
+                "basename": f"{_i:04} ünï.{exts[_i % len(exts)]}",
+                "dirname": "/CD1",
+                "size": _i * 1000,
+                "filetype": exts[_i % len(exts)]}
+            for _i in range(n_files)}
+
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = WriteInterface(str(tmp_path / "Catalog.sqlite"))
+    catalog.new_label("label", "/label")
+    for _i in range(3):
+        catalog.ingest_asset(f"cname{_i}", 1, survey(500))
+    return catalog
+
+def assert_matches_table(columns, catalog):
+    rows = catalog.c.execute("SELECT id, asset, filetype, size, basename, digest FROM file"\
+                             " ORDER BY id;").fetchall()
+    assert columns["id"].tolist() == [_r[0] for _r in rows]
+    assert columns["asset"].tolist() == [_r[1] for _r in rows]
+    assert columns["filetype"].tolist() == [_r[2] for _r in rows]
+    assert columns["size"].tolist() == [_r[3] for _r in rows]
+    assert [columns["basename"][_i] for _i in range(len(rows))] == [_r[4] for _r in rows]
+    assert [columns["digest"][_i] for _i in range(len(rows))] == [_r[5] or "" for _r in rows]
+
+def test_append_npy(tmp_path):
+    path = str(tmp_path / "column.npy")
+    append_npy(path, np.arange(3, dtype=np.float32).reshape(1, 3))
+    for _i in range(1, 200):
+        append_npy(path, np.full((_i, 3), _i, dtype=np.float32))
+    loaded = np.load(path, mmap_mode="r")
+    assert loaded.shape == (1 + 199 * 200 // 2, 3)
+    assert loaded[-1].tolist() == [199] * 3
+    with pytest.raises(ValueError):
+        append_npy(path, np.zeros((1, 4), dtype=np.float32))
+
+def test_text_column():
+    blob, offsets = TextColumn.encode(["a", "", None, "ünï"])
+    column = TextColumn(blob, np.concatenate([[0], offsets]))
+    assert [column[_i] for _i in range(len(column))] == ["a", "", "", "ünï"]
+    assert column.lengths().tolist() == [1, 0, 0, 5]
+
+def test_export_catalog(catalog, tmp_path):
+    directory = str(tmp_path / "columns")
+    actions = ColumnarSnapshot(catalog, directory).refresh()
+    assert set(actions.values()) == {"rewritten"}
+    files = load_columns(directory, "file")
+    assert isinstance(files["id"], np.memmap) and files["size"].dtype == np.int64
+    assert_matches_table(files, catalog)
+    assert load_columns(directory, "asset")["managed"].tolist() == [1, 1, 1]
+    assert load_manifest(directory)["generation"] == catalog.generation()
+
+def test_refresh_appends_new_rows(catalog, tmp_path):
+    directory = str(tmp_path / "columns")
+    ColumnarSnapshot(catalog, directory).refresh()
+    files = load_columns(directory, "file")
+    catalog.ingest_asset("cname3", 1, survey(20))
+    catalog.update_digests({1505: "a" * 64})
+    actions = ColumnarSnapshot(catalog, directory).refresh()
+    assert actions == {"label": "unchanged", "filetype": "unchanged",
+                       "asset": "appended", "file": "appended"}
+    assert len(files["id"]) == 1500
+    assert_matches_table(load_columns(directory, "file"), catalog)
+    assert ColumnarSnapshot(catalog, directory).refresh()["file"] == "unchanged"
+
+def test_refresh_rewrites_changed_rows(catalog, tmp_path):
+    directory = str(tmp_path / "columns")
+    ColumnarSnapshot(catalog, directory).refresh()
+    files = load_columns(directory, "file")
+    old_path = load_manifest(directory)["snapshots"]["file"]["path"]
+    catalog.update_digests({7: "b" * 64})
+    catalog.remove_file(8)
+    assert ColumnarSnapshot(catalog, directory).refresh()["file"] == "rewritten"
+    assert not (tmp_path / "columns" / old_path).exists()
+    assert len(files["id"]) == 1500 and files["basename"][7].startswith("0007")
+    assert_matches_table(load_columns(directory, "file"), catalog)
+
+def test_refresh_rewrites_after_interrupted_append(catalog, tmp_path):
+    directory = str(tmp_path / "columns")
+    ColumnarSnapshot(catalog, directory).refresh()
+    path = load_manifest(directory)["snapshots"]["file"]["path"]
+    append_npy(str(tmp_path / "columns" / path / "size.npy"), np.zeros(5, dtype=np.int64))
+    catalog.ingest_asset("cname3", 1, survey(20))
+    assert ColumnarSnapshot(catalog, directory).refresh()["file"] == "rewritten"
+    assert_matches_table(load_columns(directory, "file"), catalog)
+
+def test_export_analysis(tmp_path):
+    data = DataInterface(str(tmp_path / "LibrosaAnalysis.sqlite"))
+    rng = np.random.default_rng(0)
+    chroma = rng.random((40, 12)).astype(np.float32)
+    data.c.executemany("INSERT INTO chromadistribution (catalog, file, c01, c02, c03, c04,"\
+                       " c05, c06, c07, c08, c09, c10, c11, c12)"\
+                       " VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?);",
+                       [("cat", _i + 1) + tuple(_v) for _i, _v in enumerate(chroma.tolist())])
+    for file_id in range(1, 11):
+        data.new_data(file_id, "cat", "1", dvalue=str(file_id * 1.5))
+        data.new_data(file_id, "cat", "2", dvalue="120.0")
+    data.commit()
+    directory = str(tmp_path / "columns")
+    ColumnarSnapshot(data, directory).refresh()
+    columns = load_columns(directory, "chroma")
+    assert columns["chroma"].shape == (40, 12) and columns["chroma"].dtype == np.float32
+    assert np.array_equal(columns["chroma"], chroma)
+    assert columns["catalog"][39] == "cat"
+    durations = load_columns(directory, "duration")
+    assert durations["file"].tolist() == list(range(1, 11))
+    assert durations["duration"].tolist() == [_i * 1.5 for _i in range(1, 11)]
+    data.new_data(11, "cat", "1", dvalue="3.0")
+    data.commit()
+    actions = ColumnarSnapshot(data, directory).refresh()
+    assert actions == {"chroma": "unchanged", "duration": "appended", "tempo": "appended"}
+    assert load_columns(directory, "duration")["duration"][-1] == 3.0
+    assert len(load_columns(directory, "tempo")["tempo"]) == 10
+
+def test_rewrite_at_same_generation_keeps_current_files(catalog, tmp_path):
+    directory = str(tmp_path / "columns")
+    ColumnarSnapshot(catalog, directory).refresh()
+    files = load_columns(directory, "file")
+    old_path = load_manifest(directory)["snapshots"]["file"]["path"]
+    snapshot = ColumnarSnapshot(catalog, directory)
+    snapshot.rewrite("file", catalog.column_snapshots["file"], catalog.generation())
+    assert (tmp_path / "columns" / old_path).exists()
+    assert_matches_table(files, catalog)
+    snapshot.save_manifest()
+    assert not (tmp_path / "columns" / old_path).exists()
+    assert_matches_table(load_columns(directory, "file"), catalog)
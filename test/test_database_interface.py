@@ -0,0 +1,198 @@
+import json
+import shutil
+import sqlite3
+import threading
+import pytest
+
+from interfaces.Interface import (changelog_schema,
+                                  ConnectionPool,
+                                  DatabaseInterface,
+                                  POOL,
+                                  PROFILER,
+                                  ProfiledCursor)
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = DatabaseInterface(str(tmp_path / "Test.sqlite"))
+    database.c.execute("CREATE TABLE data (id integer PRIMARY KEY, value text);")
+    database.c.executemany("INSERT INTO data (value) VALUES (?);",
+                           [(str(_i) * 100,) for _i in range(5000)])
+    database.commit()
+    return database
+
+def count_rows(path):
+    db = sqlite3.connect(path)
+    count = db.execute("SELECT COUNT(*) FROM data;").fetchone()[0]
+    db.close()
+    return count
+
+def test_export_replica(database, tmp_path):
+    replica_path = database.export_replica(pages=8)
+    assert replica_path == str(tmp_path / "Test-ReadReplica.sqlite")
+    assert count_rows(replica_path) == 5000
+    assert not shutil.os.path.exists(f"{replica_path}.tmp")
+    db = sqlite3.connect(replica_path)
+    assert db.execute("PRAGMA journal_mode;").fetchone()[0] == "delete"
+    db.close()
+
+def test_export_replica_keeps_connection_and_readers(database):
+    replica_path = database.export_replica()
+    reader = sqlite3.connect(replica_path)
+    reader.execute("BEGIN;")
+    assert reader.execute("SELECT COUNT(*) FROM data;").fetchone()[0] == 5000
+    database.c.execute("INSERT INTO data (value) VALUES ('new');")
+    database.export_replica(pages=8)
+    assert reader.execute("SELECT COUNT(*) FROM data;").fetchone()[0] == 5000
+    reader.close()
+    assert count_rows(replica_path) == 5001
+
+def test_writable_connection_uses_wal(database):
+    assert database.c.execute("PRAGMA journal_mode;").fetchone()[0] == "wal"
+
+@pytest.mark.parametrize("immutable", [False, True])
+def test_readonly_connection(database, immutable):
+    replica = DatabaseInterface(database.export_replica(), readonly=True,
+                                immutable=immutable)
+    assert replica.c.execute("SELECT COUNT(*) FROM data;").fetchone()[0] == 5000
+    assert replica.c.execute("PRAGMA mmap_size;").fetchone()[0] > 0
+    with pytest.raises(sqlite3.OperationalError):
+        replica.c.execute("INSERT INTO data (value) VALUES ('new');")
+
+def test_readonly_connection_requires_database(tmp_path):
+    with pytest.raises(sqlite3.OperationalError):
+        DatabaseInterface(str(tmp_path / "Missing.sqlite"), readonly=True)
+
+def test_interfaces_share_pooled_connection(database):
+    other = DatabaseInterface(database.dbpath)
+    assert other.db is database.db
+    assert other.c is not database.c
+    connections = []
+    thread = threading.Thread(target=lambda: connections.append(other.db))
+    thread.start()
+    thread.join()
+    assert connections[0] is not database.db
+
+def test_replaced_file_gets_new_connection(database):
+    replica_path = database.export_replica()
+    replica = DatabaseInterface(replica_path, immutable=True)
+    assert DatabaseInterface(replica_path, immutable=True).db is replica.db
+    database.c.execute("INSERT INTO data (value) VALUES ('new');")
+    database.export_replica()
+    reexported = DatabaseInterface(replica_path, immutable=True)
+    assert reexported.db is not replica.db
+    assert count_rows_of(reexported) == count_rows_of(replica) + 1
+
+def count_rows_of(interface):
+    return interface.c.execute("SELECT COUNT(*) FROM data;").fetchone()[0]
+
+def test_schema_applied_once_per_file(database):
+    assert database.needs_schema("test")
+    database.schema_applied("test")
+    assert not DatabaseInterface(database.dbpath).needs_schema("test")
+    assert DatabaseInterface(":memory:").needs_schema("test")
+
+def test_pool_closes_idle_connections(tmp_path):
+    pool = ConnectionPool(max_connections=2)
+    keys = [pool.acquire(str(tmp_path / f"{_i}.sqlite"), "rw")[0] for _i in range(3)]
+    assert pool.size() == 3
+    pool.release(keys[0])
+    pool.acquire(str(tmp_path / "3.sqlite"), "rw")
+    assert pool.size() == 3 and keys[0] not in pool.connections
+    key, db = pool.acquire(str(tmp_path / "1.sqlite"), "rw")
+    assert key == keys[1] and pool.connections[key][1] == 2
+
+def test_pool_closes_connections_of_exited_threads(database):
+    pool_size = POOL.size()
+    for _i in range(150):
+        thread = threading.Thread(target=lambda: count_rows_of(database))
+        thread.start()
+        thread.join()
+    assert POOL.size() <= pool_size + 1
+    assert len(database.handles) <= 2 and len(database.pool_keys) <= 2
+    assert count_rows_of(database) == 5000
+
+class LoggedInterface(DatabaseInterface):
+
+    changelog_tables = ["data"]
+
+@pytest.fixture
+def logged(tmp_path):
+    logged = LoggedInterface(str(tmp_path / "Logged.sqlite"))
+    logged.c.execute("CREATE TABLE data (id integer PRIMARY KEY, value text);")
+    for statement in changelog_schema(["data"]):
+        logged.c.execute(statement)
+    logged.c.executemany("INSERT INTO data (value) VALUES (?);",
+                         [(str(_i),) for _i in range(2000)])
+    logged.commit()
+    return logged
+
+def test_changelog_records_writes(logged):
+    assert logged.generation() == 2000
+    logged.c.execute("UPDATE data SET value = 'updated' WHERE id = 5;")
+    logged.c.execute("DELETE FROM data WHERE id = 6;")
+    assert logged.changes_since(2000) == [(2001, "data", 5, "update"),
+                                          (2002, "data", 6, "delete")]
+
+def test_sync_replica_applies_changes_only(logged):
+    replica_path = logged.export_replica()
+    logged.c.execute("UPDATE data SET value = 'updated' WHERE id < 1500;")
+    logged.c.execute("DELETE FROM data WHERE id > 1900;")
+    logged.c.execute("INSERT INTO data (value) VALUES ('new');")
+    logged.c.execute("DELETE FROM data WHERE id = 1;")
+    assert logged.sync_replica() == logged.generation()
+    db = sqlite3.connect(replica_path)
+    query = "SELECT * FROM data ORDER BY id;"
+    assert db.execute(query).fetchall() == logged.c.execute(query).fetchall()
+    assert db.execute("SELECT * FROM changelog;").fetchall() \
+           == logged.c.execute("SELECT * FROM changelog;").fetchall()
+    db.close()
+
+def test_sync_replica_without_changelog_exports(database):
+    replica_path = database.export_replica()
+    database.c.execute("INSERT INTO data (value) VALUES ('new');")
+    database.sync_replica()
+    assert count_rows(replica_path) == 5001
+
+@pytest.fixture
+def profiler(tmp_path):
+    PROFILER.reset()
+    PROFILER.enable(slow_ms=0, slow_log_path=str(tmp_path / "slow.jsonl"))
+    yield PROFILER
+    PROFILER.disable()
+    PROFILER.reset()
+
+def test_profiler_records_statements(profiler, tmp_path):
+    database = DatabaseInterface(str(tmp_path / "Profiled.sqlite"))
+    assert isinstance(database.c, ProfiledCursor)
+    database.c.execute("CREATE TABLE data (id integer PRIMARY KEY, value text);")
+    database.c.executemany("INSERT INTO data (value) VALUES (?);", [("a",), ("b",), ("c",)])
+    for ids in [(1,), (1, 2), (1, 2, 3)]:
+        database.c.execute(f"SELECT value FROM data WHERE id IN ({','.join('?' * len(ids))});", ids)
+        database.c.fetchall()
+    assert [_r for _r in database.c.execute("SELECT * FROM data WHERE value = ?;", ("a",))] \
+           == [(1, "a")]
+    report = {_r["statement"]: _r for _r in profiler.report()}
+    assert report["INSERT INTO data (value) VALUES (?);"]["rows"] == 3
+    selected = report["SELECT value FROM data WHERE id IN (...);"]
+    assert (selected["calls"], selected["rows"]) == (3, 6)
+    assert 0 <= selected["p50_ms"] <= selected["p95_ms"] <= selected["max_ms"]
+    assert report["SELECT * FROM data WHERE value = ?;"]["rows"] == 1
+
+def test_profiler_slow_query_log_and_dump(profiler, tmp_path):
+    database = DatabaseInterface(str(tmp_path / "Profiled.sqlite"))
+    database.c.execute("CREATE TABLE data (id integer PRIMARY KEY, value text);")
+    database.c.execute("SELECT id FROM data WHERE value = ?;", ("a",))
+    database.c.execute("SELECT id FROM data WHERE id = ?;", (1,))
+    database.close()
+    slow = [json.loads(_l) for _l in (tmp_path / "slow.jsonl").read_text().splitlines()]
+    plans = {_e["statement"]: " ".join(_e["plan"]) for _e in slow}
+    assert "SCAN data" in plans["SELECT id FROM data WHERE value = ?;"]
+    assert "USING INTEGER PRIMARY KEY" in plans["SELECT id FROM data WHERE id = ?;"]
+    profiler.dump(str(tmp_path / "profile.json"))
+    dump = json.loads((tmp_path / "profile.json").read_text())
+    assert len(dump["statements"]) == 3 and len(dump["slow_queries"]) == 3
+
+def test_profiler_disabled_uses_plain_cursors(database):
+    assert not PROFILER.enabled
+    assert type(database.c) is sqlite3.Cursor
@@ -0,0 +1,467 @@
+import logging
+import numpy as np
+import pytest
+from types import SimpleNamespace
+
+from scipy.spatial.distance import cdist
+
+from apps.analysis.HarmonicDistance import (blocked_intracatalog_distances,
+                                            closest,
+                                            clustered_pair_sources,
+                                            delta_intercatalog_distances,
+                                            delta_intracatalog_distances,
+                                            HarmonicDistance,
+                                            Intercatalog,
+                                            Intracatalog,
+                                            load_tile_matrix,
+                                            nearest_neighbours,
+                                            neighbouring_clusters,
+                                            tile_distances,
+                                            transposed_distances,
+                                            upper_triangle_tiles)
+from interfaces.database.LibrosaData import DataInterface
+
+
+@pytest.fixture
+def chroma():
+    rng = np.random.default_rng(0)
+    matrix = rng.random((23, 12)).astype(np.float32)
+    matrix /= matrix.sum(axis=1)[:, None]
+    file_ids = np.sort(rng.choice(np.arange(1, 200), size=23, replace=False))
+    return (file_ids, matrix)
+
+def linear_pairs(file_ids, matrix):
+    return {(int(file_ids[_i]), int(file_ids[_j])):
+            float(((matrix[_i] - matrix[_j]).astype(np.float64)**2).sum())
+            for _i in range(len(file_ids))
+            for _j in range(_i + 1, len(file_ids))}
+
+def collect(blocks):
+    pairs = {}
+    for file1, file2, distances in blocks:
+        pairs.update({(_a, _b): _d for _a, _b, _d
+                      in zip(file1.tolist(), file2.tolist(), distances.tolist())})
+    return pairs
+
+@pytest.mark.parametrize("block_size", [1, 5, 64])
+def test_blocked_matches_linear(block_size, chroma):
+    expected = linear_pairs(*chroma)
+    result = collect(blocked_intracatalog_distances(*chroma, block_size=block_size))
+    assert result.keys() == expected.keys()
+    assert all([abs(result[_k] - expected[_k]) < 1e-6 for _k in expected.keys()])
+
+def test_blocked_resume(chroma):
+    file_ids, _ = chroma
+    expected = linear_pairs(*chroma)
+    last_pair = (int(file_ids[4]), int(file_ids[9]))
+    result = collect(blocked_intracatalog_distances(*chroma, last_pair=last_pair,
+                                                    block_size=5))
+    assert set(result.keys()) == {_k for _k in expected.keys() if _k > last_pair}
+
+@pytest.mark.parametrize("tile_size", [1, 4, 7, 64])
+def test_tiles_match_linear(tile_size, chroma, tmp_path):
+    file_ids, matrix = chroma
+    np.save(tmp_path / "chroma.npy", matrix)
+    load_tile_matrix(str(tmp_path / "chroma.npy"))
+    expected = linear_pairs(*chroma)
+    blocks = []
+    for tile in upper_triangle_tiles(len(file_ids), tile_size):
+        _, rows, cols, distances = tile_distances(tile)
+        blocks.append((file_ids[rows], file_ids[cols], distances))
+    assert sum([len(_b[0]) for _b in blocks]) == len(expected)
+    result = collect(blocks)
+    assert result.keys() == expected.keys()
+    assert all([abs(result[_k] - expected[_k]) < 1e-6 for _k in expected.keys()])
+
+def test_nearest_neighbours(chroma):
+    expected = linear_pairs(*chroma)
+    file_ids, _ = chroma
+    file1, rank, file2, distances = nearest_neighbours(*chroma, k=3)
+    assert len(file1) == 3 * len(file_ids)
+    for _id in file_ids.tolist():
+        by_distance = sorted([(_d, _p[0] if _p[1] == _id else _p[1])
+                              for _p, _d in expected.items() if _id in _p])
+        assert file2[file1 == _id].tolist() == [_b[1] for _b in by_distance[:3]]
+        assert rank[file1 == _id].tolist() == [1, 2, 3]
+
+@pytest.mark.parametrize("k", [1, 5, 30])
+def test_closest(k, chroma):
+    _, matrix = chroma
+    vector = matrix[3]
+    rows, distances = closest(vector, matrix, (matrix**2).sum(axis=1), k)
+    expected = ((matrix - vector).astype(np.float64)**2).sum(axis=1)
+    assert rows.tolist() == np.argsort(expected, kind="stable")[:k].tolist()
+    assert np.allclose(distances, expected[rows], atol=1e-6)
+
+def test_transposed_distances(chroma):
+    _, matrix = chroma
+    rows, cols = matrix[:4], matrix[4:9]
+    distances, shifts = transposed_distances(rows, cols)
+    for _i, _row in enumerate(rows):
+        for _j, _col in enumerate(cols):
+            by_shift = [((_row - np.roll(_col, _s))**2).sum() for _s in range(12)]
+            assert shifts[_i, _j] == int(np.argmin(by_shift))
+            assert abs(distances[_i, _j] - min(by_shift)) < 1e-6
+
+def test_transposed_finds_shift(chroma):
+    _, matrix = chroma
+    distances, shifts = transposed_distances(matrix[:1], np.roll(matrix[:1], -3, axis=1))
+    assert shifts[0, 0] == 3
+    assert distances[0, 0] < 1e-6
+
+def test_blocked_transposed_scorer(chroma):
+    file_ids, matrix = chroma
+    pairs = 0
+    for file1, file2, distances, shifts in blocked_intracatalog_distances(
+                                        *chroma, block_size=7,
+                                        scorer=transposed_distances):
+        assert len(file1) == len(file2) == len(distances) == len(shifts)
+        pairs += len(file1)
+    assert pairs == len(file_ids) * (len(file_ids) - 1) // 2
+
+def test_neighbouring_clusters(chroma):
+    _, centroids = chroma
+    neighbours = neighbouring_clusters(centroids, 3)
+    assert neighbours.shape == (len(centroids), 3)
+    assert all([_c not in neighbours[_c] for _c in range(len(centroids))])
+
+def test_clustered_pair_sources_cover_once(chroma):
+    _, centroids = chroma
+    neighbours = neighbouring_clusters(centroids, 3)
+    sources = clustered_pair_sources(neighbours)
+    for _a in range(len(centroids)):
+        for _b in range(_a + 1, len(centroids)):
+            related = _b in neighbours[_a] or _a in neighbours[_b]
+            assert (_b in sources[_a]) + (_a in sources[_b]) == int(related)
+
+def test_delta_intracatalog_pairs_new_files_once(chroma):
+    file_ids, matrix = chroma
+    expected = linear_pairs(*chroma)
+    new_ids = file_ids[[2, 7, 8, 22]]
+    blocks = list(delta_intracatalog_distances(file_ids, matrix, new_ids, block_size=3))
+    assert sum([len(_b[0]) for _b in blocks]) == len([_k for _k in expected.keys()
+                                                      if set(_k) & set(new_ids.tolist())])
+    result = collect(blocks)
+    assert result.keys() == {_k for _k in expected.keys() if set(_k) & set(new_ids.tolist())}
+    assert all([abs(result[_k] - expected[_k]) < 1e-6 for _k in result.keys()])
+
+def test_delta_intercatalog_pairs_new_files_once(chroma):
+    file_ids, matrix = chroma
+    ids1, m1, ids2, m2 = file_ids[:10], matrix[:10], file_ids[10:], matrix[10:]
+    new1, new2 = ids1[[0, 5]], ids2[[3]]
+    blocks = list(delta_intercatalog_distances(ids1, m1, new1, ids2, m2, new2, block_size=1))
+    expected = {(_a, _b) for _a in ids1.tolist() for _b in ids2.tolist()
+                if _a in new1 or _b in new2}
+    assert sum([len(_b[0]) for _b in blocks]) == len(expected)
+    assert collect(blocks).keys() == expected
+
+@pytest.fixture
+def intracatalog(chroma, tmp_path):
+    (tmp_path / "data" / "analysis").mkdir(parents=True)
+    results = Intracatalog(str(tmp_path), "cat")
+    results.add_distances([_k + (_d,) for _k, _d in linear_pairs(*chroma).items()])
+    results.create_indexes()
+    return results
+
+def test_intracatalog_lookups(chroma, intracatalog):
+    file_ids, _ = chroma
+    expected = linear_pairs(*chroma)
+    file_id = int(file_ids[6])
+    by_distance = sorted([(_d, _p[0] if _p[1] == file_id else _p[1])
+                          for _p, _d in expected.items() if file_id in _p])
+    neighbours = intracatalog.neighbours(file_id, 5)
+    assert [_n[0] for _n in neighbours] == [_b[1] for _b in by_distance[:5]]
+    assert len(intracatalog.all_data_by_file(file_id)) == len(file_ids) - 1
+    pair = (int(file_ids[9]), file_id)
+    assert abs(float(intracatalog.distance(*pair)) - expected[pair[::-1]]) < 1e-6
+
+def test_intracatalog_neighbours_use_indexes(intracatalog):
+    intracatalog.c.execute("EXPLAIN QUERY PLAN SELECT file2, distance FROM data"\
+                           " WHERE file1 = 1 ORDER BY distance ASC LIMIT 5;")
+    plan = " ".join([_r[-1] for _r in intracatalog.c.fetchall()])
+    assert "data_file1" in plan and "TEMP B-TREE" not in plan
+
+def test_intercatalog_lookups(chroma, tmp_path):
+    file_ids, _ = chroma
+    (tmp_path / "data" / "analysis").mkdir(parents=True)
+    results = Intercatalog(str(tmp_path), "a", "b")
+    results.add_distances([("a", _a, "b", _b, _d) for (_a, _b), _d
+                           in linear_pairs(*chroma).items()])
+    results.create_indexes()
+    file_id = int(file_ids[6])
+    assert len(results.all_data_by_file("a", file_id)) == len(file_ids) - 7
+    assert len(results.all_data_by_file("b", file_id)) == 6
+    neighbours = results.neighbours("b", file_id, 3)
+    assert [_n[0] for _n in neighbours] == ["a"] * 3
+    assert [_n[2] for _n in neighbours] == sorted([_n[2] for _n in neighbours])
+
+@pytest.fixture
+def app(tmp_path):
+    (tmp_path / "data" / "analysis").mkdir(parents=True, exist_ok=True)
+    # AppConfig needs a full installation; set up what the runs use
+    app = HarmonicDistance.__new__(HarmonicDistance)
+    app.cfg = SimpleNamespace(sonicat_path=str(tmp_path))
+    app.log = logging.getLogger("HarmonicDistance")
+    app.rosa_data = DataInterface(str(tmp_path / "data" / "analysis" / "LibrosaAnalysis.sqlite"))
+    app.lsh_indexes, app.chroma_cache, app.pair_results_dbs, app.cluster_cache = {}, {}, {}, {}
+    return app
+
+def add_chroma(app, catalog, file_ids):
+    rng = np.random.default_rng(len(file_ids) + min(file_ids))
+    app.rosa_data.c.executemany("INSERT INTO chromadistribution (catalog, file, c01, c02,"\
+                                " c03, c04, c05, c06, c07, c08, c09, c10, c11, c12)"\
+                                " VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?);",
+                                [(catalog, _f) + tuple(rng.dirichlet(np.ones(12)).tolist())
+                                 for _f in file_ids])
+    app.rosa_data.commit()
+
+def stored_pairs(results):
+    """Returns (rows, distinct pairs) stored in an Intracatalog database."""
+    results.c.execute("SELECT (SELECT COUNT(*) FROM data),"\
+                      " (SELECT COUNT(*) FROM (SELECT DISTINCT file1, file2 FROM data));")
+    return results.c.fetchone()
+
+def intercatalog_pairs(results):
+    results.c.execute("SELECT COUNT(*), COUNT(DISTINCT file1 * 1000 + file2) FROM data;")
+    return results.c.fetchone()
+
+def test_tiled_run_extends_completed_run(app, tmp_path):
+    add_chroma(app, "cat", range(1, 301))
+    app.intracatalog_tiled_run("cat", tile_size=64, workers=2)
+    results = Intracatalog(str(tmp_path), "cat")
+    assert stored_pairs(results) == (44850, 44850)
+    assert results.watermark("cat") == app.rosa_data.max_chroma_id("cat")
+    assert results.c.execute("SELECT COUNT(*) FROM tile;").fetchone() == (0,)
+    assert not list((tmp_path / "data" / "analysis").glob("*.npy"))
+    add_chroma(app, "cat", range(301, 321))
+    app.intracatalog_tiled_run("cat", tile_size=64, workers=2)
+    assert stored_pairs(results) == (51040, 51040)
+    assert results.c.execute("SELECT MAX(file2) FROM data;").fetchone() == (320,)
+
+def test_tiled_run_resumes_on_its_snapshot(app, tmp_path):
+    add_chroma(app, "cat", range(1, 101))
+    results = Intracatalog(str(tmp_path), "cat")
+    file_ids, matrix_path, chroma_id = app.chroma_snapshot("cat")
+    results.begin_run("cat", "tiled", chroma_id)
+    load_tile_matrix(matrix_path)
+    tile, rows, cols, distances = tile_distances((0, 32, 32))
+    results.add_tile_distances(chroma_id, tile, zip(file_ids[rows].tolist(),
+                                                    file_ids[cols].tolist(),
+                                                    distances.tolist()))
+    add_chroma(app, "cat", range(101, 111))
+    app.intracatalog_tiled_run("cat", tile_size=32, workers=1)
+    assert stored_pairs(results) == (5995, 5995)
+    assert results.watermark("cat") == app.rosa_data.max_chroma_id("cat")
+    assert results.pending_run("cat") is None
+
+def index_names(results):
+    results.c.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL;")
+    return {_r[0] for _r in results.c.fetchall()}
+
+def test_stores_are_indexed_and_skip_stored_pairs(tmp_path):
+    (tmp_path / "data" / "analysis").mkdir(parents=True)
+    results = Intercatalog(str(tmp_path), "a", "b")
+    assert index_names(results) == {"data_pair", "data_file1", "data_file2"}
+    rows = [("a", 1, "b", 2, 0.5), ("a", 1, "b", 3, 0.25)]
+    results.add_distances(rows)
+    results.add_distances(rows)
+    assert results.c.execute("SELECT COUNT(*) FROM data;").fetchone() == (2,)
+
+def test_create_indexes_removes_repeated_pairs(tmp_path):
+    (tmp_path / "data" / "analysis").mkdir(parents=True)
+    results = Intracatalog(str(tmp_path), "cat")
+    results.drop_indexes()
+    results.add_distances([(1, 2, 0.5), (1, 2, 0.5), (1, 3, 0.25)])
+    assert stored_pairs(results) == (3, 2)
+    reopened = Intracatalog(str(tmp_path), "cat")
+    assert stored_pairs(reopened) == (2, 2)
+    assert "data_pair" in index_names(reopened)
+
+def test_interrupted_run_is_indexed_and_resumes(app, tmp_path, monkeypatch):
+    add_chroma(app, "cat", range(1, 101))
+    add_tile_distances = Intracatalog.add_tile_distances
+    def interrupt(self, chroma_id, tile, rows):
+        if self.c.execute("SELECT COUNT(*) FROM tile;").fetchone()[0] >= 2:
+            raise RuntimeError("interrupted")
+        return add_tile_distances(self, chroma_id, tile, rows)
+    monkeypatch.setattr(Intracatalog, "add_tile_distances", interrupt)
+    with pytest.raises(RuntimeError):
+        app.intracatalog_tiled_run("cat", tile_size=16, workers=1)
+    results = Intracatalog(str(tmp_path), "cat")
+    assert results.pending_run("cat")[0] == "tiled"
+    assert index_names(results) == {"data_pair", "data_file1", "data_file2"}
+    monkeypatch.setattr(Intracatalog, "add_tile_distances", add_tile_distances)
+    app.intracatalog_tiled_run("cat", tile_size=16, workers=1)
+    assert stored_pairs(results) == (4950, 4950)
+
+def test_blocked_run_extends_completed_run(app, tmp_path):
+    add_chroma(app, "cat", range(1, 61))
+    assert app.intracatalog_blocked_run("cat", block_size=16)
+    results = Intracatalog(str(tmp_path), "cat")
+    assert stored_pairs(results) == (1770, 1770)
+    add_chroma(app, "cat", range(61, 71))
+    assert app.intracatalog_blocked_run("cat", block_size=16)
+    assert stored_pairs(results) == (2415, 2415)
+    assert results.watermark("cat") == app.rosa_data.max_chroma_id("cat")
+
+def test_blocked_run_resumes_on_its_matrix(app, tmp_path):
+    add_chroma(app, "cat", range(1, 61))
+    results = Intracatalog(str(tmp_path), "cat")
+    results.add_distances([(1, 2, 0.5)])
+    run = results.begin_run("cat", "blocked", app.rosa_data.max_chroma_id("cat"))
+    results.add_distances([(1, 3, 0.5), (1, 4, 0.5)])
+    add_chroma(app, "cat", range(61, 71))
+    assert results.last_intracatalog_pair(after_id=run[2]) == (1, 4)
+    assert app.intracatalog_blocked_run("cat", block_size=16)
+    assert stored_pairs(results) == (2415, 2415)
+
+def test_delta_run_extends_every_store(app, tmp_path):
+    add_chroma(app, "a", range(1, 51))
+    add_chroma(app, "b", range(1, 31))
+    assert app.delta_run(["b", "a"])
+    add_chroma(app, "a", range(51, 56))
+    add_chroma(app, "b", range(31, 33))
+    assert app.delta_run(["a", "b"])
+    assert stored_pairs(Intracatalog(str(tmp_path), "a")) == (1485, 1485)
+    assert stored_pairs(Intracatalog(str(tmp_path), "b")) == (496, 496)
+    intercatalog = Intercatalog(str(tmp_path), "a", "b")
+    intercatalog.c.execute("SELECT COUNT(*), COUNT(DISTINCT file1 * 1000 + file2) FROM data;")
+    assert intercatalog.c.fetchone() == (55 * 32, 55 * 32)
+
+def test_delta_run_without_watermark_records_every_pair(app, tmp_path):
+    add_chroma(app, "cat", range(1, 41))
+    results = Intracatalog(str(tmp_path), "cat")
+    results.add_distances([(1, 2, 0.5), (3, 9, 0.25)])
+    assert app.intracatalog_delta_run("cat")
+    assert stored_pairs(results) == (780, 780)
+    assert results.watermark("cat") == app.rosa_data.max_chroma_id("cat")
+
+def test_delta_run_waits_for_pending_run(app, tmp_path):
+    add_chroma(app, "cat", range(1, 41))
+    Intracatalog(str(tmp_path), "cat").begin_run("cat", "tiled", 40)
+    assert not app.intracatalog_delta_run("cat")
+    assert not app.intracatalog_blocked_run("cat")
+
+def test_recorded_closest_leaves_stores_to_full_runs(app, tmp_path):
+    add_chroma(app, "a", range(1, 51))
+    add_chroma(app, "b", range(1, 31))
+    for file_id in [1, 2, 1]:
+        app.intercatalog_closest("a", file_id, "b", k=5, record=True)
+        app.intercatalog_closest("a", file_id, "a", k=5, record=True)
+    intercatalog = Intercatalog(str(tmp_path), "a", "b")
+    intracatalog = Intracatalog(str(tmp_path), "a")
+    assert intercatalog.c.execute("SELECT COUNT(*) FROM data;").fetchone() == (10,)
+    assert stored_pairs(intracatalog)[0] == stored_pairs(intracatalog)[1] <= 10
+    assert not intercatalog.watermark("a") and not intracatalog.watermark("a")
+    assert app.intracatalog_blocked_run("a", block_size=16)
+    assert stored_pairs(intracatalog) == (1225, 1225)
+    assert app.intercatalog_delta_run("a", "b")
+    assert intercatalog_pairs(intercatalog) == (1500, 1500)
+
+def test_cluster_run_skips_empty_catalog(app, tmp_path):
+    assert app.cluster_run("cat", n_clusters=8)
+    add_chroma(app, "cat", range(1, 21))
+    with pytest.raises(ValueError):
+        app.catalog_clusters("cat")
+
+def test_new_files_join_nearest_cluster(app, tmp_path):
+    add_chroma(app, "cat", range(1, 201))
+    assert app.cluster_run("cat", n_clusters=8)
+    add_chroma(app, "cat", range(201, 211))
+    file_ids, matrix, _ = app.catalog_chroma("cat")
+    labels, centroids = app.catalog_clusters("cat")
+    assert labels.min() >= 0
+    assert labels[200:].tolist() == cdist(matrix[200:], centroids,
+                                          "sqeuclidean").argmin(axis=1).tolist()
+    neighbours = neighbouring_clusters(centroids, 2)
+    searched = [labels[205]] + neighbours[labels[205]].tolist()
+    found = app.clustered_closest("cat", 206, k=5, n_neighbouring=2)
+    assert len(found) == 5 and 206 not in [_f for _f, _ in found]
+    assert [_d for _, _d in found] == sorted([_d for _, _d in found])
+    assert all([labels[_f - 1] in searched for _f, _ in found])
+    for file_id in [0, 500]:
+        with pytest.raises(KeyError):
+            app.clustered_closest("cat", file_id)
+
+def test_clustered_run_records_related_clusters(app, tmp_path):
+    add_chroma(app, "cat", range(1, 201))
+    assert app.cluster_run("cat", n_clusters=8)
+    labels, centroids = app.catalog_clusters("cat")
+    neighbours = neighbouring_clusters(centroids, 2)
+    related = [(_a == _b) or (_b in neighbours[_a]) or (_a in neighbours[_b])
+               for _i, _a in enumerate(labels) for _b in labels[_i + 1:]]
+    assert app.intracatalog_clustered_run("cat", n_neighbouring=2, block_size=16)
+    results = Intracatalog(str(tmp_path), "cat")
+    assert stored_pairs(results) == (sum(related), sum(related))
+    add_chroma(app, "cat", range(201, 211))
+    assert app.intracatalog_clustered_run("cat", n_neighbouring=2, block_size=16)
+    assert stored_pairs(results) == (sum(related) + 200 * 10 + 45,) * 2
+    assert results.watermark("cat") == app.rosa_data.max_chroma_id("cat")
+
+def test_all_pairs_run_records_each_pair_once(app, tmp_path):
+    add_chroma(app, "a", range(1, 31))
+    add_chroma(app, "b", range(1, 21))
+    pairs = [("a", _f) for _f in range(1, 31)] + [("b", _f) for _f in range(1, 21)]
+    assert app.intercatalog_all_pairs_run(pairs)
+    intracatalog = Intracatalog(str(tmp_path), "a")
+    intercatalog = Intercatalog(str(tmp_path), "a", "b")
+    assert stored_pairs(intracatalog) == (435, 435)
+    assert stored_pairs(Intracatalog(str(tmp_path), "b")) == (190, 190)
+    assert intercatalog_pairs(intercatalog) == (600, 600)
+    add_chroma(app, "a", range(31, 36))
+    assert app.intercatalog_all_pairs_run(pairs + [("a", _f) for _f in range(31, 36)])
+    assert stored_pairs(intracatalog) == (595, 595)
+    assert intercatalog_pairs(intercatalog) == (700, 700)
+    assert not intracatalog.watermark("a")
+    assert not intercatalog.watermark("a") and not intercatalog.watermark("b")
+
+def test_one_to_many_run_records_each_pair_once(app, tmp_path):
+    add_chroma(app, "a", range(1, 31))
+    add_chroma(app, "b", range(1, 21))
+    targets = [("a", _f) for _f in range(1, 31)] + [("b", _f) for _f in range(1, 21)]
+    assert app.intercatalog_one_to_many_run(("a", 1), targets)
+    intracatalog = Intracatalog(str(tmp_path), "a")
+    intercatalog = Intercatalog(str(tmp_path), "a", "b")
+    assert stored_pairs(intracatalog) == (29, 29)
+    assert intercatalog_pairs(intercatalog) == (20, 20)
+    add_chroma(app, "a", range(31, 36))
+    targets += [("a", _f) for _f in range(31, 36)]
+    assert app.intercatalog_one_to_many_run(("a", 1), targets)
+    assert app.intercatalog_one_to_many_run(("b", 5), targets)
+    assert stored_pairs(intracatalog) == (34, 34)
+    assert intercatalog_pairs(intercatalog) == (20 + 34, 20 + 34)
+    assert not intercatalog.watermark("a") and not intercatalog.watermark("b")
+
+@pytest.mark.parametrize("method", ["blocked", "tiled"])
+def test_full_run_follows_clustered_run(method, app, tmp_path):
+    add_chroma(app, "cat", range(1, 101))
+    assert app.cluster_run("cat", n_clusters=8)
+    assert app.intracatalog_clustered_run("cat", n_neighbouring=1)
+    results = Intracatalog(str(tmp_path), "cat")
+    assert stored_pairs(results)[0] < 4950 and not results.watermark_complete("cat")
+    add_chroma(app, "cat", range(101, 106))
+    assert app.intracatalog_clustered_run("cat", n_neighbouring=1)
+    assert not results.watermark_complete("cat")
+    if method == "blocked":
+        assert app.intracatalog_blocked_run("cat", block_size=16)
+    else:
+        app.intracatalog_tiled_run("cat", tile_size=32, workers=1)
+    assert stored_pairs(results) == (5460, 5460)
+    assert results.watermark_complete("cat")
+    assert results.watermark("cat") == app.rosa_data.max_chroma_id("cat")
+
+def test_delta_run_replaces_distances_of_reanalyzed_files(app, tmp_path):
+    add_chroma(app, "a", range(1, 41))
+    add_chroma(app, "b", range(1, 21))
+    assert app.delta_run(["a", "b"])
+    add_chroma(app, "a", [1])
+    assert app.delta_run(["a", "b"])
+    vectors = {_c: dict(zip(*app.chroma_rows(_c, range(1, 41))[:2])) for _c in ["a", "b"]}
+    intracatalog = Intracatalog(str(tmp_path), "a")
+    intercatalog = Intercatalog(str(tmp_path), "a", "b")
+    assert float(intracatalog.distance(1, 2)) == pytest.approx(
+        ((vectors["a"][1] - vectors["a"][2])**2).sum(), rel=1e-5)
+    assert float(intercatalog.distance("a", 1, "b", 3)) == pytest.approx(
+        ((vectors["a"][1] - vectors["b"][3])**2).sum(), rel=1e-5)
+    assert stored_pairs(intracatalog) == (780, 780)
+    assert intercatalog_pairs(intercatalog) == (800, 800)
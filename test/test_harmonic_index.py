@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from apps.analysis.HarmonicIndex import LshIndex, synthetic_chroma
+
+
+@pytest.fixture
+def chroma():
+    matrix = synthetic_chroma(2000, n_families=16)
+    return (np.arange(1, 2001) * 3, matrix)
+
+def exact_neighbours(matrix, row, k):
+    distances = ((matrix - matrix[row])**2).sum(axis=1)
+    return set(np.argsort(distances)[:k].tolist())
+
+def test_query_recall(chroma):
+    file_ids, matrix = chroma
+    index = LshIndex(n_tables=8, n_bits=10, probes=1).fit(file_ids, matrix)
+    recalls = []
+    for row in range(0, 2000, 40):
+        found = index.query(matrix[row], 10)[0]
+        truth = {int(file_ids[_r]) for _r in exact_neighbours(matrix, row, 10)}
+        recalls.append(len(set(found.tolist()) & truth) / 10)
+    assert np.mean(recalls) > 0.9
+
+def test_query_ranked(chroma):
+    file_ids, matrix = chroma
+    index = LshIndex().fit(file_ids, matrix)
+    found, distances = index.query(index.vector(file_ids[7]), 5)
+    assert found[0] == file_ids[7]
+    assert distances.tolist() == sorted(distances.tolist())
+
+def test_vector_missing(chroma):
+    index = LshIndex().fit(*chroma)
+    with pytest.raises(KeyError):
+        index.vector(1)
+
+def test_save_load(chroma, tmp_path):
+    file_ids, matrix = chroma
+    index = LshIndex(n_tables=4, n_bits=8, probes=0).fit(file_ids, matrix)
+    index.save(str(tmp_path / "index.npz"))
+    loaded = LshIndex.load(str(tmp_path / "index.npz"))
+    assert (loaded.n_tables, loaded.n_bits, loaded.probes) == (4, 8, 0)
+    assert loaded.query(matrix[3], 5)[0].tolist() == index.query(matrix[3], 5)[0].tolist()
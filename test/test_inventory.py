@@ -0,0 +1,75 @@
+import hashlib
+import pytest
+
+from apps.App import AppConfig
+from apps.sys.Inventory import Inventory, file_digest, survey_files
+from interfaces.database.Catalog import WriteInterface
+
+
+@pytest.fixture
+def asset_path(tmp_path):
+    path = tmp_path / "Label-Asset"
+    (path / "CD1").mkdir(parents=True)
+    (path / "CD1" / "01.wav").write_bytes(b"riff" * 5000)
+    (path / "CD1" / "02.wav").write_bytes(b"data" * 5000)
+    (path / "01.cue").write_bytes(b"riff" * 5000)
+    return str(path)
+
+@pytest.mark.parametrize("chunk_size", [7, 4096, 4 * 1024 * 1024])
+def test_file_digest(chunk_size, asset_path):
+    expected = hashlib.sha256(b"riff" * 5000).hexdigest()
+    assert file_digest(f"{asset_path}/CD1/01.wav", chunk_size) == expected
+
+def test_survey_files_digests(asset_path):
+    file_data = survey_files(asset_path, workers=2)
+    assert file_data.keys() == {"/CD1/01.wav", "/CD1/02.wav", "/01.cue"}
+    assert file_data["/CD1/01.wav"]["digest"] == file_data["/01.cue"]["digest"]
+    assert file_data["/CD1/02.wav"]["digest"] != file_data["/01.cue"]["digest"]
+
+def test_duplicate_report(asset_path, tmp_path):
+    replicas = {}
+    for catalog in ["releases", "samples"]:
+        replicas[catalog] = WriteInterface(str(tmp_path / f"{catalog}.sqlite"))
+        replicas[catalog].new_label("label", "/label")
+        replicas[catalog].ingest_asset("Label-Asset", 1, survey_files(asset_path))
+    assert len(replicas["samples"].duplicate_digests()) == 1
+    inventory = Inventory.__new__(Inventory)
+    inventory.replicas = replicas
+    report = inventory.duplicate_report()
+    assert [len(_r["files"]) for _r in report] == [4, 2]
+    assert report[0]["reclaimable"] == 3 * 20000
+    assert {_c for _c, _ in report[1]["files"]} == {"releases", "samples"}
+
+@pytest.fixture
+def inventory(tmp_path):
+    (tmp_path / "data" / "catalog").mkdir(parents=True)
+    config = {"catalogs": {"releases": {"moniker": "Releases"}},
+              "apps": {"sys": {"debug": {"moniker": "Inventory", "log_level": "debug"}}}}
+    # Logging and Cleanse need a full installation; set up what precheck uses
+    inventory = Inventory.__new__(Inventory)
+    inventory.cfg = AppConfig(str(tmp_path), "debug", debug_cfg=config)
+    inventory.replicas, inventory.catalogs = {}, {}
+    return inventory
+
+def test_missing_replica_is_reported(inventory, tmp_path):
+    catalog = WriteInterface(str(tmp_path / "data" / "catalog" / "Releases.sqlite"))
+    with pytest.raises(FileNotFoundError, match="releases"):
+        inventory.load_catalog_replicas()
+    with pytest.raises(FileNotFoundError, match="releases"):
+        inventory.load_federated_catalogs()
+    catalog.export_replica()
+    inventory.load_catalog_replicas()
+    assert not inventory.replicas["releases"].asset_exists("Label - Asset")
+
+def test_precheck_reads_the_catalog(inventory, tmp_path):
+    path = tmp_path / "Label - Asset"
+    path.mkdir()
+    catalog = WriteInterface(str(tmp_path / "data" / "catalog" / "Releases.sqlite"))
+    catalog.export_replica()
+    inventory.load_catalog_replicas()
+    inventory.load_catalogs()
+    assert inventory.precheck("releases", str(path))
+    catalog.new_label("label", "/label")
+    catalog.ingest_asset("Label - Asset", 1, {})
+    assert not inventory.replicas["releases"].asset_exists("Label - Asset")
+    assert not inventory.precheck("releases", str(path))
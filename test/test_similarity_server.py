@@ -0,0 +1,73 @@
+from http.client import HTTPConnection
+from http.server import ThreadingHTTPServer
+import numpy as np
+import pytest
+from threading import Thread
+
+from apps.analysis.SimilarityServer import SimilarityIndex, SimilarityRequestHandler
+from interfaces.database.LibrosaData import DataInterface
+
+
+@pytest.fixture
+def replica(tmp_path):
+    data = DataInterface(str(tmp_path / "LibrosaAnalysis.sqlite"))
+    rng = np.random.default_rng(0)
+    for catalog in ["releases", "samples"]:
+        for file_id in range(1, 51):
+            data.c.execute("INSERT INTO chromadistribution (catalog, file, c01, c02,"\
+                           " c03, c04, c05, c06, c07, c08, c09, c10, c11, c12)"\
+                           " VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?);",
+                           [catalog, file_id] + rng.dirichlet(np.ones(12)).tolist())
+    data.db.commit()
+    return (data.export_replica(), data)
+
+def test_similar_to_file(replica):
+    index = SimilarityIndex(replica[0])
+    results = index.similar_to_file("releases", 3, k=5)
+    assert len(results) == 5
+    assert ("releases", 3) not in [(_r["catalog"], _r["file"]) for _r in results]
+    distances = [_r["distance"] for _r in results]
+    assert distances == sorted(distances)
+
+def test_similar_within(replica):
+    index = SimilarityIndex(replica[0])
+    results = index.similar_to_file("releases", 3, k=5, within=["samples"])
+    assert all([_r["catalog"] == "samples" for _r in results])
+
+def test_similar_to_vector(replica):
+    index = SimilarityIndex(replica[0])
+    vector = index.vector("samples", 7)
+    assert index.similar_to_vector(vector, k=1)[0]["file"] == 7
+
+def test_refresh(replica):
+    path, data = replica
+    index = SimilarityIndex(path)
+    assert not index.refresh()
+    data.c.execute("INSERT INTO chromadistribution (catalog, file, c01, c02, c03, c04,"\
+                   " c05, c06, c07, c08, c09, c10, c11, c12)"\
+                   " VALUES ('stems', 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0);")
+    data.db.commit()
+    assert not index.refresh()
+    data.export_replica()
+    assert index.refresh()
+    assert "stems" in index.catalogs.keys()
+
+@pytest.mark.parametrize("query,status", [("/file?catalog=releases&id=3", 200),
+                                          ("/file?catalog=releases&id=999", 404),
+                                          ("/file?catalog=releases", 400),
+                                          ("/file?id=3", 400),
+                                          ("/vector?k=3", 400),
+                                          ("/vector?v=1,2", 400),
+                                          ("/nearest?id=3", 404)])
+def test_request_status(replica, query, status):
+    handler = type("Handler", (SimilarityRequestHandler,),
+                   {"index": SimilarityIndex(replica[0])})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        connection = HTTPConnection("127.0.0.1", server.server_address[1])
+        connection.request("GET", query)
+        assert connection.getresponse().status == status
+    finally:
+        server.shutdown()
+        server.server_close()